@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+# BENCHMARK - FORMULARIO DATOS EXPO FERIA
+# Genera libros sintéticos con la forma de "FORMULARIO DATOS EXPO FERIA.xlsx"
+# (1k / 10k / 100k visitantes, catálogo PROVINCIA real, cédulas válidas, duplicados
+# y premios) y mide las funciones calientes de form_expo_feria2.py. La salida es
+# repetible (semilla fija, mediana y p95 de varias repeticiones) para comparar
+# entre commits:
+#   python bench_expo.py                          # 1000,10000,100000 → bench_output.txt
+#   python bench_expo.py --tamanos 1000,10000 --backend sqlite --json antes.json
+#   python bench_expo.py --comparar antes.json    # agrega la columna Δ% contra otra corrida
+# Cada tamaño corre en un proceso nuevo (cachés de Streamlit vacías) sobre una copia
+# del libro generado; los libros se guardan en <tmp>/expo_bench para no regenerarlos.
+
+import os, re, ast, sys, json, time, random, shutil, hashlib, logging, argparse, platform, importlib, subprocess, tempfile
+from pathlib import Path
+from statistics import median
+
+APP_PATH = Path(__file__).with_name("form_expo_feria2.py")
+EXCEL_FILE = "FORMULARIO DATOS EXPO FERIA.xlsx"
+CACHE_DIR = Path(tempfile.gettempdir()) / "expo_bench"
+SEMILLA = 2025
+
+# ===== PERFIL DE LA FERIA =====
+TASA_DUP_CEDULA = 0.04   # visitantes que se registran otra vez (misma cédula y teléfono)
+TASA_DUP_TELEFONO = 0.02 # teléfono compartido (familia, mismo local)
+TASA_CORREO = 0.6
+TASA_RUC = 0.2           # mecánicos/distribuidores que dan RUC en vez de cédula
+TASA_PUNTAJE = 0.7
+TASA_PREMIO = 0.12
+REPARTO = (("MECANICO", "M", 0.40), ("DISTRIBUIDOR", "D", 0.15), ("CONSUMIDOR", "C", 0.45))
+STANDS = ("PANTRO", "EXTREMEMAX")
+PREMIOS = ("CASCO", "GORRA", "CAMISETA", "LLAVERO", "GUANTES", "ACEITE 1L", "KIT DE HERRAMIENTAS")
+NOMBRES = ("JUAN", "CARLOS", "LUIS", "JOSE", "MARIO", "ANDRES", "DIEGO", "JORGE", "PEDRO", "MIGUEL",
+           "ANA", "MARIA", "LUCIA", "GABRIELA", "SOFIA", "CARMEN", "ROSA", "PAOLA", "DANIELA", "VERONICA")
+APELLIDOS = ("PEREZ", "GARCIA", "LOPEZ", "TORRES", "VERA", "MORA", "CEVALLOS", "ZAMBRANO", "CHAVEZ",
+             "SANCHEZ", "GUERRERO", "ORTIZ", "MENDOZA", "CASTILLO", "PONCE", "RIVERA", "SALAZAR", "NUÑEZ")
+MOTOS = ("DAYTONA 150", "SHINERAY 200", "SUZUKI GN125", "HONDA CB190", "BAJAJ PULSAR 200", "TVS APACHE 160")
+REPUESTOS = ("KIT DE ARRASTRE", "PASTILLAS DE FRENO", "LLANTAS", "BATERIA", "ACEITE", "FILTRO DE AIRE")
+
+# Provincias y cantones reales; las parroquias salen de un repertorio común.
+PROVINCIAS = {
+    "AZUAY": ("CUENCA", "GUALACEO", "PAUTE", "SIGSIG"),
+    "BOLIVAR": ("GUARANDA", "SAN MIGUEL", "CHILLANES"),
+    "CAÑAR": ("AZOGUES", "CAÑAR", "LA TRONCAL"),
+    "CARCHI": ("TULCAN", "MONTUFAR", "ESPEJO"),
+    "CHIMBORAZO": ("RIOBAMBA", "GUANO", "ALAUSI", "COLTA"),
+    "COTOPAXI": ("LATACUNGA", "SALCEDO", "PUJILI", "LA MANA"),
+    "EL ORO": ("MACHALA", "PASAJE", "SANTA ROSA", "HUAQUILLAS"),
+    "ESMERALDAS": ("ESMERALDAS", "QUININDE", "ATACAMES"),
+    "GALAPAGOS": ("SAN CRISTOBAL", "SANTA CRUZ", "ISABELA"),
+    "GUAYAS": ("GUAYAQUIL", "DURAN", "MILAGRO", "DAULE", "SAMBORONDON"),
+    "IMBABURA": ("IBARRA", "OTAVALO", "COTACACHI", "ANTONIO ANTE"),
+    "LOJA": ("LOJA", "CATAMAYO", "MACARA", "SARAGURO"),
+    "LOS RIOS": ("BABAHOYO", "QUEVEDO", "VENTANAS", "VINCES"),
+    "MANABI": ("PORTOVIEJO", "MANTA", "CHONE", "EL CARMEN", "JIPIJAPA"),
+    "MORONA SANTIAGO": ("MORONA", "GUALAQUIZA", "SUCUA"),
+    "NAPO": ("TENA", "ARCHIDONA", "EL CHACO"),
+    "ORELLANA": ("FRANCISCO DE ORELLANA", "LA JOYA DE LOS SACHAS"),
+    "PASTAZA": ("PASTAZA", "MERA"),
+    "PICHINCHA": ("QUITO", "CAYAMBE", "RUMIÑAHUI", "MEJIA", "PEDRO MONCAYO"),
+    "SANTA ELENA": ("SANTA ELENA", "LA LIBERTAD", "SALINAS"),
+    "SANTO DOMINGO DE LOS TSACHILAS": ("SANTO DOMINGO", "LA CONCORDIA"),
+    "SUCUMBIOS": ("LAGO AGRIO", "SHUSHUFINDI"),
+    "TUNGURAHUA": ("AMBATO", "PELILEO", "BAÑOS DE AGUA SANTA", "PILLARO"),
+    "ZAMORA CHINCHIPE": ("ZAMORA", "YANTZAZA", "CHINCHIPE"),
+}
+PARROQUIAS = ("SAN JOSE", "LA MERCED", "SAN ANTONIO", "EL CARMEN", "SANTA ROSA", "SAN PEDRO",
+              "LA PAZ", "SAN JUAN", "EL SAGRARIO", "SAN FRANCISCO", "LA MATRIZ", "SAN LUIS")
+
+# ===== CARGA DE LA APP (sin la interfaz) =====
+def cargar_app(excel_dir, backend):
+    """Importa form_expo_feria2 (sin UI) apuntando a `excel_dir`: una vez por proceso."""
+    os.environ.update(EXCEL_DIR=str(excel_dir), EXCEL_FILE=EXCEL_FILE, STORAGE_BACKEND=backend,
+                      COMPACT_DELAY="3600")  # la compactación se mide aparte, no en medio
+    logging.disable(logging.WARNING)  # avisos de Streamlit sin servidor
+    return importlib.import_module("form_expo_feria2")
+
+def headers_app() -> dict:
+    """HEADERS de la app sin importarla (el proceso padre no debe fijar su EXCEL_DIR)."""
+    src = APP_PATH.read_text(encoding="utf-8")
+    m = re.search(r"^HEADERS = (\{.*?^\})", src, re.S | re.M)
+    return ast.literal_eval(m.group(1))
+
+# ===== GENERADOR DE LIBROS =====
+def cedula_valida(rnd):
+    """Cédula ecuatoriana con dígito verificador correcto."""
+    d = [*divmod(rnd.randint(1, 24), 10), rnd.randint(0, 5)] + [rnd.randint(0, 9) for _ in range(6)]
+    tot = sum(x if x < 10 else x - 9 for x in (v * c for v, c in zip(d, (2, 1, 2, 1, 2, 1, 2, 1, 2))))
+    return "".join(map(str, d)) + str((10 - tot % 10) % 10)
+
+def _catalogo(rnd):
+    """Filas de PROVINCIA como se llenan a mano: provincia y cantón solo en su primera fila."""
+    filas, lugares = [], []
+    for prov, cantones in PROVINCIAS.items():
+        for j, cant in enumerate(cantones):
+            for k, parr in enumerate(rnd.sample(PARROQUIAS, rnd.randint(3, 8))):
+                filas.append([prov if j == 0 and k == 0 else None, cant if k == 0 else None, parr])
+                lugares.append((prov, cant, parr))
+    return filas, lugares
+
+def _fila(headers, v: dict):
+    """Valores por concepto → fila en el orden de `headers` (las hojas no comparten columnas)."""
+    reglas = (("CODIGO", "codigo"), ("PUNTAJE", "puntaje"), ("PREMIO", "premio"), ("NOMBRE DE LA", "local"),
+              ("NOMBRE", "nombre"), ("CEDULA", "ced"), ("RUC", "ced"), ("TELEFONO", "tel"), ("CORREO", "correo"),
+              ("EDAD", "edad"), ("HOMBRE O MUJER", "sexo"), ("PROVINCIA", "prov"), ("CANTON", "cant"),
+              ("PARROQUIA", "parr"), ("DIRECCION", "dir"), ("MODELO", "moto"), ("REPUESTO", "repuesto"),
+              ("TIPO", "tipo"), ("STAND", "stand"))
+    fila = []
+    for h in headers:
+        hn = str(h).upper()
+        fila.append(next((v.get(k) for pat, k in reglas if pat in hn), None))
+    return fila
+
+def generar_libro(destino: Path, n: int, headers: dict, semilla=SEMILLA):
+    """Libro con `n` visitantes repartidos como en la feria; determinista para (n, semilla)."""
+    from openpyxl import Workbook
+    rnd = random.Random(semilla * 1_000_003 + n)
+    cat, lugares = _catalogo(rnd)
+    hojas = {h: [] for h in headers}
+    hojas["PROVINCIA"] = cat
+    contadores, vistos, tels = {}, [], []
+    for _ in range(n):
+        hoja, pfx = rnd.choices([(h, p) for h, p, _ in REPARTO], [w for *_, w in REPARTO])[0]
+        contadores[pfx] = contadores.get(pfx, 0) + 1
+        codigo = f"{pfx}{contadores[pfx]}"
+        if vistos and rnd.random() < TASA_DUP_CEDULA:
+            ced, nombre, tel = rnd.choice(vistos)
+        else:
+            ced = cedula_valida(rnd)
+            if hoja != "CONSUMIDOR" and rnd.random() < TASA_RUC: ced += "001"
+            nombre = f"{rnd.choice(NOMBRES)} {rnd.choice(APELLIDOS)} {rnd.choice(APELLIDOS)}"
+            tel = rnd.choice(tels) if tels and rnd.random() < TASA_DUP_TELEFONO else f"09{rnd.randint(0, 99999999):08d}"
+            vistos.append((ced, nombre, tel)); tels.append(tel)
+        prov, cant, parr = rnd.choice(lugares)
+        stand = rnd.choice(STANDS)
+        v = {"codigo": codigo, "nombre": nombre, "ced": ced, "tel": tel, "edad": rnd.randint(16, 70),
+             "correo": (nombre.split()[0] + str(rnd.randint(1, 999)) + "@mail.com").lower()
+                       if hoja != "CONSUMIDOR" and rnd.random() < TASA_CORREO else None,
+             "sexo": rnd.choice(("HOMBRE", "MUJER")), "prov": prov, "cant": cant, "parr": parr,
+             "dir": f"CALLE {rnd.randint(1, 60)} Y AV. {rnd.choice(APELLIDOS)}", "moto": rnd.choice(MOTOS),
+             "repuesto": rnd.choice(REPUESTOS), "local": f"TALLER {rnd.choice(APELLIDOS)}", "stand": stand}
+        hojas[hoja].append(_fila(headers[hoja], v))
+        reg = {"codigo": codigo, "ced": ced, "nombre": nombre, "tel": tel, "tipo": hoja, "stand": stand,
+               "puntaje": rnd.randint(0, 500) if rnd.random() < TASA_PUNTAJE else None}
+        hojas["REGISTRO DE CODIGOS"].append(_fila(headers["REGISTRO DE CODIGOS"], reg))
+        if rnd.random() < TASA_PREMIO:
+            hojas["REGISTRO DE PREMIOS"].append(_fila(headers["REGISTRO DE PREMIOS"], {**reg, "premio": rnd.choice(PREMIOS)}))
+    wb = Workbook(write_only=True)
+    for hoja, filas in hojas.items():
+        ws = wb.create_sheet(hoja); ws.append(headers[hoja])
+        for f in filas: ws.append(f)
+    destino.parent.mkdir(parents=True, exist_ok=True)
+    tmp = destino.with_suffix(".tmp.xlsx"); wb.save(tmp); os.replace(tmp, destino)
+    return {"visitantes": n, "premios": len(hojas["REGISTRO DE PREMIOS"]), "provincia_filas": len(cat),
+            "cedulas": [c for c, *_ in vistos]}
+
+def libro_en_cache(n: int, headers: dict) -> Path:
+    """Libro generado (se reutiliza si los encabezados de la app no cambiaron)."""
+    firma = hashlib.blake2b(json.dumps(headers, sort_keys=True).encode(), digest_size=4).hexdigest()
+    p = CACHE_DIR / f"libro_{n}_{SEMILLA}_{firma}.xlsx"
+    meta = p.with_suffix(".json")
+    if not (p.exists() and meta.exists()):
+        meta.parent.mkdir(parents=True, exist_ok=True)
+        meta.write_text(json.dumps(generar_libro(p, n, headers)), encoding="utf-8")
+    return p
+
+# ===== MEDICIÓN =====
+def medir(nombre, fn, reps):
+    """fn(i) `reps` veces; devuelve mediana y p95 en milisegundos."""
+    ts = []
+    for i in range(reps):
+        t = time.perf_counter(); fn(i); ts.append((time.perf_counter() - t) * 1000)
+    ts.sort()
+    return {"funcion": nombre, "n": reps, "mediana_ms": round(median(ts), 3),
+            "p95_ms": round(ts[min(len(ts) - 1, int(0.95 * len(ts)))], 3)}
+
+def correr_tamano(n: int, backend: str) -> list:
+    """Se ejecuta en un proceso propio: el orden importa (primero lo "frío")."""
+    trabajo = Path(tempfile.mkdtemp(prefix="expo_bench_"))
+    try:
+        libro = libro_en_cache(n, headers_app())
+        meta = json.loads(libro.with_suffix(".json").read_text(encoding="utf-8"))
+        shutil.copy(libro, trabajo / EXCEL_FILE)
+        app = cargar_app(trabajo, backend)
+        rnd = random.Random(SEMILLA + n)
+        ceds = meta["cedulas"]
+        codigos = [f"{p}{rnd.randint(1, max(1, int(n * w)))}" for _, p, w in REPARTO for _ in range(100)]
+        rnd.shuffle(codigos)
+        # Búsquedas típicas del stand: código exacto, apellido, inicio de cédula, stand, sin resultados.
+        consultas = [codigos[0], "perez", ceds[0][:5], "PANTRO", "zz-no-existe", "GARCIA TORRES", "m1"]
+        res = []
+        t = time.perf_counter(); app.storage()
+        res.append({"funcion": "storage (arranque)", "n": 1, "mediana_ms": round((time.perf_counter() - t) * 1000, 3), "p95_ms": None})
+        # load_province_index ya no existe: catalogo_geo() es el catálogo compilado (GEO_PATH).
+        prov = lambda i: app.catalogo_geo()
+        res.append(medir("catalogo_geo (load_province_index) [frío]", prov, 1))
+        res.append(medir("catalogo_geo (load_province_index)", prov, 50))
+        geo = ["SAN", "TAR", "MANTA", "QUITO", "LA", "ZZ"]
+        res.append(medir("catalogo_geo().buscar", lambda i: app.catalogo_geo().buscar(geo[i % len(geo)]), 300))
+        res.append(medir("load_registros_codigos [frío]", lambda i: app.load_registros_codigos(), 1))
+        res.append(medir("load_registros_codigos", lambda i: app.load_registros_codigos(), 10))
+        dup = lambda i: app.buscar_duplicados(ceds[(i * 7919) % len(ceds)] if i % 4 else cedula_valida(rnd), "",
+                                                 f"09{(i * 104729) % 10**8:08d}")
+        res.append(medir("buscar_duplicados [frío]", dup, 1))
+        res.append(medir("buscar_duplicados", dup, 200))
+        # filtrar_por_query y lookup_stand_by_code ya no existen: buscar() (índice de
+        # trigramas) y perfil() (unión código → visitante) son sus reemplazos.
+        busca = lambda i: app.buscar("codigos", consultas[i % len(consultas)])
+        res.append(medir("buscar (filtrar_por_query) [frío]", busca, 1))
+        res.append(medir("buscar (filtrar_por_query)", busca, 5 * len(consultas)))
+        res.append(medir("perfil (lookup_stand_by_code)", lambda i: app.perfil(codigos[i % len(codigos)]), 500))
+        res.append(medir("next_code (escaneo completo)", lambda i: app.next_code("M"), 3))
+        res.append(medir("allocate_code", lambda i: app.allocate_code("M"), 100))
+        hp = app.HEADERS["REGISTRO DE PREMIOS"]
+        res.append(medir("append_row", lambda i: app.append_row("REGISTRO DE PREMIOS", _fila(hp, {
+            "codigo": codigos[i % len(codigos)], "premio": PREMIOS[i % len(PREMIOS)]})), 50))
+        res.append(medir("upsert_registro_codigo", lambda i: app.upsert_registro_codigo(
+            codigos[i % len(codigos)], ceds[i % len(ceds)], "BENCH", "0999999999", "MECANICO", "PANTRO"), 50))
+        hc = app.HEADERS["CONSUMIDOR"]
+        def registrar(i):
+            ced = cedula_valida(rnd)
+            fila = _fila(hc, {"nombre": f"BENCH {i}", "ced": ced, "tel": "0999999999", "stand": "PANTRO"})[1:]
+            app.registrar_visitante("CONSUMIDOR", "C", fila, ced, "", "0999999999", f"BENCH {i}", "PANTRO")
+        res.append(medir("registrar_visitante", registrar, 30))
+        res.append(medir("load_registros_codigos (tras escrituras)", lambda i: app.load_registros_codigos(), 5))
+        res.append(medir("export_xlsx (compactación)", lambda i: app.storage().export_xlsx(), 1))
+        # Tras compactar la capa columnar solo actualiza las particiones de hoy (sin reparsear).
+        res.append(medir("frames (tras compactación)", lambda i: app.storage().frames(), 1))
+        hoy = app.ahora()[:10]
+        res.append(medir("exportar_hojas (stand + hoy)", lambda i: app.exportar_hojas(
+            ["CONSUMIDOR", "REGISTRO DE CODIGOS"], stand="PANTRO", desde=hoy + " 00:00:00", hasta=hoy + " 23:59:59"), 5))
+        # Siguientes compactaciones: solo se reescriben las hojas con eventos (10 puntajes + 1 premio).
+        def compactar_poco(i):
+            for k in range(10): app.storage().upsert("REGISTRO DE CODIGOS", codigos[(i * 10 + k) % len(codigos)], {"PUNTAJE": k})
+            app.append_row("REGISTRO DE PREMIOS", _fila(hp, {"codigo": codigos[i % len(codigos)], "premio": PREMIOS[0]}))
+            app.storage().export_xlsx()
+        res.append(medir("export_xlsx (incremental, 11 eventos)", compactar_poco, 3))
+        for r in res: r["tamano"] = n
+        return res
+    finally:
+        shutil.rmtree(trabajo, ignore_errors=True)
+
+# ===== INFORME =====
+def _version_codigo():
+    try:
+        sha = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=APP_PATH.parent,
+                             capture_output=True, text=True).stdout.strip()
+        sucio = subprocess.run(["git", "status", "--porcelain", "--", APP_PATH.name], cwd=APP_PATH.parent,
+                               capture_output=True, text=True).stdout.strip()
+        return (sha or "?") + ("+cambios" if sucio else "")
+    except OSError: return "?"
+
+def informe(corrida: dict, base: dict = None) -> str:
+    ref = {(r["tamano"], r["funcion"]): r for r in (base or {}).get("resultados", [])}
+    lineas = [f"# bench_expo  commit={corrida['commit']}  backend={corrida['backend']}  "
+              f"python={corrida['python']}  semilla={SEMILLA}"]
+    if base: lineas.append(f"# comparado con commit={base.get('commit')} (Δ% de la mediana; negativo = más rápido)")
+    cab = f"{'tamaño':>7}  {'función':<42} {'n':>4} {'mediana ms':>11} {'p95 ms':>10}" + ("   Δ%" if base else "")
+    lineas += [cab, "-" * len(cab)]
+    for r in corrida["resultados"]:
+        p95 = "" if r["p95_ms"] is None else f"{r['p95_ms']:.3f}"
+        fila = f"{r['tamano']:>7}  {r['funcion']:<42} {r['n']:>4} {r['mediana_ms']:>11.3f} {p95:>10}"
+        b = ref.get((r["tamano"], r["funcion"]))
+        if b and b["mediana_ms"]:
+            fila += f" {100 * (r['mediana_ms'] - b['mediana_ms']) / b['mediana_ms']:+6.1f}"
+        lineas.append(fila)
+    return "\n".join(lineas) + "\n"
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark de form_expo_feria2.py con libros sintéticos.")
+    ap.add_argument("--tamanos", default="1000,10000,100000", help="visitantes por libro, separados por coma")
+    ap.add_argument("--backend", default="excel", choices=("excel", "sqlite"))
+    ap.add_argument("--salida", default="bench_output.txt", help="informe de texto")
+    ap.add_argument("--json", help="guarda los resultados para compararlos después")
+    ap.add_argument("--comparar", help="JSON de otra corrida (p. ej. de otro commit)")
+    ap.add_argument("--_hijo", nargs=3, metavar=("N", "BACKEND", "JSON"), help=argparse.SUPPRESS)
+    args = ap.parse_args()
+    if args._hijo:
+        n, backend, out = args._hijo
+        Path(out).write_text(json.dumps(correr_tamano(int(n), backend)), encoding="utf-8"); return
+    corrida = {"commit": _version_codigo(), "backend": args.backend, "python": platform.python_version(),
+               "resultados": []}
+    for n in (int(x) for x in args.tamanos.split(",") if x.strip()):
+        print(f"… {n} visitantes", file=sys.stderr)
+        with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as f: out = f.name
+        try:
+            subprocess.run([sys.executable, __file__, "--_hijo", str(n), args.backend, out], check=True)
+            corrida["resultados"] += json.loads(Path(out).read_text(encoding="utf-8"))
+        finally: os.remove(out)
+    base = json.loads(Path(args.comparar).read_text(encoding="utf-8")) if args.comparar else None
+    texto = informe(corrida, base)
+    print(texto, end="")
+    Path(args.salida).write_text(texto, encoding="utf-8")
+    if args.json: Path(args.json).write_text(json.dumps(corrida, indent=1), encoding="utf-8")
+
+if __name__ == "__main__":
+    main()
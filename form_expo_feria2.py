@@ -2,10 +2,25 @@
 # FORMULARIO DATOS EXPO FERIA - versión integral y robusta
 # MECANICO / DISTRIBUIDOR / CONSUMIDOR / PUNTAJE / PREMIOS / CONSULTA / STAND
 
-import os, re, time
+import io, os, re, hmac, time, json, atexit, queue, shutil, weakref, zipfile, hashlib, sqlite3, tempfile, threading
+import importlib.util
+from bisect import bisect_left, insort
+from collections import Counter, deque
+from contextlib import contextmanager
+from functools import wraps
+from itertools import groupby
 from pathlib import Path
+from xml.etree import ElementTree as ET
+from xml.sax.saxutils import escape as xml_escape, unescape as xml_unescape
+try: import fcntl
+except ImportError: fcntl = None; import msvcrt  # Windows
+import numpy as np
+import pandas as pd
 import streamlit as st
 from openpyxl import Workbook, load_workbook
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+from openpyxl.utils import get_column_letter, column_index_from_string
+from openpyxl.packaging.custom import StringProperty
 
 st.set_page_config(page_title="Formulario Expo Feria", page_icon="📝", layout="centered")
 
@@ -16,6 +31,31 @@ EXCEL_DIR = os.environ.get("EXCEL_DIR", "data")
 EXCEL_FILE = os.environ.get("EXCEL_FILE", "FORMULARIO DATOS EXPO FERIA.xlsx")
 EXCEL_PATH = Path(EXCEL_DIR) / EXCEL_FILE
 EXCEL_PATH.parent.mkdir(parents=True, exist_ok=True)
+# Journal append-only: cada registro es una línea JSON; el Excel se compacta aparte.
+JOURNAL_PATH = EXCEL_PATH.with_name(EXCEL_PATH.stem + ".journal.jsonl")
+COMPACT_DELAY = float(os.environ.get("COMPACT_DELAY", "3"))  # segundos
+# Última compactación: identidad del .xlsx resultante, la de los datos "base" y el seq.
+COMPACT_MARK_PATH = EXCEL_PATH.with_name(EXCEL_PATH.stem + ".compactado.json")
+# Hojas del .xlsx en Arrow, por hash de contenido (ver CAPA COLUMNAR).
+COLUMNAR_DIR = EXCEL_PATH.with_name(EXCEL_PATH.stem + ".columnar")
+# Contadores persistentes de códigos (M/D/C): último número entregado por prefijo.
+COUNTERS_PATH = EXCEL_PATH.with_name(EXCEL_PATH.stem + ".codigos.json")
+# Qué (hoja, CODIGO) tocó cada compactación: el journal se trunca, esto no (ver CARGA DE EXCEL).
+HISTORIAL_PATH = EXCEL_PATH.with_name(EXCEL_PATH.stem + ".historial.jsonl")
+# Catálogo provincia → cantón → parroquia compilado (ver CATÁLOGO GEOGRÁFICO).
+GEO_PATH = EXCEL_PATH.with_name(EXCEL_PATH.stem + ".geo.json")
+# Hojas y encabezados ya reconciliados con HEADERS, por identidad del .xlsx (ver ESQUEMA VERIFICADO).
+ESQUEMA_PATH = EXCEL_PATH.with_name(EXCEL_PATH.stem + ".esquema.json")
+CODE_PREFIXES = ("M", "D", "C")
+# Modo multi-nodo (varias laptops, cada una con su EXCEL_DIR): el nodo NODE_ID de NODE_COUNT
+# solo entrega números ≡ NODE_ID (mód NODE_COUNT), así dos nodos nunca repiten un código.
+NODE_COUNT = max(1, int(os.environ.get("NODE_COUNT", "1")))
+NODE_ID = int(os.environ.get("NODE_ID", "1"))
+if not 1 <= NODE_ID <= NODE_COUNT:
+    raise ValueError(f"NODE_ID debe estar entre 1 y NODE_COUNT ({NODE_COUNT}); es {NODE_ID}.")
+# Motor de almacenamiento: "excel" (journal + .xlsx) o "sqlite" (el .xlsx se exporta).
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "excel").strip().lower()
+SQLITE_PATH = EXCEL_PATH.with_suffix(".sqlite3")
 
 # ===== ENCABEZADOS =====
 HEADERS = {
@@ -37,56 +77,169 @@ HEADERS = {
         "QUE REPUESTO BUSCAS?","SI HAS COMPRANDO PRODCUTOS EXTREMEMAX?","STAND"
     ],
     "PROVINCIA": ["PROVINCIA","CANTON/CIUDAD","PARROQUIA"],
-    "REGISTRO DE CODIGOS": ["CODIGO","PUNTAJE","RUC O CEDULA","NOMBRE","TELEFONO","TIPO","STAND"],
+    "REGISTRO DE CODIGOS": ["CODIGO","PUNTAJE","RUC O CEDULA","NOMBRE","TELEFONO","TIPO","STAND","FECHA REGISTRO"],
     "REGISTRO DE PREMIOS": ["CODIGO","PREMIO","RUC O CEDULA","NOMBRE","TELEFONO","TIPO","STAND"],
 }
 
+# ===== MÉTRICAS OPERATIVAS =====
+# Almacén en memoria del proceso (compartido por todas las sesiones): tiempos
+# (ventana móvil → p50/p95) y contadores. Se ven en el panel oculto (?admin=…) y
+# se pueden volcar en formato Prometheus o JSON lines. Nombres y etiquetas:
+#   tiempos (s):  excel_carga{modo}, excel_guardado, columnar_parseo, vista_construir{vista},
+#                 escritor_lote{backend}, accion{accion: registrar|puntaje|puntaje_lote|premio|buscar|importar|exportar}
+#   contadores:   excel_bytes_escritos, excel_reintentos{op},
+#                 cache{cache,resultado}, escritor_eventos{backend}, compactaciones, eventos_compactados
+METRICAS_VENTANA = float(os.environ.get("METRICAS_VENTANA", "900"))  # segundos
+METRICAS_MAX = 4096                                                 # observaciones por serie
+METRICAS_PATH = os.environ.get("METRICAS_PATH", "")  # p. ej. /var/lib/node_exporter/expo.{pid}.prom
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")  # sin él no hay panel
+
+@st.cache_resource(show_spinner=False)
+def _metricas():
+    m = {"lock": threading.Lock(), "tiempos": {}, "contadores": {}, "desde": time.time()}
+    if METRICAS_PATH:
+        def volcar():
+            while True:
+                time.sleep(15)
+                try: _escribir_metricas(Path(METRICAS_PATH.replace("{pid}", str(os.getpid()))))
+                except Exception: pass
+        threading.Thread(target=volcar, name="expo-metricas", daemon=True).start()
+    return m
+
+def _serie(labels: dict) -> tuple:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def metrica_contar(nombre: str, n=1, **labels):
+    m = _metricas(); k = (nombre, _serie(labels))
+    with m["lock"]: m["contadores"][k] = m["contadores"].get(k, 0) + n
+
+def metrica_tiempo(nombre: str, segundos: float, **labels):
+    m = _metricas(); k = (nombre, _serie(labels))
+    with m["lock"]:
+        s = m["tiempos"].get(k)
+        if s is None: s = m["tiempos"][k] = {"obs": deque(maxlen=METRICAS_MAX), "n": 0, "suma": 0.0}
+        s["obs"].append((time.time(), segundos)); s["n"] += 1; s["suma"] += segundos
+
+def metrica_cache(cache: str, acierto: bool):
+    metrica_contar("cache", cache=cache, resultado="acierto" if acierto else "fallo")
+
+@contextmanager
+def medir(nombre: str, **labels):
+    """Mide el bloque (también si lanza una excepción)."""
+    t = time.perf_counter()
+    try: yield
+    finally: metrica_tiempo(nombre, time.perf_counter() - t, **labels)
+
+def medido(nombre: str, **labels):
+    """Decorador: mide cada llamada a la función."""
+    def deco(fn):
+        @wraps(fn)
+        def envuelta(*a, **kw):
+            with medir(nombre, **labels): return fn(*a, **kw)
+        return envuelta
+    return deco
+
+def _percentil(ordenados, q):
+    return ordenados[min(len(ordenados) - 1, int(q * len(ordenados)))] if ordenados else None
+
+def resumen_metricas() -> dict:
+    """{"tiempos": [...], "contadores": [...]} con p50/p95/máx de la ventana móvil."""
+    m = _metricas(); corte = time.time() - METRICAS_VENTANA
+    with m["lock"]:
+        tiempos = [(k, [v for ts, v in s["obs"] if ts >= corte], s["n"], s["suma"]) for k, s in m["tiempos"].items()]
+        contadores = list(m["contadores"].items())
+    filas = []
+    for (nombre, labels), vals, n, suma in sorted(tiempos):
+        vals.sort()
+        filas.append({"metrica": nombre, **dict(labels), "n_ventana": len(vals),
+                      "p50_ms": None if not vals else round(_percentil(vals, 0.5) * 1000, 2),
+                      "p95_ms": None if not vals else round(_percentil(vals, 0.95) * 1000, 2),
+                      "max_ms": None if not vals else round(vals[-1] * 1000, 2),
+                      "n_total": n, "suma_s": round(suma, 4)})
+    return {"tiempos": filas,
+            "contadores": [{"metrica": nombre, **dict(labels), "total": v} for (nombre, labels), v in sorted(contadores)]}
+
+def _prom_labels(d: dict) -> str:
+    return "{" + ",".join(f'{k}="{str(v).replace(chr(34), chr(39))}"' for k, v in d.items()) + "}" if d else ""
+
+def metricas_prometheus() -> str:
+    """Formato de texto de Prometheus: tiempos como summary (segundos), contadores como counter."""
+    r = resumen_metricas(); lineas = []; tipos = set()
+    fijas = ("metrica", "n_ventana", "p50_ms", "p95_ms", "max_ms", "n_total", "suma_s", "total")
+    for f in r["tiempos"]:
+        nombre = f"expo_{f['metrica']}_segundos"; labels = {k: v for k, v in f.items() if k not in fijas}
+        if nombre not in tipos: lineas.append(f"# TYPE {nombre} summary"); tipos.add(nombre)
+        for q, campo in (("0.5", "p50_ms"), ("0.95", "p95_ms")):
+            if f[campo] is not None:
+                lineas.append(f"{nombre}{_prom_labels({**labels, 'quantile': q})} {f[campo] / 1000:.6f}")
+        lineas.append(f"{nombre}_sum{_prom_labels(labels)} {f['suma_s']}")
+        lineas.append(f"{nombre}_count{_prom_labels(labels)} {f['n_total']}")
+    for f in r["contadores"]:
+        nombre = f"expo_{f['metrica']}_total"; labels = {k: v for k, v in f.items() if k not in fijas}
+        if nombre not in tipos: lineas.append(f"# TYPE {nombre} counter"); tipos.add(nombre)
+        lineas.append(f"{nombre}{_prom_labels(labels)} {f['total']}")
+    return "\n".join(lineas) + "\n"
+
+def metricas_jsonl() -> str:
+    r = resumen_metricas(); ts = round(time.time(), 3)
+    return "".join(json.dumps({"ts": ts, "pid": os.getpid(), "tipo": tipo, **f}, ensure_ascii=False) + "\n"
+                   for tipo in ("tiempos", "contadores") for f in r[tipo])
+
+def _escribir_metricas(path: Path):
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(metricas_prometheus(), encoding="utf-8"); os.replace(tmp, path)
+
 # ===== UTILIDADES EXCEL (robusto) =====
 def _mtime(p: Path) -> float:
     try: return os.path.getmtime(p)
     except: return 0.0
 
+def _file_size(p: Path) -> int:
+    try: return os.path.getsize(p)
+    except OSError: return 0
+
 def safe_load_workbook(path, read_only=False, data_only=False, tries=10, wait=0.4):
     last = None
     for _ in range(tries):
         try:
-            return load_workbook(path, read_only=read_only, data_only=data_only)
+            with medir("excel_carga", modo="lectura" if read_only else "completa"):
+                return load_workbook(path, read_only=read_only, data_only=data_only)
         except PermissionError as e:
-            last = e
+            last = e; metrica_contar("excel_reintentos", op="carga")
             time.sleep(wait)
     raise last if last else PermissionError("No se pudo abrir el Excel (bloqueado).")
 
-def safe_save_workbook(wb, path: Path, tries=30, wait=0.5):
+def safe_save_workbook(wb, path: Path, tries=30, wait=0.5, antes_de_reemplazar=None):
     """
-    1) Intenta guardar directo (Windows-friendly).
-    2) Reintenta varias veces si está bloqueado.
-    3) Si no se puede, guarda una COPIA con timestamp en la misma carpeta.
+    1) Guarda en un temporal PROPIO (proceso + hilo) y lo reemplaza de forma atómica:
+       los lectores nunca ven un .xlsx a medio escribir y dos guardados a la vez no
+       se pisan el temporal.
+    2) Reintenta varias veces si está bloqueado; si no se puede, relanza el error
+       (sin copias con otro nombre: los datos siguen en el journal / SQLite).
+    `antes_de_reemplazar(key)` recibe la identidad (_file_key) que tendrá el archivo:
+    os.replace conserva mtime y tamaño del temporal.
+    `wb` puede ser cualquier objeto con save(path)/close() (p. ej. _LibroIncremental).
+    Quien guarda el Excel compartido debe tener file_lock("excel"). Devuelve la ruta.
     """
     last = None
-    for _ in range(tries):
-        try:
-            wb.save(path)
-            try: wb.close()
-            except: pass
-            return
-        except PermissionError as e:
-            last = e; time.sleep(wait)
-        except Exception as e:
-            last = e; break
-
-    # Fallback: copia con timestamp
-    stamp = time.strftime("%Y%m%d-%H%M%S")
-    alt = path.with_name(f"{path.stem}_copia_{stamp}{path.suffix}")
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
     try:
-        wb.save(alt)
-        try: wb.close()
-        except: pass
-        st.warning(f"⚠️ El archivo principal está bloqueado. Guardé una COPIA: {alt}")
-        return
-    except Exception as e2:
+        for _ in range(tries):
+            try:
+                with medir("excel_guardado"):
+                    wb.save(tmp)
+                    if antes_de_reemplazar: antes_de_reemplazar(_file_key(tmp))
+                    os.replace(tmp, path)
+                metrica_contar("excel_bytes_escritos", _file_size(path))
+                return path
+            except PermissionError as e:
+                last = e; metrica_contar("excel_reintentos", op="guardado"); time.sleep(wait)
+        raise last
+    finally:
+        try: os.remove(tmp)
+        except OSError: pass
         try: wb.close()
         except: pass
-        raise last or e2
 
 def _norm_text(x):
     if x is None: return ""
@@ -114,36 +267,1662 @@ def _sync_headers(ws, desired_headers):
     return changed
 
 def ensure_workbook(path: Path):
+    with file_lock("excel"):
+        _ensure_workbook(path)
+
+def _ensure_workbook(path: Path):
+    # Esta versión del archivo ya se verificó (al arrancar, en otro proceso, o es la
+    # que dejó nuestra compactación): no se abre el libro.
+    verificado = _esquema(_file_key(path)) is not None
+    metrica_cache("esquema", verificado)
+    if verificado: return
     if not path.exists():
         wb=Workbook()
         if "Sheet" in wb.sheetnames: wb.remove(wb["Sheet"])
         for name, headers in HEADERS.items():
             ws=wb.create_sheet(name); ws.append(headers)
-        safe_save_workbook(wb, path); return
-    try: wb=safe_load_workbook(path)
-    except PermissionError: return
-    changed=False
-    for name, headers in HEADERS.items():
-        if name not in wb.sheetnames:
-            ws=wb.create_sheet(name); ws.append(headers); changed=True
+        try: safe_save_workbook(wb, path)
+        except PermissionError: return
+        _esquema_publicar(_file_key(path), _encabezados(wb))
+        return
+    # Chequeo barato en solo lectura (solo la fila 1): la carga completa solo si falta algo.
+    hojas = _encabezados_al_dia(path)
+    if hojas is None:
+        try: wb=safe_load_workbook(path)
+        except PermissionError: return
+        changed=False
+        for name, headers in HEADERS.items():
+            if name not in wb.sheetnames:
+                ws=wb.create_sheet(name); ws.append(headers); changed=True
+            else:
+                ws=wb[name]
+                if _sync_headers(ws, headers): changed=True
+        hojas = _encabezados(wb)
+        if changed:
+            try: safe_save_workbook(wb, path)
+            except PermissionError: return
+    _esquema_publicar(_file_key(path), hojas)
+
+def _encabezados(wb) -> dict:
+    """{hoja: fila 1} de todas las hojas (texto; vacío en lugar de None)."""
+    return {ws.title: ["" if v is None else str(v) for v in next(ws.iter_rows(min_row=1, max_row=1, values_only=True), ())]
+            for ws in wb.worksheets}
+
+def _encabezados_al_dia(path: Path):
+    """Encabezados de cada hoja si ya cumplen HEADERS; None si falta algo (o no se pudo leer)."""
+    try: wb=safe_load_workbook(path, read_only=True)
+    except Exception: return None
+    try:
+        hojas = _encabezados(wb)
+        for name, headers in HEADERS.items():
+            if name not in hojas: return None
+            head={_norm_text(h) for h in hojas[name]}
+            if any(_norm_text(h) not in head for h in headers): return None
+        return hojas
+    finally: wb.close()
+
+# ===== ESQUEMA VERIFICADO =====
+# Hojas y encabezados del .xlsx ya reconciliados con HEADERS, atados a la identidad
+# del archivo (_file_key) y a la versión de HEADERS, guardados en ESQUEMA_PATH. Se
+# reconcilia al arrancar y tras una carga (o una edición a mano); mientras la
+# identidad coincida nadie reabre el libro para confirmar la fila 1. Las
+# compactaciones no tocan encabezados: solo mueven la identidad.
+_ESQUEMA_HEADERS = hashlib.blake2b(json.dumps(HEADERS, sort_keys=True).encode(), digest_size=8).hexdigest()
+
+@st.cache_resource(show_spinner=False)
+def _esquema_state():
+    return {"lock": threading.Lock(), "actual": None, "disco": None}  # actual: {"key", "hojas", "hmaps"}
+
+def _esquema_nuevo(key, hojas):
+    return {"key": tuple(key), "hojas": hojas,
+            "hmaps": {h: {_norm_text(v): i for i, v in enumerate(cols)} for h, cols in hojas.items()}}
+
+def _esquema_leer():
+    try: datos = json.loads(ESQUEMA_PATH.read_text(encoding="utf-8"))
+    except (OSError, ValueError): return None
+    if datos.get("headers") != _ESQUEMA_HEADERS or not datos.get("key"): return None
+    return _esquema_nuevo(datos["key"], datos["hojas"])
+
+def _esquema(key):
+    """Esquema verificado ({"key", "hojas", "hmaps"}) de la versión `key` del .xlsx, o None."""
+    if key is None: return None
+    es = _esquema_state(); key = tuple(key)
+    with es["lock"]:
+        e = es["actual"]
+        if e is None or e["key"] != key:
+            # Otro proceso pudo verificar (o compactar) esta versión: se relee el archivo si cambió.
+            d = _file_key(ESQUEMA_PATH)
+            if d != es["disco"]:
+                es["disco"] = d; e = _esquema_leer()
+                if e is not None: es["actual"] = e
+        return e if e is not None and e["key"] == key else None
+
+def _esquema_publicar(key, hojas):
+    if key is None: return
+    es = _esquema_state(); tmp = ESQUEMA_PATH.with_suffix(f".{os.getpid()}.tmp")
+    with es["lock"]:
+        es["actual"] = _esquema_nuevo(key, hojas)
+        try:
+            tmp.write_text(json.dumps({"headers": _ESQUEMA_HEADERS, "key": list(key), "hojas": hojas},
+                                      ensure_ascii=False), encoding="utf-8")
+            os.replace(tmp, ESQUEMA_PATH); es["disco"] = _file_key(ESQUEMA_PATH)
+        except OSError: pass  # sin permisos: el esquema queda solo en memoria
+
+def columnas(hoja, key=None):
+    """Encabezado normalizado → posición en `hoja`, del esquema verificado (None si no lo hay)."""
+    e = _esquema(_file_key(EXCEL_PATH) if key is None else key)
+    return e["hmaps"].get(hoja) if e else None
+
+# ===== CANDADOS ENTRE PROCESOS =====
+# Cada sesión de Streamlit es un hilo y puede haber varias réplicas sobre el mismo
+# EXCEL_DIR: todo lo que escribe toma un candado del SO sobre "<archivo>.<nombre>.lock".
+#   "excel":   cargar+guardar el .xlsx (compactación, encabezados, carga de archivo)
+#   "journal": agregar/truncar el journal y los contadores de códigos (operaciones cortas)
+@st.cache_resource(show_spinner=False)
+def _file_lock_state():
+    return {"lock": threading.Lock(), "locks": {}}
+
+def _os_lock(fh):
+    if fcntl: fcntl.flock(fh.fileno(), fcntl.LOCK_EX); return
+    fh.seek(0)
+    while True:
+        try: msvcrt.locking(fh.fileno(), msvcrt.LK_LOCK, 1); return
+        except OSError: time.sleep(0.05)
+
+def _os_unlock(fh):
+    if fcntl: fcntl.flock(fh.fileno(), fcntl.LOCK_UN); return
+    fh.seek(0); msvcrt.locking(fh.fileno(), msvcrt.LK_UNLCK, 1)
+
+@contextmanager
+def file_lock(nombre: str):
+    """Candado exclusivo entre procesos e hilos; reentrante dentro del mismo hilo."""
+    fs = _file_lock_state()
+    with fs["lock"]:
+        ent = fs["locks"].setdefault(nombre, {"rlock": threading.RLock(), "depth": 0, "fh": None})
+    with ent["rlock"]:
+        if ent["depth"] == 0:
+            fh = open(EXCEL_PATH.with_name(f"{EXCEL_PATH.stem}.{nombre}.lock"), "a+b")
+            try: _os_lock(fh)
+            except Exception: fh.close(); raise
+            ent["fh"] = fh
+        ent["depth"] += 1
+        try: yield
+        finally:
+            ent["depth"] -= 1
+            if ent["depth"] == 0:
+                try: _os_unlock(ent["fh"])
+                finally: ent["fh"].close(); ent["fh"] = None
+
+# ===== ÍNDICE CODIGO → FILA =====
+# Número de fila (primera aparición) de cada CODIGO por hoja, atado a la identidad
+# del .xlsx (mtime_ns, tamaño): si el archivo cambia (compactación de otro proceso,
+# carga desde la app, re-ordenado a mano) el índice se reconstruye solo. La
+# compactación lo mantiene al día y lo publica con la identidad del archivo nuevo.
+@st.cache_resource(show_spinner=False)
+def _row_index_state():
+    return {"lock": threading.Lock(), "key": None, "sheets": {}}
+
+def _file_key(path: Path):
+    try: stt = os.stat(path); return (stt.st_mtime_ns, stt.st_size)
+    except OSError: return None
+
+def _build_code_rows(ws) -> dict:
+    ci = find_col(header_map(ws), "CODIGO")
+    idx = {}
+    if ci is None: return idx
+    for r, vals in enumerate(ws.iter_rows(min_row=2, min_col=ci+1, max_col=ci+1, values_only=True), start=2):
+        cod = str((vals[0] if vals else "") or "").strip().upper()
+        if cod: idx.setdefault(cod, r)
+    return idx
+
+def code_rows(wb, hoja) -> dict:
+    """CODIGO → fila de `hoja` en `wb` (cacheado si `wb` trae la identidad del archivo)."""
+    ri = _row_index_state(); key = getattr(wb, "_file_key", None)
+    with ri["lock"]:
+        if key is not None and ri["key"] == key and hoja in ri["sheets"]:
+            metrica_cache("codigo_fila", True); return ri["sheets"][hoja]
+    metrica_cache("codigo_fila", False)
+    idx = _build_code_rows(wb[hoja])
+    if key is not None:
+        with ri["lock"]:
+            if ri["key"] != key: ri["key"], ri["sheets"] = key, {}
+            ri["sheets"][hoja] = idx
+    return idx
+
+def _publish_code_rows(key, sheets: dict, base_key=None):
+    """Tras guardar: las hojas tocadas traen su índice nuevo; las demás siguen válidas."""
+    ri = _row_index_state()
+    with ri["lock"]:
+        keep = ri["sheets"] if base_key is not None and ri["key"] == base_key else {}
+        ri["key"], ri["sheets"] = key, {**keep, **sheets}
+
+def reset_code_rows():
+    ri = _row_index_state()
+    with ri["lock"]: ri["key"], ri["sheets"] = None, {}
+
+# ===== INSTANTÁNEAS DE LECTURA COMPARTIDAS =====
+# Un solo libro openpyxl (solo lectura) por versión del .xlsx para todo el proceso:
+# sesiones, pestañas e hilos lo comparten (zipfile serializa las lecturas). Se abre
+# desde los bytes en memoria, sin dejar el archivo abierto (en Windows un handle
+# abierto impide el os.replace de la compactación). Cada lector lo toma y lo suelta;
+# una versión reemplazada se cierra cuando la suelta su último lector.
+@st.cache_resource(show_spinner=False)
+def _instantaneas_state():
+    return {"lock": threading.Lock(), "key": None, "abiertas": {}}  # key → {"wb", "usos"}
+
+def _leer_estable(path: Path):
+    """(bytes, _file_key) de una misma versión: se guarda con os.replace, basta releer la identidad."""
+    key = _file_key(path)
+    for _ in range(10):
+        data = path.read_bytes()
+        nueva = _file_key(path)
+        if nueva == key: break
+        key = nueva
+    return data, key
+
+def _instantanea_tomar():
+    """(wb, key) de la versión actual del Excel; devolver con _instantanea_soltar(key)."""
+    ist = _instantaneas_state()
+    with ist["lock"]:
+        key = _file_key(EXCEL_PATH)
+        a = ist["abiertas"].get(key) if key is not None else None
+        metrica_cache("instantanea", a is not None)
+        if a is None:
+            data, key = _leer_estable(EXCEL_PATH)
+            a = ist["abiertas"].get(key)
+            if a is None:
+                wb = safe_load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+                wb._file_key = key  # identidad para el índice CODIGO → fila
+                wb._datos = data    # la escritura incremental copia sus partes
+                a = ist["abiertas"][key] = {"wb": wb, "usos": 0}
+        a["usos"] += 1
+        if ist["key"] != key:
+            ist["key"] = key; _instantaneas_cerrar(ist)
+        return a["wb"], key
+
+def _instantanea_soltar(key):
+    ist = _instantaneas_state()
+    with ist["lock"]:
+        a = ist["abiertas"].get(key)
+        if a is None: return
+        a["usos"] -= 1
+        _instantaneas_cerrar(ist)
+
+def _instantaneas_cerrar(ist):
+    for k in [k for k, a in ist["abiertas"].items() if k != ist["key"] and a["usos"] <= 0]:
+        try: ist["abiertas"].pop(k)["wb"].close()
+        except Exception: pass
+
+# ===== ESCRITURA INCREMENTAL DEL .XLSX =====
+# La compactación no carga el libro en modo escritura ni lo re-serializa entero: parte
+# de los bytes de la instantánea compartida y reescribe solo las hojas con eventos
+# (filas nuevas al final; en las filas con upsert se cambian solo esas celdas, el resto
+# del XML queda igual) y docProps/custom.xml (JOURNAL_SEQ). Las demás partes del .zip se
+# copian comprimidas, byte a byte. Las celdas se escriben como lo hace openpyxl
+# (inlineStr, t="n", t="b", fórmulas "="), así que se leen igual que tras un guardado
+# completo. Si algo no encaja (hoja sin r="", libro sin JOURNAL_SEQ, zip con descriptores
+# de datos, carácter ilegal...) se vuelve a la carga completa con openpyxl.
+_XML_CELDA = re.compile(rb"<c\b[^>]*?(?:/>|>.*?</c>)", re.S)
+_XML_REF = re.compile(rb'\br="([A-Z]+)(\d+)"')
+_XML_DIM = re.compile(rb'<dimension ref="([A-Z]+)(\d+)(?::([A-Z]+)(\d+))?"\s*/>')
+_XML_SEQ = re.compile(rb'(<property\b[^>]*\bname="JOURNAL_SEQ"[^>]*>\s*<vt:lpwstr>)[^<]*(</vt:lpwstr>)')
+
+class _LibroIncremental:
+    """Se guarda como un Workbook: copia el .xlsx base (`datos`) cambiando solo `partes`."""
+    def __init__(self, datos: bytes, partes: dict): self.datos, self.partes = datos, partes
+    def save(self, path):
+        src = zipfile.ZipFile(io.BytesIO(self.datos))
+        with open(path, "wb") as f, zipfile.ZipFile(f, "w", zipfile.ZIP_DEFLATED) as out:
+            for zi in src.infolist():
+                if zi.filename in self.partes:
+                    nuevo = zipfile.ZipInfo(zi.filename, date_time=zi.date_time)
+                    nuevo.external_attr = zi.external_attr
+                    out.writestr(nuevo, self.partes[zi.filename], compress_type=zipfile.ZIP_DEFLATED)
+                    continue
+                # Cabecera local + datos comprimidos tal cual; ZipFile solo escribe el directorio.
+                off = zi.header_offset
+                n = 30 + int.from_bytes(self.datos[off+26:off+28], "little") \
+                       + int.from_bytes(self.datos[off+28:off+30], "little") + zi.compress_size
+                zi.header_offset = f.tell(); f.write(self.datos[off:off+n])
+                out.filelist.append(zi); out.NameToInfo[zi.filename] = zi
+                out.start_dir = f.tell()
+    def close(self): pass
+
+def _xlsx_hojas(z) -> dict:
+    """Nombre de hoja → parte XML (xl/worksheets/sheetN.xml), según workbook.xml y sus relaciones."""
+    local = lambda e: e.tag.rsplit("}", 1)[-1]
+    rels = {r.get("Id"): r.get("Target") for r in ET.fromstring(z.read("xl/_rels/workbook.xml.rels"))}
+    hojas = {}
+    for sh in ET.fromstring(z.read("xl/workbook.xml")).iter():
+        if local(sh) != "sheet": continue
+        destino = rels[next(v for k, v in sh.attrib.items() if k.endswith("}id"))]
+        hojas[sh.get("name")] = destino.lstrip("/") if destino.startswith("/") else "xl/" + destino
+    return hojas
+
+def _xml_celda(ref: str, v, estilo: bytes = b"") -> bytes:
+    """Celda `ref` con el valor `v` como la escribe openpyxl (`estilo`: atributo s="" original)."""
+    if v is None: return b'<c r="%s"%s/>' % (ref.encode(), estilo) if estilo else b""
+    a = b'<c r="%s"%s' % (ref.encode(), estilo)
+    if isinstance(v, bool): return a + b' t="b"><v>%d</v></c>' % v
+    if isinstance(v, (int, float)): return a + b' t="n"><v>%s</v></c>' % str(v).encode()
+    v = str(v)[:32767]
+    if ILLEGAL_CHARACTERS_RE.search(v): raise ValueError(f"{v!r} no se puede escribir en una hoja")
+    if len(v) > 1 and v.startswith("="): return a + b"><f>%s</f><v/></c>" % xml_escape(v[1:]).encode()
+    if not v: return a + b' t="inlineStr"/>'
+    esp = b' xml:space="preserve"' if v != v.strip() else b""
+    return a + b' t="inlineStr"><is><t%s>%s</t></is></c>' % (esp, xml_escape(v).encode())
+
+def _xml_texto(celda: bytes, compartidas) -> str:
+    """Texto de una celda del XML (para confirmar el CODIGO de una fila)."""
+    tipo = re.search(rb'\bt="([^"]*)"', celda[:celda.find(b">")])
+    tipo = tipo.group(1) if tipo else b"n"
+    if tipo == b"inlineStr": txt = b"".join(re.findall(rb"<t\b[^>]*>(.*?)</t>", celda, re.S))
+    else:
+        m = re.search(rb"<v>(.*?)</v>", celda, re.S); txt = m.group(1) if m else b""
+        if tipo == b"s" and txt: return str(compartidas[int(txt)])
+    return xml_unescape(txt.decode(), {"&quot;": '"', "&apos;": "'"})
+
+def _xml_celdas(fila: bytes) -> dict:
+    """Columna (0 = A) → XML de cada celda de una fila; todas deben traer r="" (si no, ValueError)."""
+    celdas = {}
+    for m in _XML_CELDA.finditer(fila):
+        ref = _XML_REF.search(m.group(0), 0, m.group(0).find(b">"))
+        if not ref: raise ValueError("celda sin referencia")
+        celdas[column_index_from_string(ref.group(1).decode()) - 1] = m.group(0)
+    return celdas
+
+def _xml_fila(fila: bytes, r: int, celdas: dict, cambios: dict) -> bytes:
+    """`fila` (<row ...>...</row> o <row .../>) con las celdas `cambios` (columna → valor) reemplazadas."""
+    cab = fila[:fila.find(b">") + 1]
+    if cab.endswith(b"/>"): cab = cab[:-2].rstrip() + b">"
+    for ci, v in cambios.items():
+        estilo = re.search(rb'\ss="\d+"', celdas[ci][:celdas[ci].find(b">")]) if ci in celdas else None
+        celdas[ci] = _xml_celda(f"{get_column_letter(ci+1)}{r}", v, estilo.group(0) if estilo else b"")
+    return cab + b"".join(celdas[ci] for ci in sorted(celdas)) + b"</row>"
+
+def _xml_hoja(xml: bytes, hmap: dict, idx: dict, evs: list, compartidas) -> bytes:
+    """
+    Aplica `evs` (append / upsert por CODIGO, como _apply_event) al XML de una hoja.
+    `idx` (CODIGO → fila) se mantiene al día igual que en la compactación completa.
+    """
+    ci_cod = find_col(hmap, "CODIGO"); width = max(hmap.values()) + 1
+    i = xml.rfind(b"<row "); ultima = 0
+    if i >= 0:
+        ref = re.search(rb'\br="(\d+)"', xml[i:xml.find(b">", i)])
+        if not ref: raise ValueError("filas sin número")
+        ultima = int(ref.group(1))
+    parches, nuevas, esperado = {}, {}, {}
+    for ev in evs:
+        if ev["op"] == "append":
+            ultima += 1; nuevas[ultima] = dict(enumerate(ev["values"]))
+            cod = str(nuevas[ultima].get(ci_cod) or "").strip().upper() if ci_cod is not None else ""
+            if cod: idx.setdefault(cod, ultima)
+            continue
+        fields = {find_col(hmap, _norm_text(h)): v for h, v in ev["fields"].items()}
+        fields.pop(None, None)
+        r = idx.get(ev["codigo"])
+        if r is None:
+            row = [""] * width; row[ci_cod] = ev["codigo"]
+            for ci, v in fields.items(): row[ci] = v
+            ultima += 1; nuevas[ultima] = dict(enumerate(row)); idx[ev["codigo"]] = ultima
+        elif r in nuevas: nuevas[r].update(fields)
+        else: parches.setdefault(r, {}).update(fields); esperado[r] = ev["codigo"]
+    out, pos = [], 0
+    for r in sorted(parches):
+        m = re.compile(rb'<row\b[^>]*?\br="%d"' % r).search(xml, pos)
+        if not m: raise ValueError(f"no se encontró la fila {r}")
+        fin = xml.find(b">", m.end()) + 1
+        if xml[fin-2:fin] != b"/>": fin = xml.index(b"</row>", fin) + 6
+        fila = xml[m.start():fin]; celdas = _xml_celdas(fila)
+        if ci_cod not in celdas or _xml_texto(celdas[ci_cod], compartidas).strip().upper() != esperado[r]:
+            raise ValueError(f"la fila {r} ya no es {esperado[r]}")  # hoja re-ordenada: carga completa
+        out += [xml[pos:m.start()], _xml_fila(fila, r, celdas, parches[r])]; pos = fin
+    out.append(xml[pos:]); xml = b"".join(out)
+    if nuevas:
+        filas = b"".join(b'<row r="%d">' % r + b"".join(_xml_celda(f"{get_column_letter(ci+1)}{r}", v)
+                                                         for ci, v in sorted(c.items())) + b"</row>"
+                         for r, c in nuevas.items())
+        if b"</sheetData>" in xml:
+            i = xml.rindex(b"</sheetData>"); xml = xml[:i] + filas + xml[i:]
+        else: xml = re.sub(rb"<sheetData\s*/>", lambda _: b"<sheetData>" + filas + b"</sheetData>", xml, count=1)
+    # openpyxl en solo lectura recorre hasta donde dice <dimension>: debe cubrir lo nuevo.
+    dim = _XML_DIM.search(xml)
+    if dim and (nuevas or parches):
+        col = max([column_index_from_string((dim.group(3) or dim.group(1)).decode())] +
+                  [max(c, default=0) + 1 for c in (*nuevas.values(), *parches.values())])
+        fila = max(int(dim.group(4) or dim.group(2)), ultima)
+        ref = b'<dimension ref="%s%s:%s%d"/>' % (dim.group(1), dim.group(2), get_column_letter(col).encode(), fila)
+        xml = xml[:dim.start()] + ref + xml[dim.end():]
+    return xml
+
+def _libro_incremental(base_key, evs, last):
+    """
+    (_LibroIncremental, {hoja: CODIGO → fila}, done) con `evs` aplicados sobre la versión
+    `base_key` del Excel; None si no se puede (se usa la carga completa con openpyxl).
+    """
+    try: wb, key = _instantanea_tomar()
+    except Exception: return None  # bloqueado o sin archivo: la carga completa decide
+    try:
+        esquema = _esquema(key)
+        if key != base_key or esquema is None: return None
+        z = zipfile.ZipFile(io.BytesIO(wb._datos))
+        if any(zi.flag_bits & 0x08 for zi in z.infolist()): return None
+        custom = z.read("docProps/custom.xml") if "docProps/custom.xml" in z.namelist() else b""
+        if not _XML_SEQ.search(custom): return None  # el primer guardado completo agrega JOURNAL_SEQ
+        done = _wb_journal_seq(wb); hojas = _xlsx_hojas(z); por_hoja = {}
+        for ev in evs:
+            if ev["seq"] > done: por_hoja.setdefault(ev["sheet"], []).append(ev)
+        partes = {"docProps/custom.xml": _XML_SEQ.sub(lambda m: m.group(1) + str(last).encode() + m.group(2), custom, count=1)}
+        rows = {}
+        for hoja, hevs in por_hoja.items():
+            if hoja not in hojas or not esquema["hmaps"].get(hoja): return None
+            rows[hoja] = dict(code_rows(wb, hoja))
+            partes[hojas[hoja]] = _xml_hoja(z.read(hojas[hoja]), esquema["hmaps"][hoja], rows[hoja], hevs,
+                                            getattr(wb, "shared_strings", []))
+        return _LibroIncremental(wb._datos, partes), rows, done
+    except Exception:
+        return None
+    finally: _instantanea_soltar(key)
+
+# ===== JOURNAL APPEND-ONLY =====
+# Los registros se escriben como eventos en JOURNAL_PATH (una línea, fsync): O(1).
+# El .xlsx es una vista compactada que se reconstruye en segundo plano
+# (COMPACT_DELAY s después del último evento) y antes de cada descarga del Excel.
+# Eventos: {"seq", "op": "append", "sheet", "values"}
+#          {"seq", "op": "upsert", "sheet", "codigo", "fields": {encabezado: valor}}
+# El Excel guarda el último seq aplicado (propiedad JOURNAL_SEQ) para que la
+# compactación sea idempotente si se corta entre el guardado y el truncado.
+@st.cache_resource(show_spinner=False)
+def _journal_state():
+    return {"tlock": threading.Lock(), "seq": 0, "timer": None, "cache_key": None,
+            "cache": [], "observers": {}}
+
+def _wb_journal_seq(wb) -> int:
+    try: return int(wb.custom_doc_props["JOURNAL_SEQ"].value)
+    except: return 0
+
+def _set_wb_journal_seq(wb, seq: int):
+    props = wb.custom_doc_props
+    if "JOURNAL_SEQ" in props.names: props["JOURNAL_SEQ"].value = str(seq)
+    else: props.append(StringProperty(name="JOURNAL_SEQ", value=str(seq)))
+
+def _journal_last_seq() -> int:
+    """seq de la última línea del journal (lee solo la cola del archivo)."""
+    try:
+        with open(JOURNAL_PATH, "rb") as f:
+            f.seek(0, os.SEEK_END); size = f.tell()
+            f.seek(max(0, size - 8192)); tail = f.read().splitlines()
+    except OSError: return 0
+    for line in reversed(tail):
+        try: return int(json.loads(line)["seq"])
+        except (ValueError, KeyError, TypeError): continue
+    return 0
+
+def journal_write(events: list):
+    """
+    Agrega eventos al journal de forma durable (una sola escritura + fsync).
+    Bajo el candado "journal": el seq crece en el orden del archivo aunque
+    escriban varios procesos.
+    """
+    js = _journal_state()
+    with file_lock("journal"):
+        js["seq"] = max(js["seq"], _journal_last_seq())
+        lines = []
+        for ev in events:
+            js["seq"] = max(js["seq"] + 1, time.time_ns())
+            lines.append(json.dumps({"seq": js["seq"], **ev}, ensure_ascii=False, default=str))
+        with open(JOURNAL_PATH, "a", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+            f.flush(); os.fsync(f.fileno())
+    # Los eventos ya son durables: si no se puede programar la compactación, la
+    # dispara la próxima escritura o exportación (no se informa como fallo).
+    try: schedule_compaction()
+    except Exception: pass
+
+def journal_events(min_seq: int = 0) -> list:
+    """Eventos del journal con seq > min_seq (parseo cacheado por tamaño/mtime)."""
+    js = _journal_state()
+    try: stt = os.stat(JOURNAL_PATH); key = (stt.st_size, stt.st_mtime_ns)
+    except OSError: return []
+    metrica_cache("journal", js["cache_key"] == key)
+    if js["cache_key"] != key:
+        evs = []
+        with open(JOURNAL_PATH, encoding="utf-8") as f:
+            for line in f:
+                try: evs.append(json.loads(line))
+                except ValueError: pass  # línea incompleta (corte a mitad de escritura)
+        js["cache"], js["cache_key"] = evs, key
+    return [e for e in js["cache"] if e.get("seq", 0) > min_seq]
+
+def _apply_event(wb, ev, rows: dict, hmaps: dict = None):
+    """
+    Aplica un evento a `wb` (modo escritura); `rows` = {hoja: CODIGO → fila}, se mantiene al día.
+    `hmaps` guarda los encabezados por hoja durante una compactación (header_map recorre la hoja).
+    """
+    hoja = ev["sheet"]; ws = wb[hoja]
+    if hmaps is None: hmaps = {}
+    if hoja not in hmaps: hmaps[hoja] = header_map(ws)
+    hmap = hmaps[hoja]; ci_cod = find_col(hmap, "CODIGO")
+    if hoja not in rows: rows[hoja] = dict(code_rows(wb, hoja))
+    idx = rows[hoja]
+    cod_de = lambda r: str(ws.cell(r, ci_cod+1).value or "").strip().upper()
+    # Fila recién agregada: _current_row (ws.max_row recorre todas las celdas en cada
+    # llamada y vuelve cuadrática una compactación con miles de filas).
+    if ev["op"] == "append":
+        ws.append(ev["values"])
+        cod = cod_de(ws._current_row) if ci_cod is not None else ""
+        if cod: idx.setdefault(cod, ws._current_row)
+        return
+    fields = {find_col(hmap, _norm_text(h)): v for h, v in ev["fields"].items()}
+    fields.pop(None, None)
+    r = idx.get(ev["codigo"])
+    if r is not None and cod_de(r) != ev["codigo"]:
+        # La hoja cambió debajo del índice (re-ordenada): se reconstruye.
+        idx = rows[hoja] = _build_code_rows(ws); r = idx.get(ev["codigo"])
+    if r is not None:
+        for ci, v in fields.items(): ws.cell(r, ci+1).value = v
+        return
+    row = [""] * (max(hmap.values()) + 1)
+    row[ci_cod] = ev["codigo"]
+    for ci, v in fields.items(): row[ci] = v
+    ws.append(row)
+    idx[ev["codigo"]] = ws._current_row
+
+def compact_journal() -> bool:
+    """Aplica los eventos pendientes al Excel (una carga + un guardado) y trunca el journal."""
+    js = _journal_state()
+    with file_lock("excel"):
+        evs = journal_events()
+        if not evs: return True
+        metrica_contar("compactaciones"); metrica_contar("eventos_compactados", len(evs))
+        _ensure_workbook(EXCEL_PATH)
+        base = _excel_base()
+        base_key = _file_key(EXCEL_PATH)
+        last = max(e["seq"] for e in evs)
+        # Solo las hojas con eventos se reescriben (ESCRITURA INCREMENTAL); si no se puede,
+        # una carga completa en modo escritura.
+        inc = _libro_incremental(base_key, evs, last)
+        metrica_cache("xlsx_incremental", inc is not None)
+        if inc is not None:
+            wb, rows, done = inc; wb._file_key = base_key
+            esquema = _esquema(base_key)
         else:
-            ws=wb[name]
-            if _sync_headers(ws, headers): changed=True
-    if changed: safe_save_workbook(wb, path)
+            try: wb = safe_load_workbook(EXCEL_PATH, tries=3)
+            except PermissionError:
+                schedule_compaction(); return False
+            wb._file_key = base_key if _file_key(EXCEL_PATH) == base_key else None
+            esquema = _esquema(wb._file_key)
+            done = _wb_journal_seq(wb); rows = {}; hmaps = dict(esquema["hmaps"]) if esquema else {}
+            for ev in evs:
+                if ev["seq"] > done: _apply_event(wb, ev, rows, hmaps)
+            _set_wb_journal_seq(wb, last)
+        # Sin copia de respaldo: si el Excel está bloqueado los eventos siguen
+        # a salvo en el journal y se reintenta más tarde. La marca se escribe ANTES
+        # del reemplazo: ningún lector ve el archivo nuevo sin ella (_excel_base).
+        marca = _compact_mark()
+        try: safe_save_workbook(wb, EXCEL_PATH, tries=3, antes_de_reemplazar=lambda key:
+                                _write_compact_mark({"key": list(key or ()), "previa": list(base_key or ()),
+                                                     "base": list(base or ()), "seq": last}))
+        except Exception:
+            _write_compact_mark(marca)
+            schedule_compaction(); return False
+        _publish_code_rows(_file_key(EXCEL_PATH), rows, base_key=wb._file_key)
+        if esquema: _esquema_publicar(_file_key(EXCEL_PATH), esquema["hojas"])
+        try: _columnar_tras_compactar(wb._file_key, _file_key(EXCEL_PATH), [e for e in evs if e["seq"] > done])
+        except Exception: pass  # la capa columnar reparsea el libro en la próxima lectura
+        # Los índices en memoria leen sus eventos pendientes antes de truncar.
+        for fn in list(js["observers"].values()):
+            try: fn()
+            except Exception: pass
+        with file_lock("journal"):
+            js["cache_key"] = None
+            _historial_agregar(done, last, [e for e in evs if e["seq"] > done])
+            rest = journal_events(last)
+            tmp = JOURNAL_PATH.with_suffix(".tmp")
+            with open(tmp, "w", encoding="utf-8") as f:
+                for ev in rest: f.write(json.dumps(ev, ensure_ascii=False, default=str) + "\n")
+                f.flush(); os.fsync(f.fileno())
+            os.replace(tmp, JOURNAL_PATH)
+        return True
 
-def append_row(sheet: str, values: list) -> bool:
-    ensure_workbook(EXCEL_PATH)
+def _historial_agregar(desde, hasta, evs):
+    """Una línea por compactación: cubre los seq (desde, hasta] y lista [seq, hoja, CODIGO]."""
+    toc = [[e["seq"], h, c] for e in evs for h, c in _tocados_eventos([e])]
+    with open(HISTORIAL_PATH, "a", encoding="utf-8") as f:
+        f.write(json.dumps({"desde": desde, "hasta": hasta, "tocados": toc}, ensure_ascii=False) + "\n")
+
+def _historial_tocados(seq):
+    """{(hoja, CODIGO)} compactados después de `seq`; None si el historial empieza más tarde."""
+    try: lineas = [json.loads(l) for l in HISTORIAL_PATH.read_text(encoding="utf-8").splitlines() if l.strip()]
+    except (OSError, ValueError): lineas = []
+    if not lineas: return set() if seq >= int(_compact_mark().get("seq") or 0) else None
+    if seq < lineas[0]["desde"]: return None
+    return {(h, c) for d in lineas if d["hasta"] > seq for n, h, c in d["tocados"] if n > seq}
+
+def _compact_mark() -> dict:
+    try: return json.loads(COMPACT_MARK_PATH.read_text(encoding="utf-8"))
+    except (OSError, ValueError): return {}
+
+def _write_compact_mark(mark: dict):
+    tmp = COMPACT_MARK_PATH.with_suffix(".tmp")
+    tmp.write_text(json.dumps(mark), encoding="utf-8"); os.replace(tmp, COMPACT_MARK_PATH)
+
+def _excel_base():
+    """
+    Identidad de los datos "externos" del Excel: la del archivo, salvo que el archivo
+    sea el que dejó una compactación (mismo contenido + journal) o el que estaba
+    reemplazando (la marca se escribe justo antes): entonces se hereda la base
+    anterior. Cambia con una carga o una edición a mano, no al compactar.
+    """
+    key = _file_key(EXCEL_PATH); m = _compact_mark()
+    heredada = key is not None and list(key) in (m.get("key"), m.get("previa"))
+    return tuple(m.get("base") or ()) if heredada else key
+
+def schedule_compaction(delay: float = None):
+    """
+    Group commit: el primer evento pendiente abre una ventana de COMPACT_DELAY y todo
+    lo que llega mientras tanto se vuelca en el MISMO guardado. La ventana no se
+    reinicia con cada evento, así que en hora pico el Excel se guarda como mucho una
+    vez por ventana y tampoco se posterga indefinidamente.
+    """
+    js = _journal_state()
+    with js["tlock"]:
+        if js["timer"] is not None: return
+        t = threading.Timer(COMPACT_DELAY if delay is None else delay, _compactar_programada)
+        t.daemon = True; t.start()
+        js["timer"] = t
+
+def _compactar_programada():
+    # La ventana se cierra ANTES de compactar: lo que llegue durante el guardado abre otra.
+    js = _journal_state()
+    with js["tlock"]: js["timer"] = None
+    compact_journal()
+
+def load_snapshot():
+    """
+    Instantánea compartida del Excel + eventos pendientes del journal, fijados juntos.
+    El journal se lee ANTES que el Excel: si una compactación termina en medio,
+    el libro nuevo ya trae esos eventos y el filtro por JOURNAL_SEQ los descarta.
+    Devuelve (wb, key, pendientes): el wb es de todos, se suelta con _instantanea_soltar(key).
+    """
+    evs = journal_events()
+    wb, key = _instantanea_tomar()
+    done = _wb_journal_seq(wb)
+    return wb, key, [e for e in evs if e["seq"] > done]
+
+def _merge_fields(hmap, width, row, fields):
+    row = list(row) + [None] * (width - len(row))
+    for h, v in fields.items():
+        ci = find_col(hmap, _norm_text(h))
+        if ci is not None: row[ci] = v
+    return tuple(row)
+
+def iter_data_rows(wb, hoja, pend=None, hmap=None):
+    """Filas de datos (desde la fila 2) de `hoja` incluyendo los eventos aún no compactados (`pend`)."""
+    ws = wb[hoja] if hoja in wb.sheetnames else None
+    if pend is None: pend = journal_events(_wb_journal_seq(wb))
+    evs = [e for e in pend if e["sheet"] == hoja]
+    if ws is None:
+        return
+    if not evs:
+        yield from ws.iter_rows(min_row=2, values_only=True); return
+    hmap = hmap or header_map(ws); ci_cod = find_col(hmap, "CODIGO")
+    width = max(hmap.values()) + 1
+    ups = {}
+    for e in evs:
+        if e["op"] == "upsert": ups.setdefault(e["codigo"], {}).update(e["fields"])
+    merged = lambda row, fields: _merge_fields(hmap, width, row, fields)
+    for row in ws.iter_rows(min_row=2, values_only=True):
+        cod = str(row[ci_cod] or "").strip().upper() if row and ci_cod is not None else ""
+        yield merged(row, ups.pop(cod)) if cod in ups else row
+    for e in evs:
+        if e["op"] == "append":
+            yield tuple(e["values"])
+        elif e["codigo"] in ups:
+            row = [None] * width
+            if ci_cod is not None: row[ci_cod] = e["codigo"]
+            yield merged(row, ups.pop(e["codigo"]))
+
+# ===== ESCRITOR ÚNICO (cola de confirmaciones) =====
+# Todas las sesiones encolan sus eventos; un solo hilo escritor toma lo que llegó
+# junto, lo confirma en UNA escritura (journal: un write+fsync; SQLite: una
+# transacción) y avisa a cada sesión cuando su fila quedó confirmada.
+WRITE_TIMEOUT = float(os.environ.get("WRITE_TIMEOUT", "30"))  # segundos
+
+@st.cache_resource(show_spinner=False)
+def _writer():
+    w = {"queue": queue.Queue(), "thread": None}
+    def confirmar(backend, items):
+        metrica_contar("escritor_eventos", sum(len(it["events"]) for it in items), backend=backend.name)
+        antes = backend.last_seq()
+        try:
+            with medir("escritor_lote", backend=backend.name):
+                backend._commit_batch([it["events"] for it in items])
+        except Exception as e:
+            if backend.last_seq() != antes:
+                # Algo del lote ya quedó escrito (p. ej. el journal hizo fsync y falló lo
+                # de después): reintentarlo lo duplicaría. Se avisa a todas las sesiones.
+                for it in items: it["error"] = e
+            else:
+                # Nada se escribió: un lote fallido no arrastra a los demás, se reintenta uno por uno.
+                for it in items:
+                    try: backend._commit_batch([it["events"]])
+                    except Exception as e1: it["error"] = e1
+        for it in items: it["done"].set()
+    def run():
+        while True:
+            lote = [w["queue"].get()]
+            try:
+                while True:
+                    try: lote.append(w["queue"].get_nowait())
+                    except queue.Empty: break
+                for backend in {id(it["backend"]): it["backend"] for it in lote}.values():
+                    confirmar(backend, [it for it in lote if it["backend"] is backend])
+            except Exception as e:
+                # Es el único escritor: ningún error lo mata (si no, cada submit esperaría
+                # hasta WRITE_TIMEOUT). Lo que no alcanzó a confirmarse recibe el error.
+                for it in lote:
+                    if not it["done"].is_set(): it["error"] = e
+            finally:
+                for it in lote: it["done"].set()
+                for _ in lote: w["queue"].task_done()
+    w["thread"] = threading.Thread(target=run, name="expo-writer", daemon=True)
+    w["thread"].start()
+    atexit.register(_drenar_al_salir, w)
+    return w
+
+def _drenar_al_salir(w):
+    """Al cerrar el proceso: espera lo encolado y vuelca al Excel lo que quede pendiente."""
+    limite = time.time() + WRITE_TIMEOUT
+    while w["queue"].unfinished_tasks and time.time() < limite: time.sleep(0.05)
+    js = _journal_state()
+    with js["tlock"]:
+        if js["timer"] is not None: js["timer"].cancel(); js["timer"] = None
     try:
-        wb = safe_load_workbook(EXCEL_PATH)
-    except PermissionError:
-        st.error("🔒 Cierra el Excel o pausa OneDrive e intenta de nuevo.")
-        return False
+        if storage().pending(): storage().export_xlsx()
+    except Exception: pass
+
+def submit_write(backend, events: list):
+    """Encola eventos y espera a que el escritor los confirme (o relanza su error)."""
+    item = {"backend": backend, "events": events, "done": threading.Event(), "error": None}
+    _writer()["queue"].put(item)
+    if not item["done"].wait(WRITE_TIMEOUT):
+        raise TimeoutError("El escritor no confirmó el registro a tiempo.")
+    if item["error"] is not None: raise item["error"]
+
+# ===== CAPA COLUMNAR (pandas / Arrow) =====
+# Las vistas y cachés leen las hojas como DataFrames tipados (texto → "string",
+# PUNTAJE/EDAD → "Int64") en vez de recorrer iter_rows fila por fila. Con el
+# backend "excel" las hojas del .xlsx se guardan en Arrow (feather) bajo
+# COLUMNAR_DIR: un reinicio o una réplica nueva las lee en milisegundos sin volver
+# a parsear el Excel. Los eventos aún no compactados se aplican encima, con la
+# misma semántica que la compactación.
+# Particiones: las hojas de visitantes y los registros se parten por día de feria
+# (FECHA REGISTRO del CODIGO, "" si no tiene) y STAND de la fila. Cada partición es
+# un archivo COLUMNAR_DIR/partes/<hash del contenido>.arrow y cada versión del .xlsx
+# un manifiesto COLUMNAR_DIR/<hash del .xlsx>.json con las suyas: los días cerrados
+# no cambian y se comparten entre versiones (ni se reescriben ni se releen). Una
+# compactación propia aplica sus eventos solo a las particiones que toca (las de
+# hoy) en vez de reparsear el libro; una carga, una edición a mano o un evento que
+# cambia de partición filas existentes (STAND o FECHA REGISTRO de un código ya
+# registrado) sí reparsean. El .xlsx sigue teniendo toda la historia (se abre y se
+# corrige a mano); las particiones solo existen en la capa de lectura.
+COLUMNAS_ENTERAS = ("PUNTAJE", "EDAD")
+PARTICIONADAS = tuple(h for h in HEADERS if h != "PROVINCIA")  # el catálogo es una sola partición
+PARTICIONES_MAX_MOVIDAS = 50  # filas que cambian de STAND en un lote antes de volver a partir todo
+
+@st.cache_resource(show_spinner=False)
+def _columnar_state():
+    return {"lock": threading.Lock(), "key": None, "base": None, "vivo": None}
+
+def _nombres_columnas(headers) -> list:
+    """Encabezados normalizados y únicos (Arrow exige nombres distintos)."""
+    nombres = []
+    for i, h in enumerate(headers):
+        n = _norm_text(h) or f"COL{i+1}"; base, k = n, 2
+        while n in nombres: n, k = f"{base}_{k}", k + 1
+        nombres.append(n)
+    return nombres
+
+def _tipar(df):
+    for c in df.columns:
+        if c in COLUMNAS_ENTERAS:
+            n = pd.to_numeric(df[c], errors="coerce").astype("float64")
+            df[c] = np.trunc(n.where(n.abs() < 2**53)).astype("Int64")  # como int(): trunca
+        else: df[c] = df[c].astype("string")
+    return df
+
+def frame_de_filas(headers, rows) -> pd.DataFrame:
+    """DataFrame tipado de `rows` (tuplas en el orden de `headers`)."""
+    cols = _nombres_columnas(headers); w = len(cols)
+    datos = [tuple(r[:w]) + (None,) * (w - len(r)) for r in (tuple(r) for r in rows)]
+    return _tipar(pd.DataFrame.from_records(datos, columns=cols) if datos else pd.DataFrame(columns=cols, dtype=object))
+
+def frame_hmap(df) -> dict:
+    return {c: i for i, c in enumerate(df.columns)}
+
+def texto_col(df, *cands):
+    """Columna `cands` como texto sin espacios de borde ("" si falta o está vacía)."""
+    ci = find_col(frame_hmap(df), *cands)
+    if ci is None: return pd.Series("", index=df.index, dtype="string")
+    return df.iloc[:, ci].astype("string").fillna("").str.strip()
+
+def norm_text_col(s):
+    """_norm_text vectorizado."""
+    s = s.astype("string").fillna("").str.strip().str.upper()
+    s = s.str.translate(str.maketrans("ÁÉÍÓÚÜÑ", "AEIOUUN"))
+    return s.str.replace(r"\s+", " ", regex=True)
+
+def _por_codigo(frames, hojas, *cands) -> pd.Series:
+    """CODIGO → primer valor no vacío de la columna `cands` en `hojas`."""
+    partes = [pd.Series(texto_col(df, *cands).to_numpy(), index=texto_col(df, "CODIGO").str.upper().to_numpy())
+              for df in (frames.get(h) for h in hojas) if df is not None and find_col(frame_hmap(df), *cands) is not None]
+    if not partes: return pd.Series(dtype="string")
+    s = pd.concat(partes)
+    s = s[(s != "") & (s.index != "")]
+    return s[~s.index.duplicated()]
+
+def _valor_columna(dtype, v):
+    if str(dtype) == "Int64":
+        n = pd.to_numeric(pd.Series([v], dtype=object), errors="coerce").iloc[0]
+        return int(n) if pd.notna(n) and abs(n) < 2**53 else pd.NA
+    return pd.NA if v is None else str(v)
+
+def frame_con_eventos(df, evs) -> pd.DataFrame:
+    """Eventos pendientes de la hoja aplicados al frame (sin tocar el original)."""
+    if not evs: return df
+    hmap = frame_hmap(df); width = len(df.columns); ci_cod = find_col(hmap, "CODIGO")
+    ups = {}
+    for e in evs:
+        if e["op"] == "upsert": ups.setdefault(e["codigo"], {}).update(e["fields"])
+    df = df.copy()
+    if ups and ci_cod is not None and len(df):
+        cod = df.iloc[:, ci_cod].astype("string").fillna("").str.strip().str.upper()
+        for i, c in cod[cod.isin(list(ups))].drop_duplicates().items():
+            for h, v in ups.pop(c).items():
+                ci = find_col(hmap, _norm_text(h))
+                if ci is not None: df.iat[i, ci] = _valor_columna(df.dtypes.iloc[ci], v)
+    nuevas = []
+    for e in evs:
+        if e["op"] == "append": nuevas.append(tuple(e["values"]))
+        elif e["codigo"] in ups:
+            row = [None] * width
+            if ci_cod is not None: row[ci_cod] = e["codigo"]
+            nuevas.append(_merge_fields(hmap, width, row, ups.pop(e["codigo"])))
+    if not nuevas: return df
+    return pd.concat([df, frame_de_filas(list(df.columns), nuevas)], ignore_index=True)
+
+def _celda(values, ci) -> str:
+    return str(values[ci] if values[ci] is not None else "").strip().upper() if ci is not None and ci < len(values) else ""
+
+def _campo(fields, nombre):
+    """Valor de `nombre` en los campos de un upsert (None si no viene)."""
+    v = [v for h, v in fields.items() if _norm_text(h) == nombre]
+    return None if not v else str(v[-1] if v[-1] is not None else "").strip()
+
+def _dias_por_codigo(reg) -> dict:
+    """CODIGO → día (AAAA-MM-DD) de su primera FECHA REGISTRO no vacía."""
+    s = _por_codigo({} if reg is None else {"R": reg}, ("R",), "FECHA REGISTRO").str[:10]
+    return dict(zip(s.index, s.to_numpy(object)))
+
+def _aplicar_particion(df, ops, vacia):
+    """
+    `ops` = [(evento, posición de la fila nueva o None, ¿primera fila del código?)] en
+    orden, aplicados como _apply_event: un upsert va a la primera fila del CODIGO.
+    None si un código no está donde dice el índice.
+    """
+    hmap = frame_hmap(vacia); width = len(vacia.columns); ci_cod = find_col(hmap, "CODIGO")
+    nuevas, pos, nueva_de, ups = [], [], {}, {}
+    for e, p, primera in ops:
+        if e["op"] == "append":
+            nuevas.append(tuple(e["values"])); pos.append(p)
+            if primera: nueva_de[_celda(e["values"], ci_cod)] = len(nuevas) - 1
+        elif p is not None:
+            row = [None] * width
+            if ci_cod is not None: row[ci_cod] = e["codigo"]
+            nuevas.append(_merge_fields(hmap, width, row, e["fields"])); pos.append(p)
+            nueva_de[e["codigo"]] = len(nuevas) - 1
+        elif e["codigo"] in nueva_de:
+            i = nueva_de[e["codigo"]]; nuevas[i] = _merge_fields(hmap, width, nuevas[i], e["fields"])
+        else: ups.setdefault(e["codigo"], {}).update(e["fields"])
+    if ups:
+        if ci_cod is None or df is None: return None
+        df = df.copy(); cod = texto_col(df, "CODIGO").str.upper().to_numpy(object)
+        for i in np.flatnonzero(np.isin(cod, list(ups))):
+            for h, v in ups.pop(cod[i], {}).items():
+                ci = find_col(hmap, _norm_text(h))
+                if ci is not None: df.iat[i, ci] = _valor_columna(df.dtypes.iloc[ci], v)
+        if ups: return None
+    if not nuevas: return df
+    extra = frame_de_filas(list(vacia.columns), nuevas).set_axis(pd.Index(pos, dtype="int64"))
+    return extra if df is None or not len(df) else pd.concat([df, extra])
+
+class Particiones:
+    """
+    Hojas partidas en {(día, STAND): DataFrame}; el índice de cada partición es la
+    posición de la fila en la hoja. Versión inmutable: aplicar() devuelve otra que
+    comparte las particiones no tocadas.
+    """
+    def __init__(self, partes, vacias, n, seq, ids=None, dias=None, donde=None):
+        self.partes = partes    # {hoja: {(día, STAND): DataFrame}}
+        self.vacias = vacias    # {hoja: DataFrame sin filas (columnas y tipos)}
+        self.n = n              # {hoja: posición de la próxima fila}
+        self.seq = seq
+        self.ids = ids or {}    # (hoja, día, STAND) → hash de su archivo Arrow
+        self._hojas = {}
+        self.dias = _dias_por_codigo(self.hoja("REGISTRO DE CODIGOS") if "REGISTRO DE CODIGOS" in partes else None) \
+            if dias is None else dias
+        self.donde = self._indexar() if donde is None else donde  # {hoja: CODIGO → partición de su primera fila}
+
+    @classmethod
+    def desde_frames(cls, hojas: dict, seq):
+        """Parte las hojas completas (índice 0..n-1, en el orden del Excel)."""
+        reg = hojas.get("REGISTRO DE CODIGOS")
+        dias = _dias_por_codigo(reg); partes = {}
+        for h, df in hojas.items():
+            if h not in PARTICIONADAS or not len(df):
+                partes[h] = {("", ""): df} if len(df) else {}; continue
+            dia = np.array([dias.get(c, "") for c in texto_col(df, "CODIGO").str.upper()], dtype=object)
+            stand = texto_col(df, "STAND").str.upper().to_numpy(object)
+            partes[h] = {k: df.iloc[i] for k, i in df.groupby([dia, stand], sort=False).indices.items()}
+        return cls(partes, {h: df.iloc[:0] for h, df in hojas.items()}, {h: len(df) for h, df in hojas.items()},
+                   seq, dias=dias)
+
+    def _indexar(self) -> dict:
+        donde = {}
+        for h in PARTICIONADAS:
+            partes = list(self.partes.get(h, {}).items())
+            if not partes: donde[h] = {}; continue
+            pos = np.concatenate([df.index.to_numpy() for _, df in partes])
+            cod = np.concatenate([texto_col(df, "CODIGO").str.upper().to_numpy(object) for _, df in partes])
+            k = np.repeat(np.arange(len(partes)), [len(df) for _, df in partes])
+            orden = np.argsort(-pos, kind="stable")  # al armar el dict gana la primera fila
+            donde[h] = {c: partes[i][0] for c, i in zip(cod[orden], k[orden]) if c}
+        return donde
+
+    def hoja(self, h) -> pd.DataFrame:
+        """Hoja completa en el orden del Excel (se arma una vez por versión)."""
+        if h not in self._hojas:
+            partes = list(self.partes[h].values())
+            df = pd.concat(partes).sort_index() if len(partes) > 1 else partes[0] if partes else self.vacias[h]
+            self._hojas[h] = df.reset_index(drop=True)
+        return self._hojas[h]
+
+    def consultar(self, hojas, dias=None, stands=None) -> dict:
+        """
+        {hoja: DataFrame} armado solo con las particiones que pueden cumplir el filtro
+        (filas en el orden del Excel). dias = (desde, hasta) "AAAA-MM-DD" inclusivos,
+        None = sin límite; con días, las filas sin FECHA REGISTRO quedan fuera.
+        stands = STANDs en mayúsculas. Las hojas no particionadas van completas.
+        """
+        out = {}
+        for h in hojas:
+            if h not in self.partes: continue
+            if h not in PARTICIONADAS or (dias is None and stands is None): out[h] = self.hoja(h); continue
+            d0, d1 = dias or (None, None)
+            sel = [df for (d, s), df in self.partes[h].items()
+                   if (dias is None or (d and (not d0 or d >= d0) and (not d1 or d <= d1)))
+                   and (stands is None or s in stands)]
+            out[h] = (pd.concat(sel).sort_index() if sel else self.vacias[h]).reset_index(drop=True)
+        return out
+
+    def aplicar(self, evs):
+        """
+        Nueva versión con `evs` aplicados como los aplica la compactación al .xlsx,
+        tocando solo las particiones afectadas. Un upsert que cambia el STAND mueve
+        la fila a su partición nueva; None si cambia el día de un código ya
+        registrado o si se mueven demasiadas filas (sale más barato volver a partir
+        desde las hojas completas).
+        """
+        p = self
+        for _ in range(PARTICIONES_MAX_MOVIDAS + 1):
+            p, i = p._aplicar_tramo(evs)
+            if p is None or i is None: return p
+            p = p._mover(evs[i]); evs = evs[i + 1:]
+        return None
+
+    def _mover(self, e):
+        """Upsert `e` que cambia el STAND de la primera fila de su código (conserva su posición)."""
+        h, cod = e["sheet"], e["codigo"]
+        clave = self.donde[h][cod]; df = self.partes[h][clave]
+        i = int(np.flatnonzero(texto_col(df, "CODIGO").str.upper().to_numpy(object) == cod)[0])
+        fila = df.iloc[[i]].copy(); hmap = frame_hmap(fila)
+        for k, v in e["fields"].items():
+            ci = find_col(hmap, _norm_text(k))
+            if ci is not None: fila.iat[0, ci] = _valor_columna(fila.dtypes.iloc[ci], v)
+        nueva = (clave[0], _campo(e["fields"], "STAND").upper())
+        partes, ids = dict(self.partes), dict(self.ids); partes[h] = dict(partes[h])
+        if len(df) > 1: partes[h][clave] = df.drop(index=df.index[i])
+        else: del partes[h][clave]
+        destino = partes[h].get(nueva)
+        partes[h][nueva] = fila if destino is None else pd.concat([destino, fila]).sort_index()
+        ids.pop((h, *clave), None); ids.pop((h, *nueva), None)
+        donde = dict(self.donde); donde[h] = {**donde[h], cod: nueva}
+        return Particiones(partes, self.vacias, self.n, max(self.seq, e["seq"]), ids, self.dias, donde)
+
+    def _aplicar_tramo(self, evs):
+        """(versión con `evs` aplicados, None) o, si uno cambia un STAND, (versión con los anteriores, su índice)."""
+        if not evs: return self, None
+        dias, donde, n = dict(self.dias), dict(self.donde), dict(self.n)
+        ci = {h: (find_col(frame_hmap(v), "CODIGO"), find_col(frame_hmap(v), "STAND"), find_col(frame_hmap(v), "FECHA REGISTRO"))
+              for h, v in self.vacias.items()}
+        existe = lambda cod: any(cod in donde.get(h, ()) for h in PARTICIONADAS)
+        # El día sale de REGISTRO DE CODIGOS: se fija antes de ubicar las filas del lote
+        # (el registro agrega la fila del visitante antes de su FECHA REGISTRO).
+        for e in evs:
+            if e["sheet"] != "REGISTRO DE CODIGOS" or e["sheet"] not in ci: continue
+            ci_cod, _, ci_fec = ci[e["sheet"]]
+            if e["op"] == "append":
+                cod = _celda(e["values"], ci_cod); dia = _celda(e["values"], ci_fec)[:10]
+                if not dia or dias.get(cod): continue
+            else:
+                cod = e["codigo"]; dia = _campo(e["fields"], "FECHA REGISTRO")
+                if dia is None: continue
+                dia = dia[:10]
+            if dia == dias.get(cod, ""): continue
+            if existe(cod): return None, None
+            dias[cod] = dia
+        ops = {}
+        for j, e in enumerate(evs):
+            h = e["sheet"]
+            if h not in self.vacias: continue
+            if h not in PARTICIONADAS:
+                p = None
+                if e["op"] == "append": p = n[h]; n[h] += 1
+                ops.setdefault((h, ("", "")), []).append((e, p, False)); continue
+            ci_cod, ci_sta, _ = ci[h]
+            if donde.get(h) is self.donde.get(h): donde[h] = dict(donde.get(h, {}))
+            m = donde[h]
+            if e["op"] == "append":
+                cod = _celda(e["values"], ci_cod); clave = (dias.get(cod, ""), _celda(e["values"], ci_sta))
+                primera = bool(cod) and cod not in m
+                if primera: m[cod] = clave
+                p = n[h]; n[h] += 1
+            else:
+                cod = e["codigo"]; stand = _campo(e["fields"], "STAND"); clave = m.get(cod); primera, p = False, None
+                if clave is None:
+                    clave = m[cod] = (dias.get(cod, ""), (stand or "").upper()); p = n[h]; n[h] += 1
+                elif stand is not None and stand.upper() != clave[1]: return self._aplicar_tramo(evs[:j])[0], j
+            ops.setdefault((h, clave), []).append((e, p, primera))
+        partes, ids = dict(self.partes), dict(self.ids)
+        for (h, clave), lista in ops.items():
+            if partes[h] is self.partes[h]: partes[h] = dict(partes[h])
+            df = _aplicar_particion(partes[h].get(clave), lista, self.vacias[h])
+            if df is None: return None, None
+            partes[h][clave] = df; ids.pop((h, *clave), None)
+        return Particiones(partes, self.vacias, n, max([self.seq] + [e["seq"] for e in evs]), ids, dias, donde), None
+
+def _columnar_desde_xlsx(data: bytes) -> dict:
+    wb = safe_load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+    try:
+        hojas = {}
+        for hoja in wb.sheetnames:
+            filas = wb[hoja].iter_rows(values_only=True)
+            hojas[hoja] = frame_de_filas(next(filas, ()), filas)
+        return {"hojas": hojas, "seq": _wb_journal_seq(wb)}
+    finally: wb.close()
+
+def _parte_leer(pid: str) -> pd.DataFrame:
+    df = pd.read_feather(COLUMNAR_DIR / "partes" / f"{pid}.arrow", dtype_backend="numpy_nullable")
+    return df.set_index("_fila").rename_axis(None)
+
+def _columnar_leer(h: str, previa=None):
+    """Particiones de la versión `h`; las que ya están en memoria (`previa`) no se releen."""
+    try:
+        man = json.loads((COLUMNAR_DIR / f"{h}.json").read_text(encoding="utf-8"))
+        en_memoria = {pid: previa.partes[hoja][(d, s)] for (hoja, d, s), pid in previa.ids.items()} if previa else {}
+        partes, vacias, n, ids = {}, {}, {}, {}
+        for hoja, m in man["hojas"].items():
+            partes[hoja] = {}
+            for d, s, pid in m["partes"]:
+                df = en_memoria.get(pid)
+                partes[hoja][(d, s)] = _parte_leer(pid) if df is None else df; ids[(hoja, d, s)] = pid
+            vacias[hoja] = frame_de_filas(m["columnas"], ()); n[hoja] = m["n"]
+        return Particiones(partes, vacias, n, man["seq"], ids)
+    except Exception: return None
+
+def _columnar_guardar(h: str, base: Particiones):
+    """Escribe las particiones nuevas y el manifiesto de la versión `h` (temporal + os.replace)."""
+    d = COLUMNAR_DIR / "partes"
+    tmp = lambda p: p.with_name(f"{p.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        d.mkdir(parents=True, exist_ok=True)
+        man = {"seq": base.seq, "hojas": {}}
+        for hoja, partes in base.partes.items():
+            lista = []
+            for (dia, stand), df in partes.items():
+                pid = base.ids.get((hoja, dia, stand))
+                if pid is None:
+                    buf = io.BytesIO(); df.reset_index(names="_fila").to_feather(buf)
+                    pid = hashlib.blake2b(buf.getvalue(), digest_size=16).hexdigest()
+                    dest = d / f"{pid}.arrow"
+                    if not dest.exists(): tmp(dest).write_bytes(buf.getvalue()); os.replace(tmp(dest), dest)
+                    base.ids[(hoja, dia, stand)] = pid
+                lista.append([dia, stand, pid])
+            man["hojas"][hoja] = {"columnas": list(base.vacias[hoja].columns), "n": base.n[hoja], "partes": lista}
+        dest = COLUMNAR_DIR / f"{h}.json"
+        tmp(dest).write_text(json.dumps(man, ensure_ascii=False), encoding="utf-8"); os.replace(tmp(dest), dest)
+    except Exception: return  # sin pyarrow o sin permisos: solo se pierde la caché en disco
+    # Limpieza: se conserva también la generación anterior (el manifiesto más reciente
+    # después de este), que otra réplica puede estar leyendo todavía. Solo se borra lo
+    # que ninguna de las dos usa Y es más viejo que ella: lo que otro proceso está
+    # escribiendo ahora (partes antes que su manifiesto) es más nuevo y se respeta.
+    try:
+        previas = sorted((p for p in COLUMNAR_DIR.glob("*.json") if p.name != dest.name),
+                         key=lambda p: p.stat().st_mtime_ns, reverse=True)
+        previa = previas[0] if previas else dest
+        limite = previa.stat().st_mtime_ns
+        vivas = {f"{pid}.arrow" for pid in base.ids.values()}
+        if previa is not dest:
+            vivas |= {f"{pid}.arrow" for m in json.loads(previa.read_text(encoding="utf-8"))["hojas"].values()
+                      for *_, pid in m["partes"]}
+    except (OSError, ValueError, KeyError, TypeError): return  # otra réplica limpiando a la vez
+    def vieja(p):
+        try: return p.stat().st_mtime_ns < limite
+        except OSError: return False
+    for p in COLUMNAR_DIR.glob("*"):
+        if p.name not in (dest.name, previa.name, "partes") and vieja(p):
+            shutil.rmtree(p, ignore_errors=True) if p.is_dir() else p.unlink(missing_ok=True)
+    for p in d.glob("*.arrow"):
+        if p.name not in vivas and vieja(p): p.unlink(missing_ok=True)
+
+def columnar_base() -> Particiones:
+    """Particiones del .xlsx actual (frames de solo lectura), sin los eventos pendientes."""
+    cs = _columnar_state()
+    with cs["lock"]:
+        key = _file_key(EXCEL_PATH)
+        if key is None:
+            return Particiones.desde_frames({h: frame_de_filas(cols, ()) for h, cols in HEADERS.items()}, 0)
+        metrica_cache("columnar_memoria", key == cs["key"])
+        if key == cs["key"]: return cs["base"]
+        data, key = _leer_estable(EXCEL_PATH)
+        h = hashlib.blake2b(data, digest_size=16).hexdigest()
+        base = _columnar_leer(h, cs["base"])
+        metrica_cache("columnar_disco", base is not None)
+        if base is None:
+            with medir("columnar_parseo"):
+                leido = _columnar_desde_xlsx(data)
+                base = Particiones.desde_frames(leido["hojas"], leido["seq"])
+            _columnar_guardar(h, base)
+        cs.update(key=key, base=base, vivo=None)
+        return base
+
+def columnar_vivo(evs) -> Particiones:
+    """
+    Base + eventos pendientes del journal (`evs`, leídos ANTES que el Excel, como en
+    load_snapshot). Se guarda la última: el siguiente rerun solo aplica lo nuevo.
+    """
+    base = columnar_base(); cs = _columnar_state()
+    pend = [e for e in evs if e["seq"] > base.seq]
+    if not pend: return base
+    with cs["lock"]: v = cs["vivo"]
+    if v is not None and v[0] is base and v[1].seq <= pend[-1]["seq"]:
+        vivo = v[1].aplicar([e for e in pend if e["seq"] > v[1].seq])
+    else: vivo = base.aplicar(pend)
+    if vivo is None:  # filas que cambian de partición: se vuelve a partir desde las hojas completas
+        vivo = Particiones.desde_frames({h: frame_con_eventos(base.hoja(h), [e for e in pend if e["sheet"] == h])
+                                         for h in base.partes}, pend[-1]["seq"])
+    with cs["lock"]:
+        # Otra sesión pudo dejar una más nueva, o cambiar la base, mientras se aplicaba.
+        v = cs["vivo"]
+        if cs["base"] is base and (v is None or v[0] is not base or v[1].seq <= vivo.seq): cs["vivo"] = (base, vivo)
+    return vivo
+
+def _columnar_tras_compactar(previa_key, key, evs):
+    """
+    Compactación propia: la versión nueva del .xlsx es la anterior (`previa_key`) con
+    `evs`; se aplican solo a sus particiones y se guardan solo las que cambiaron.
+    """
+    cs = _columnar_state()
+    with cs["lock"]:
+        if previa_key is None or key is None or cs["key"] != previa_key: return
+        base = cs["base"].aplicar(evs)
+        metrica_cache("columnar_compactacion", base is not None)
+        if base is None: return
+        cs.update(key=key, base=base, vivo=None)
+    _columnar_guardar(hashlib.blake2b(EXCEL_PATH.read_bytes(), digest_size=16).hexdigest(), base)
+
+# ===== BACKENDS DE ALMACENAMIENTO =====
+# Interfaz común (ExcelBackend / SQLiteBackend):
+#   commit(eventos)         escribe en bloque eventos append/upsert (mismo formato del journal)
+#   append / upsert         atajos de un solo evento (upsert por CODIGO)
+#   snapshot()              lectura consistente: sheetnames, hmap, rows, get, find, seq
+#   frames(hojas)           las mismas hojas como DataFrames tipados + seq (capa columnar)
+#   particiones()           las hojas partidas por día × STAND (Particiones.consultar poda)
+#   events_since(seq)       eventos confirmados después de `seq` (índices incrementales)
+#   export_xlsx()           "FORMULARIO DATOS EXPO FERIA.xlsx" al día, con el formato de HEADERS
+#   replace_from_xlsx(data) reemplaza los datos con un Excel subido
+#   version()               versión "base": solo cambia con una carga o una edición externa
+#   last_seq(), horizon()   último seq confirmado / seq hasta el que el log ya se truncó
+#   tocados_desde(seq)      {(hoja, CODIGO)} cambiados después de `seq`; None sin historial
+#   pending()               cambios aún no volcados al Excel
+#   volcado(seq)            ¿el evento `seq` ya está en el almacenamiento definitivo?
+def _sheet_key_cols(hmap):
+    return (find_col(hmap,"CODIGO"), find_col(hmap,"CEDULA","RUC"), find_col(hmap,"TELEFONO"))
+
+class _SnapshotLookups:
+    """get/find por recorrido; los backends con índices los reemplazan."""
+    def get(self, hoja, codigo):
+        if hoja not in self.sheetnames: return None
+        ci = find_col(self.hmap(hoja), "CODIGO")
+        if ci is None: return None
+        for row in self.rows(hoja):
+            if row and ci < len(row) and str(row[ci] or "").strip().upper() == codigo: return row
+        return None
+
+    def find(self, hoja, campo, valor):
+        """campo: "cedula" | "telefono"; compara valores normalizados."""
+        if hoja not in self.sheetnames: return []
+        _, ci_ced, ci_tel = _sheet_key_cols(self.hmap(hoja))
+        ci, norm = (ci_ced, norm_id) if campo == "cedula" else (ci_tel, norm_phone)
+        if ci is None or not norm(valor): return []
+        return [r for r in self.rows(hoja) if r and ci < len(r) and r[ci] is not None
+                and norm(str(r[ci])) == norm(valor)]
+
+class ExcelSnapshot(_SnapshotLookups):
+    """Instantánea compartida (no se modifica) + los eventos pendientes de ESTA lectura."""
+    def __init__(self, wb, key, pend):
+        self.wb, self.key, self.pend = wb, key, pend
+        # close() la suelta; si alguien lo olvida, la suelta el recolector.
+        self._soltar = weakref.finalize(self, _instantanea_soltar, key)
+    @property
+    def sheetnames(self): return self.wb.sheetnames
+    @property
+    def seq(self): return max([_wb_journal_seq(self.wb)] + [e["seq"] for e in self.pend])
+    def hmap(self, hoja): return columnas(hoja, self.key) or header_map(self.wb[hoja])
+    def headers(self, hoja): return list(next(self.wb[hoja].iter_rows(min_row=1, max_row=1, values_only=True)))
+    def rows(self, hoja): return iter_data_rows(self.wb, hoja, self.pend, columnas(hoja, self.key))
+
+    def get(self, hoja, codigo):
+        """Fila por CODIGO: índice → lectura de esa sola fila + eventos pendientes de ese código."""
+        if hoja not in self.sheetnames: return None
+        hmap = self.hmap(hoja); ci = find_col(hmap, "CODIGO")
+        if ci is None: return None
+        row, r = None, code_rows(self.wb, hoja).get(codigo)
+        if r is not None:
+            row = next(self.wb[hoja].iter_rows(min_row=r, max_row=r, values_only=True), None)
+            if not row or ci >= len(row) or str(row[ci] or "").strip().upper() != codigo:
+                return super().get(hoja, codigo)  # índice desfasado: recorrido completo
+        width = max(hmap.values()) + 1
+        for e in self.pend:
+            if e["sheet"] != hoja: continue
+            if e["op"] == "append":
+                v = e["values"]
+                if row is None and ci < len(v) and str(v[ci] or "").strip().upper() == codigo: row = tuple(v)
+            elif e["codigo"] == codigo:
+                base = row or [None] * width
+                if row is None: base[ci] = codigo
+                row = _merge_fields(hmap, width, base, e["fields"])
+        return row
+
+    def close(self): self._soltar()
+
+class ExcelBackend:
+    name = "excel"
+    def __init__(self):
+        # Encabezados al día desde el arranque (p. ej. STAND en un Excel antiguo): las
+        # lecturas no cambian de forma cuando llega la primera compactación.
+        if EXCEL_PATH.exists(): ensure_workbook(EXCEL_PATH)
+    def snapshot(self): return ExcelSnapshot(*load_snapshot())
+    def particiones(self, hojas=None): return columnar_vivo(journal_events())  # journal antes que el Excel
+    def frames(self, hojas=None):
+        p = self.particiones()
+        return {h: p.hoja(h) for h in p.partes if hojas is None or h in hojas}, p.seq
+    def commit(self, events): submit_write(self, events)
+    def _commit_batch(self, lotes):
+        if not EXCEL_PATH.exists(): ensure_workbook(EXCEL_PATH)
+        journal_write([ev for evs in lotes for ev in evs])
+    def append(self, hoja, values): self.commit([{"op": "append", "sheet": hoja, "values": values}])
+    def upsert(self, hoja, codigo, fields): self.commit([{"op": "upsert", "sheet": hoja, "codigo": codigo, "fields": fields}])
+    def events_since(self, seq): return journal_events(seq)
+    def tocados_desde(self, seq):
+        hist = _historial_tocados(seq)
+        return None if hist is None else hist | _tocados_eventos(journal_events(seq))
+    def version(self): return (self.name, _excel_base())
+    def horizon(self): return int(_compact_mark().get("seq") or 0)
+    def last_seq(self): return max(_journal_last_seq(), self.horizon())
+    def pending(self): return len(journal_events())
+    def volcado(self, seq): return self.horizon() >= seq
+    def export_xlsx(self):
+        if not compact_journal(): return None
+        if not EXCEL_PATH.exists(): ensure_workbook(EXCEL_PATH)
+        return EXCEL_PATH
+    def replace_from_xlsx(self, data: bytes):
+        # Temporal + fsync + os.replace, como safe_save_workbook: ni un guardado
+        # concurrente ni un lector ven el Excel a medio escribir.
+        tmp = EXCEL_PATH.with_name(f".{EXCEL_PATH.name}.upload.tmp")
+        with file_lock("excel"):
+            with open(tmp, "wb") as f:
+                f.write(data); f.flush(); os.fsync(f.fileno())
+            os.replace(tmp, EXCEL_PATH)
+            _ensure_workbook(EXCEL_PATH)
+            reset_code_rows()
+
+# Último seq confirmado: el log se poda al exportar, así que puede quedar vacío.
+_SQL_ULTIMO_SEQ = ("SELECT MAX(COALESCE((SELECT MAX(seq) FROM eventos), 0), "
+                   "CAST(COALESCE((SELECT valor FROM meta WHERE clave='export_seq'), 0) AS INTEGER))")
+
+class SQLiteSnapshot(_SnapshotLookups):
+    """Transacción de lectura abierta: vista consistente aunque otros escriban (WAL)."""
+    def __init__(self, conn):
+        self.conn = conn; conn.execute("BEGIN")
+        self.heads = {h: json.loads(c) for h, c in conn.execute("SELECT hoja, columnas FROM encabezados ORDER BY orden")}
+        self.seq = conn.execute(_SQL_ULTIMO_SEQ).fetchone()[0]
+    @property
+    def sheetnames(self): return list(self.heads)
+    def hmap(self, hoja): return {_norm_text(v): i for i, v in enumerate(self.heads[hoja])}
+    def headers(self, hoja): return list(self.heads[hoja])
+    def rows(self, hoja):
+        for (datos,) in self.conn.execute("SELECT datos FROM filas WHERE hoja=? ORDER BY id", (hoja,)):
+            yield tuple(json.loads(datos))
+    def get(self, hoja, codigo):
+        r = self.conn.execute("SELECT datos FROM filas WHERE hoja=? AND codigo=? ORDER BY id LIMIT 1",
+                              (hoja, codigo)).fetchone()
+        return tuple(json.loads(r[0])) if r else None
+    def find(self, hoja, campo, valor):
+        col, norm = ("cedula", norm_id) if campo == "cedula" else ("telefono", norm_phone)
+        if not norm(valor): return []
+        return [tuple(json.loads(d)) for (d,) in self.conn.execute(
+            f"SELECT datos FROM filas WHERE {col}=? AND hoja=? ORDER BY id", (norm(valor), hoja))]
+    def close(self):
+        try: self.conn.rollback(); self.conn.close()
+        except: pass
+
+class SQLiteBackend:
+    """
+    SQLite embebido en modo WAL: una fila por registro (JSON en el orden de columnas
+    de la hoja) con índices por CODIGO, cédula y teléfono normalizados. Exporta el
+    mismo Excel que el backend "excel"; el log de eventos se poda en cada
+    exportación y de lo podado solo queda qué códigos tocó (tabla historial).
+    """
+    name = "sqlite"
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS encabezados(hoja TEXT PRIMARY KEY, orden INTEGER, columnas TEXT NOT NULL);
+    CREATE TABLE IF NOT EXISTS filas(id INTEGER PRIMARY KEY AUTOINCREMENT, hoja TEXT NOT NULL,
+        codigo TEXT, cedula TEXT, telefono TEXT, datos TEXT NOT NULL);
+    CREATE INDEX IF NOT EXISTS ix_filas_codigo ON filas(hoja, codigo);
+    CREATE INDEX IF NOT EXISTS ix_filas_cedula ON filas(cedula);
+    CREATE INDEX IF NOT EXISTS ix_filas_telefono ON filas(telefono);
+    CREATE TABLE IF NOT EXISTS eventos(seq INTEGER PRIMARY KEY AUTOINCREMENT, evento TEXT NOT NULL);
+    CREATE TABLE IF NOT EXISTS historial(seq INTEGER NOT NULL, hoja TEXT NOT NULL, codigo TEXT NOT NULL);
+    CREATE INDEX IF NOT EXISTS ix_historial_seq ON historial(seq);
+    CREATE TABLE IF NOT EXISTS meta(clave TEXT PRIMARY KEY, valor TEXT);
+    """
+
+    def __init__(self, path: Path):
+        self.path = path; self.lock = threading.Lock()
+        conn = self._connect()
+        conn.executescript(self.SCHEMA)
+        if not conn.execute("SELECT 1 FROM encabezados LIMIT 1").fetchone():
+            # Otro proceso puede estar arrancando a la vez: solo importa quien encuentre
+            # la base vacía DENTRO de la transacción (si no, borraría filas ya escritas).
+            if EXCEL_PATH.exists(): self._import(conn, EXCEL_PATH, solo_si_vacia=True)
+            else:
+                conn.execute("BEGIN IMMEDIATE")
+                if not conn.execute("SELECT 1 FROM encabezados LIMIT 1").fetchone():
+                    for i, (hoja, cols) in enumerate(HEADERS.items()):
+                        conn.execute("INSERT INTO encabezados VALUES (?,?,?)", (hoja, i, json.dumps(cols)))
+                conn.execute("COMMIT")
+        else: self._sync_encabezados(conn)
+        conn.close()
+
+    def _encabezados_faltantes(self, conn) -> dict:
+        """{hoja: columnas actuales + las de HEADERS que faltan} solo para las hojas desactualizadas."""
+        actuales = {h: json.loads(c) for h, c in conn.execute("SELECT hoja, columnas FROM encabezados")}
+        out = {}
+        for hoja, cols in HEADERS.items():
+            cur = actuales.get(hoja, []); norm = {_norm_text(c) for c in cur}
+            extra = [c for c in cols if _norm_text(c) not in norm]
+            if extra or hoja not in actuales: out[hoja] = cur + extra
+        return out
+
+    def _sync_encabezados(self, conn):
+        """Como _sync_headers: agrega al final las columnas nuevas de HEADERS (p. ej. FECHA REGISTRO)."""
+        if not self._encabezados_faltantes(conn): return
+        with self.lock:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                orden = conn.execute("SELECT COALESCE(MAX(orden), -1) + 1 FROM encabezados").fetchone()[0]
+                for i, (hoja, cols) in enumerate(self._encabezados_faltantes(conn).items()):
+                    conn.execute("INSERT INTO encabezados VALUES (?,?,?) ON CONFLICT(hoja) DO UPDATE SET columnas=excluded.columnas",
+                                 (hoja, orden + i, json.dumps(cols, ensure_ascii=False)))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK"); raise
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL"); conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _row_keys(self, hmap, values):
+        ci_cod, ci_ced, ci_tel = _sheet_key_cols(hmap)
+        get = lambda c: str(values[c] or "") if c is not None and c < len(values) and values[c] is not None else ""
+        return get(ci_cod).strip().upper(), norm_id(get(ci_ced)), norm_phone(get(ci_tel))
+
+    def _apply(self, conn, hmaps, ev):
+        hoja = ev["sheet"]
+        if hoja not in hmaps:
+            cols = json.loads(conn.execute("SELECT columnas FROM encabezados WHERE hoja=?", (hoja,)).fetchone()[0])
+            hmaps[hoja] = ({_norm_text(v): i for i, v in enumerate(cols)}, len(cols))
+        hmap, width = hmaps[hoja]
+        if ev["op"] == "append":
+            vals = list(ev["values"]) + [None] * (width - len(ev["values"]))
+        else:
+            r = conn.execute("SELECT id, datos FROM filas WHERE hoja=? AND codigo=? ORDER BY id LIMIT 1",
+                             (hoja, ev["codigo"])).fetchone()
+            vals = json.loads(r[1]) if r else [""] * width
+            vals += [""] * (width - len(vals))
+            ci_cod = find_col(hmap, "CODIGO")
+            if ci_cod is not None: vals[ci_cod] = ev["codigo"]
+            for h, v in ev["fields"].items():
+                ci = find_col(hmap, _norm_text(h))
+                if ci is not None: vals[ci] = v
+            if r:
+                conn.execute("UPDATE filas SET codigo=?, cedula=?, telefono=?, datos=? WHERE id=?",
+                             (*self._row_keys(hmap, vals), json.dumps(vals, ensure_ascii=False, default=str), r[0]))
+                return
+        conn.execute("INSERT INTO filas(hoja, codigo, cedula, telefono, datos) VALUES (?,?,?,?,?)",
+                     (hoja, *self._row_keys(hmap, vals), json.dumps(vals, ensure_ascii=False, default=str)))
+
+    def commit(self, events): submit_write(self, events)
+
+    def _commit_batch(self, lotes):
+        conn = self._connect()
+        try:
+            with self.lock:
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    hmaps = {}
+                    for ev in (ev for evs in lotes for ev in evs):
+                        conn.execute("INSERT INTO eventos(evento) VALUES (?)", (json.dumps(ev, ensure_ascii=False, default=str),))
+                        self._apply(conn, hmaps, ev)
+                    conn.execute("COMMIT")
+                except Exception:
+                    conn.execute("ROLLBACK"); raise
+        finally:
+            conn.close()
+
+    def append(self, hoja, values): self.commit([{"op": "append", "sheet": hoja, "values": values}])
+    def upsert(self, hoja, codigo, fields): self.commit([{"op": "upsert", "sheet": hoja, "codigo": codigo, "fields": fields}])
+    def snapshot(self): return SQLiteSnapshot(self._connect())
+    def frames(self, hojas=None):
+        snap = self.snapshot()
+        try:
+            return {h: frame_de_filas(snap.headers(h), snap.rows(h))
+                    for h in snap.sheetnames if hojas is None or h in hojas}, snap.seq
+        finally: snap.close()
+    def particiones(self, hojas=None):
+        # Sin caché columnar: las filas ya están indexadas en SQLite; se parten al vuelo.
+        return Particiones.desde_frames(*self.frames(None if hojas is None else {*hojas, "REGISTRO DE CODIGOS"}))
+
+    def events_since(self, seq):
+        conn = self._connect()
+        try:
+            return [{"seq": n, **json.loads(e)} for n, e in
+                    conn.execute("SELECT seq, evento FROM eventos WHERE seq>? ORDER BY seq", (seq,))]
+        finally: conn.close()
+
+    def _meta(self, conn, clave, default=None):
+        r = conn.execute("SELECT valor FROM meta WHERE clave=?", (clave,)).fetchone()
+        return r[0] if r else default
+
+    def version(self):
+        conn = self._connect()
+        try: return (self.name, self._meta(conn, "generacion", "0"))
+        finally: conn.close()
+
+    def horizon(self):
+        conn = self._connect()
+        try: return int(self._meta(conn, "export_seq", 0))
+        finally: conn.close()
+
+    def tocados_desde(self, seq):
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN")  # historial y log en la misma lectura: una poda no deja hueco
+            hist = set(conn.execute("SELECT hoja, codigo FROM historial WHERE seq>?", (seq,)))
+            evs = [{"seq": n, **json.loads(e)} for n, e in conn.execute("SELECT seq, evento FROM eventos WHERE seq>?", (seq,))]
+        finally: conn.close()
+        return hist | _tocados_eventos(evs)
+    def volcado(self, seq): return True  # la transacción ya es el almacenamiento; el .xlsx es una exportación
+
+    def last_seq(self):
+        conn = self._connect()
+        try: return conn.execute(_SQL_ULTIMO_SEQ).fetchone()[0]
+        finally: conn.close()
+
+    def pending(self):
+        conn = self._connect()
+        try: return conn.execute("SELECT COUNT(*) FROM eventos WHERE seq>?", (int(self._meta(conn, "export_seq", 0)),)).fetchone()[0]
+        finally: conn.close()
+
+    def export_xlsx(self):
+        # Botón, cierre del proceso y sincronización pueden exportar a la vez: bajo el
+        # candado, y la instantánea dentro para que export_seq nunca retroceda.
+        with file_lock("excel"):
+            snap = self.snapshot()
+            try:
+                wb = Workbook(write_only=True)
+                for hoja in snap.sheetnames:
+                    ws = wb.create_sheet(hoja); ws.append(snap.headers(hoja))
+                    for row in snap.rows(hoja): ws.append(list(row))
+                seq = snap.seq
+                _set_wb_journal_seq(wb, seq)  # la copia descargada sabe hasta qué evento incluye
+            finally: snap.close()
+            try: safe_save_workbook(wb, EXCEL_PATH)
+            except PermissionError: return None
+            self._podar(seq)
+        return EXCEL_PATH
+
+    def _podar(self, seq):
+        """Lo exportado ya está en el .xlsx: fija export_seq y poda el log hasta ahí (horizon)."""
+        conn = self._connect()
+        try:
+            with self.lock:
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    conn.execute("INSERT OR REPLACE INTO meta VALUES ('export_seq', ?)", (str(seq),))
+                    # Como HISTORIAL_PATH: qué códigos tocó lo podado, para combinar_xlsx.
+                    evs = [{"seq": n, **json.loads(e)} for n, e in conn.execute("SELECT seq, evento FROM eventos WHERE seq<=?", (seq,))]
+                    conn.executemany("INSERT INTO historial VALUES (?,?,?)",
+                                     [(e["seq"], h, c) for e in evs for h, c in _tocados_eventos([e])])
+                    conn.execute("DELETE FROM eventos WHERE seq<=?", (seq,))
+                    conn.execute("COMMIT")
+                except Exception:
+                    conn.execute("ROLLBACK"); raise
+        finally: conn.close()
+
+    def _import(self, conn, path, solo_si_vacia=False):
+        wb = safe_load_workbook(path, read_only=True, data_only=True)
+        try:
+            with self.lock:
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    if solo_si_vacia and conn.execute("SELECT 1 FROM encabezados LIMIT 1").fetchone():
+                        conn.execute("ROLLBACK"); return
+                    conn.execute("DELETE FROM filas"); conn.execute("DELETE FROM encabezados")
+                    conn.execute("INSERT OR REPLACE INTO meta VALUES ('generacion', "
+                                 "CAST(COALESCE((SELECT valor FROM meta WHERE clave='generacion'), 0) + 1 AS TEXT))")
+                    hojas = list(HEADERS) + [h for h in wb.sheetnames if h not in HEADERS]
+                    for i, hoja in enumerate(hojas):
+                        cols = ([str(h).strip() if h is not None else "" for h in
+                                 next(wb[hoja].iter_rows(min_row=1, max_row=1, values_only=True), ())]
+                                if hoja in wb.sheetnames else [])
+                        while cols and not cols[-1]: cols.pop()
+                        norm = [_norm_text(c) for c in cols]
+                        for h in HEADERS.get(hoja, []):
+                            if _norm_text(h) not in norm: cols.append(h); norm.append(_norm_text(h))
+                        conn.execute("INSERT INTO encabezados VALUES (?,?,?)", (hoja, i, json.dumps(cols, ensure_ascii=False)))
+                        if hoja not in wb.sheetnames: continue
+                        hmap = {c: j for j, c in enumerate(norm)}
+                        for row in wb[hoja].iter_rows(min_row=2, values_only=True):
+                            if not row or all(v is None or str(v).strip() == "" for v in row): continue
+                            vals = list(row)[:len(cols)]; vals += [None] * (len(cols) - len(vals))
+                            conn.execute("INSERT INTO filas(hoja, codigo, cedula, telefono, datos) VALUES (?,?,?,?,?)",
+                                         (hoja, *self._row_keys(hmap, vals), json.dumps(vals, ensure_ascii=False, default=str)))
+                    conn.execute("COMMIT")
+                except Exception:
+                    conn.execute("ROLLBACK"); raise
+        finally:
+            wb.close()
+
+    def replace_from_xlsx(self, data: bytes):
+        fd, tmp = tempfile.mkstemp(dir=self.path.parent, prefix=f".{self.path.stem}.", suffix=".upload.xlsx")
+        with os.fdopen(fd, "wb") as f: f.write(data)
+        conn = self._connect()
+        try: self._import(conn, tmp)
+        finally:
+            conn.close()
+            try: os.remove(tmp)
+            except OSError: pass
+
+@st.cache_resource(show_spinner=False)
+def _storage(kind: str):
+    if kind == "sqlite": return SQLiteBackend(SQLITE_PATH)
+    return ExcelBackend()
+
+def storage():
+    """Backend activo según STORAGE_BACKEND (compartido por todas las sesiones)."""
+    return _storage(STORAGE_BACKEND)
+
+def excel_para_descargar() -> bytes:
+    """
+    El .xlsx con todo lo confirmado: compacta el journal (o exporta SQLite) antes de
+    leerlo, para que la descarga nunca quede atrás de lo registrado.
+    """
+    ruta = storage().export_xlsx()
+    if ruta is None: raise PermissionError("No se pudo actualizar el Excel (bloqueado). Intenta de nuevo.")
+    return ruta.read_bytes()
+
+# ===== VISTAS EN MEMORIA (write-through) =====
+# Estructuras derivadas (perfiles por código, premios, índices de búsqueda,
+# duplicados, ranking) que se construyen UNA vez por versión base de los datos y
+# luego se parchan en sitio con cada evento confirmado (de esta sesión, de otras o
+# de otros procesos). Solo un cambio externo (carga, edición a mano) o un hueco en
+# el log (truncado por otro proceso) obliga a reconstruir. También lleva un
+# contador por hoja para las cachés que dependen de pocas hojas (p. ej. PROVINCIA).
+# VISTAS: nombre → (construir() -> (objeto, seq), aplicar(objeto, evento)).
+# Las vistas derivadas se construyen desde "perfiles", así que se registran
+# después y se parchan después (orden de inserción).
+@st.cache_resource(show_spinner=False)
+def _vistas_state():
+    return {"lock": threading.RLock(), "base": None, "seq": 0, "hojas": {}, "vistas": {}}
+
+def _vistas_catch_up():
+    vs = _vistas_state(); be = storage()
+    # Como observador de la compactación no espera indefinidamente: si no alcanza
+    # a leer antes del truncado, el horizonte lo detecta y se reconstruye.
+    if not vs["lock"].acquire(timeout=5): return
     try:
-        ws = wb[sheet]; ws.append(values)
-        safe_save_workbook(wb, EXCEL_PATH)
+        base = be.version(); horizonte = be.horizon()
+        nuevos = be.events_since(vs["seq"])
+        # Eventos ya compactados y truncados del journal: la vista no puede
+        # ponerse al día y se reconstruye desde el origen.
+        perdidos = vs["seq"] < horizonte and not any(e["seq"] == horizonte for e in nuevos)
+        if vs["base"] != base or perdidos:
+            vs.update(base=base, seq=be.last_seq(), hojas={}, vistas={})
+            return
+        for e in nuevos:
+            vs["hojas"][e["sheet"]] = vs["hojas"].get(e["sheet"], 0) + 1
+            # Las vistas tratan las hojas de visitantes como solo-append: una fila de
+            # visitante corregida (combinación de Excel) las invalida y se reconstruyen
+            # al pedirlas; lo demás del lote sigue parchándose.
+            if e["op"] == "upsert" and e["sheet"] in VISITOR_SHEETS: vs["vistas"].clear()
+            for nombre, v in vs["vistas"].items():
+                if e["seq"] > v["seq"]:
+                    VISTAS[nombre][1](v["obj"], e); v["seq"] = e["seq"]
+        if nuevos: vs["seq"] = max(e["seq"] for e in nuevos)
+    finally: vs["lock"].release()
+
+def obtener_vista(nombre):
+    """Objeto de la vista al día (se construye la primera vez o tras un cambio externo)."""
+    vs = _vistas_state()
+    _journal_state()["observers"]["vistas"] = _vistas_catch_up
+    with vs["lock"]:
+        _vistas_catch_up()
+        v = vs["vistas"].get(nombre)
+        metrica_cache("vista", v is not None)
+        if v is None:
+            with medir("vista_construir", vista=nombre): obj, seq = VISTAS[nombre][0]()
+            v = vs["vistas"][nombre] = {"obj": obj, "seq": seq}
+        return v["obj"]
+
+def _vista_seq(nombre) -> int:
+    return _vistas_state()["vistas"][nombre]["seq"]
+
+def version_hojas(*hojas) -> tuple:
+    """Clave de caché que solo cambia si cambian esas hojas (o los datos base)."""
+    vs = _vistas_state()
+    _journal_state()["observers"]["vistas"] = _vistas_catch_up
+    with vs["lock"]:
+        _vistas_catch_up()
+        return (vs["base"],) + tuple(vs["hojas"].get(h, 0) for h in hojas)
+
+def append_row(sheet: str, values: list) -> bool:
+    try:
+        storage().append(sheet, values)
         return True
-    except PermissionError:
-        st.error("🔒 No se pudo guardar (archivo bloqueado)."); return False
     except Exception as e:
         st.error(f"❗ Error inesperado al guardar: {e}"); return False
 
@@ -174,40 +1953,116 @@ def email_valido(e):
     if not e: return True
     return re.match(r"^[^@\s]+@[^@\s]+\.[^@\s]+$", e.strip()) is not None
 
-# ===== ÍNDICE PROVINCIA → CANTÓN → PARROQUIA =====
-@st.cache_data(show_spinner=False)
-def load_province_index(path_str: str, mtime: float):
-    index={}
+# ===== CATÁLOGO GEOGRÁFICO (provincia → cantón → parroquia) =====
+# La hoja PROVINCIA se compila UNA vez a GEO_PATH (JSON versionado): provincias,
+# cantones y parroquias ya normalizados y ordenados, más un índice de prefijos
+# (cada inicio de palabra del nombre, ordenado) para el buscador con bisect. Lo
+# comparten todas las sesiones y procesos; solo se recompila si cambia el contenido
+# de la hoja (hash "fuente"), y una carga sin hoja PROVINCIA conserva el anterior.
+GEO_FORMATO = 1
+_GEO_VACIAS = {"DE", "DEL", "LA", "LAS", "LOS", "EL", "Y"}  # no abren una clave del índice
+
+def _geo_filas() -> list:
+    """(provincia, cantón, parroquia) normalizados; celdas combinadas heredan la fila anterior."""
+    df = storage().frames(("PROVINCIA",))[0].get("PROVINCIA")
+    if df is None: return []
+    cmap = frame_hmap(df)
+    ciP = cmap.get("PROVINCIA"); ciC = cmap.get("CANTON/CIUDAD"); ciPa = cmap.get("PARROQUIA")
+    if ciP is None or ciC is None: return []
+    vacia = pd.Series("", index=df.index, dtype="string")
+    cols = [norm_text_col(df.iloc[:, ci]) if ci is not None else vacia for ci in (ciP, ciC, ciPa)]
+    filas = []; lastP = lastC = ""
+    for P, C, Pa in zip(*cols):
+        P = P or lastP; C = C or lastC
+        if not P or not C: continue
+        lastP, lastC = P, C
+        filas.append((P, C, Pa))
+    return filas
+
+def _geo_claves(nombre):
+    palabras = nombre.split(" ")
+    return {" ".join(palabras[k:]) for k in range(len(palabras)) if k == 0 or palabras[k] not in _GEO_VACIAS}
+
+def compilar_catalogo(filas, fuente) -> dict:
+    arbol = {}
+    for P, C, Pa in filas:
+        ps = arbol.setdefault(P, {}).setdefault(C, set())
+        if Pa: ps.add(Pa)
+    prefijos = set()
+    for P, cs in arbol.items():
+        for C, ps in cs.items():
+            prefijos |= {(k, P, C, "") for k in _geo_claves(C)}
+            for Pa in ps: prefijos |= {(k, P, C, Pa) for k in _geo_claves(Pa)}
+    return {"formato": GEO_FORMATO, "fuente": fuente, "provincias": sorted(arbol),
+            "cantones": {P: sorted(cs) for P, cs in arbol.items()},
+            "parroquias": {f"{P}\t{C}": sorted(ps) for P, cs in arbol.items() for C, ps in cs.items()},
+            "prefijos": sorted(prefijos)}
+
+class CatalogoGeo:
+    """Catálogo compilado: hijos ya ordenados e índice de prefijos normalizados."""
+    def __init__(self, datos):
+        self.fuente = datos["fuente"]; self.provincias = datos["provincias"]
+        self._cantones = datos["cantones"]; self._parroquias = datos["parroquias"]
+        self._prefijos = [tuple(p) for p in datos["prefijos"]]
+        self._claves = [p[0] for p in self._prefijos]
+
+    def cantones(self, prov) -> list:
+        return self._cantones.get(_norm_text(prov), [])
+
+    def parroquias(self, prov, cant) -> list:
+        return self._parroquias.get(f"{_norm_text(prov)}\t{_norm_text(cant)}", [])
+
+    def buscar(self, texto, limite=15) -> list:
+        """[(provincia, cantón, parroquia)] cuyo nombre tiene una palabra que empieza con `texto`."""
+        q = _norm_text(texto)
+        if not q: return []
+        out = []; i = bisect_left(self._claves, q)
+        while i < len(self._claves) and self._claves[i].startswith(q) and len(out) < limite:
+            r = self._prefijos[i][1:]; i += 1
+            if r not in out: out.append(r)
+        return out
+
+def _geo_leer():
+    try: datos = json.loads(GEO_PATH.read_text(encoding="utf-8"))
+    except (OSError, ValueError): return None
+    return CatalogoGeo(datos) if datos.get("formato") == GEO_FORMATO else None
+
+def _geo_guardar(datos):
+    tmp = GEO_PATH.with_suffix(f".{os.getpid()}.tmp")
     try:
-        wb=safe_load_workbook(Path(path_str), read_only=True, data_only=True)
-        if "PROVINCIA" not in wb.sheetnames: return {}
-        ws=wb["PROVINCIA"]
-        head=next(ws.iter_rows(min_row=1, max_row=1, values_only=True))
-        cmap={_norm_text(v):i for i,v in enumerate(head)}
-        ciP=cmap.get("PROVINCIA"); ciC=cmap.get("CANTON/CIUDAD"); ciPa=cmap.get("PARROQUIA")
-        if ciP is None or ciC is None: return {}
-        lastP=lastC=""
-        for row in ws.iter_rows(min_row=2, values_only=True):
-            P=_norm_text(row[ciP]) or lastP
-            C=_norm_text(row[ciC]) or lastC
-            Pa=_norm_text(row[ciPa]) if ciPa is not None else ""
-            if not P or not C: continue
-            lastP, lastC = P, C
-            index.setdefault(P, {}).setdefault(C, set())
-            if Pa: index[P][C].add(Pa)
-        for P in index:
-            for C in list(index[P].keys()):
-                index[P][C]=sorted(index[P][C]) if index[P][C] else []
-        return index
-    except: return {}
-
-def cantones_de(prov, idx):
+        tmp.write_text(json.dumps(datos, ensure_ascii=False, separators=(",", ":")), encoding="utf-8")
+        os.replace(tmp, GEO_PATH)
+    except OSError: pass  # sin permisos: el catálogo queda solo en memoria
+
+@st.cache_resource(show_spinner=False)
+def _geo_state():
+    return {"lock": threading.Lock(), "version": None, "cat": None}
+
+def catalogo_geo() -> CatalogoGeo:
+    """Catálogo al día. Solo mira la hoja PROVINCIA si cambió (version_hojas), no con cada registro."""
+    gs = _geo_state(); v = version_hojas("PROVINCIA")
+    with gs["lock"]:
+        metrica_cache("provincias", gs["version"] == v)
+        if gs["version"] == v: return gs["cat"]
+        cat = gs["cat"] or _geo_leer()
+        try: filas = _geo_filas()
+        except Exception: filas = []
+        if filas or cat is None:
+            fuente = hashlib.blake2b(json.dumps(filas).encode(), digest_size=16).hexdigest()
+            if cat is None or cat.fuente != fuente:
+                with medir("catalogo_compilar"): datos = compilar_catalogo(filas, fuente)
+                if filas: _geo_guardar(datos)
+                cat = CatalogoGeo(datos)
+        gs.update(version=v, cat=cat)
+        return cat
+
+def cantones_de(prov, cat):
     if not prov: return []
-    return sorted(idx.get(_norm_text(prov), {}).keys())
+    return cat.cantones(prov)
 
-def parroquias_de(prov, cant, idx):
+def parroquias_de(prov, cant, cat):
     if not prov or not cant: return []
-    return idx.get(_norm_text(prov), {}).get(_norm_text(cant), [])
+    return cat.parroquias(prov, cant)
 
 # ===== DUPLICADOS (solo alerta, no bloquea) =====
 def find_col(m,*cands):
@@ -216,159 +2071,909 @@ def find_col(m,*cands):
             if c in k: return i
     return None
 
+# Índice hash: (campo, valor normalizado) -> [(hoja, CODIGO, NOMBRE)].
+# Es la vista "duplicados": se construye una vez y se parcha con cada fila nueva.
+VISITOR_SHEETS = ("MECANICO","DISTRIBUIDOR","CONSUMIDOR")
+
+def _dup_index_add(keys, hoja, codigo, nombre, ced, correo, tel):
+    ref=(hoja, codigo, nombre)
+    for k in (("id", norm_id(ced)), ("mail", norm_email(correo)), ("tel", norm_phone(tel))):
+        if k[1]: keys.setdefault(k, []).append(ref)
+
+def _dup_index_add_row(keys, hoja, hmap, row):
+    if not row: return
+    ci=find_col(hmap,"CEDULA","RUC"); ctel=find_col(hmap,"TELEFONO"); ccor=find_col(hmap,"CORREO")
+    ccod=find_col(hmap,"CODIGO"); cnom=find_col(hmap,"NOMBRE")
+    get=lambda c: row[c] if c is not None and c < len(row) and row[c] is not None else None
+    ref_cod=str(get(ccod) or "").strip()
+    ref_nom=str(get(cnom) or "").strip()
+    _dup_index_add(keys, hoja, ref_cod, ref_nom, str(get(ci) or ""), str(get(ccor) or ""), str(get(ctel) or ""))
+
+def _dup_construir():
+    # Normalización por columnas (norm_id / norm_email / norm_phone vectorizados).
+    frames, seq = storage().frames(VISITOR_SHEETS)
+    keys = {}
+    digitos = lambda s: s.str.replace(r"\D+", "", regex=True)
+    for hoja in VISITOR_SHEETS:
+        df = frames.get(hoja)
+        if df is None or not len(df): continue
+        refs = [(hoja, c, n) for c, n in zip(texto_col(df, "CODIGO"), texto_col(df, "NOMBRE"))]
+        for campo, vals in (("id", digitos(texto_col(df, "CEDULA", "RUC"))),
+                            ("mail", texto_col(df, "CORREO").str.lower()),
+                            ("tel", digitos(texto_col(df, "TELEFONO")).str[-10:])):
+            for ref, v in zip(refs, vals):
+                if v: keys.setdefault((campo, v), []).append(ref)
+    return keys, seq
+
+def _dup_aplicar(keys, e):
+    # Las filas nuevas vienen en el orden de HEADERS (ver registrar_visitante).
+    if e["op"] == "append" and e["sheet"] in VISITOR_SHEETS:
+        _dup_index_add_row(keys, e["sheet"], _headers_hmap(e["sheet"]), e["values"])
+
+def _headers_hmap(hoja):
+    return {_norm_text(v): i for i, v in enumerate(HEADERS[hoja])}
+
 def buscar_duplicados(cedula_o_ruc, correo, telefono):
+    try: keys = obtener_vista("duplicados")
+    except: return []
     matches=[]
-    try: wb=safe_load_workbook(EXCEL_PATH, read_only=True, data_only=True)
-    except: return matches
-    id_new=norm_id(cedula_o_ruc); em_new=norm_email(correo); ph_new=norm_phone(telefono)
-    for hoja in ("MECANICO","DISTRIBUIDOR","CONSUMIDOR"):
-        if hoja not in wb.sheetnames: continue
-        ws=wb[hoja]; hmap=header_map(ws)
-        ci=find_col(hmap,"CEDULA","RUC"); ctel=find_col(hmap,"TELEFONO"); ccor=find_col(hmap,"CORREO")
-        ccod=find_col(hmap,"CODIGO"); cnom=find_col(hmap,"NOMBRE")
-        for row in ws.iter_rows(min_row=2, values_only=True):
-            if not row: continue
-            oid=norm_id(str(row[ci])) if ci is not None and row[ci] is not None else ""
-            otel=norm_phone(str(row[ctel])) if ctel is not None and row[ctel] is not None else ""
-            ocur=norm_email(str(row[ccor])) if ccor is not None and row[ccor] is not None else ""
-            dup = (id_new and oid and id_new==oid) or (em_new and ocur and em_new==ocur) or (ph_new and otel and ph_new==otel)
-            if dup:
-                codigo=str(row[ccod]) if ccod is not None else ""
-                nombre=str(row[cnom]) if cnom is not None else ""
-                matches.append((hoja, codigo, nombre))
+    for k in (("id", norm_id(cedula_o_ruc)), ("mail", norm_email(correo)), ("tel", norm_phone(telefono))):
+        if not k[1]: continue
+        for ref in keys.get(k, ()):
+            if ref not in matches: matches.append(ref)
     return matches
 
+def alerta_duplicados(dups, campos="Cédula/RUC o Correo o Teléfono"):
+    if dups:
+        lista = "\n".join([f"- {h} | Código {c} | {n}" for h,c,n in dups[:6]])
+        st.warning(f"⚠️ Ya existe un registro con esta {campos}:\n" + lista)
+
 # ===== CÓDIGO Y REGISTRO =====
-def next_code(prefix):
-    ensure_workbook(EXCEL_PATH)
+def ahora() -> str:
+    """FECHA REGISTRO: hora local del servidor; el texto ISO se ordena y compara como fecha."""
+    return time.strftime("%Y-%m-%d %H:%M:%S")
+
+def next_code(prefix, snap=None, be=None):
+    """Siguiente código por escaneo completo. Si la lectura falla, el error sube:
+    un máximo a medias sembraría el contador por debajo de códigos ya entregados."""
     mx=0
+    own = snap is None
     try:
-        wb=safe_load_workbook(EXCEL_PATH, read_only=True, data_only=True)
-        if "REGISTRO DE CODIGOS" in wb.sheetnames:
-            for (val,) in wb["REGISTRO DE CODIGOS"].iter_rows(min_row=2, max_col=1, values_only=True):
-                s=str(val or "").upper(); m=re.search(r"(\d+)$", s) if s.startswith(prefix) else None
-                if m: mx=max(mx, int(m.group(1)))
+        if own: snap=(be or storage()).snapshot()
+        if "REGISTRO DE CODIGOS" in snap.sheetnames:
+            for (val,*_) in snap.rows("REGISTRO DE CODIGOS"):
+                mx=max(mx, _code_num(val, prefix))
         for hoja,pfx in (("MECANICO","M"),("DISTRIBUIDOR","D"),("CONSUMIDOR","C")):
-            if pfx!=prefix or hoja not in wb.sheetnames: continue
-            for (val,) in wb[hoja].iter_rows(min_row=2, max_col=1, values_only=True):
-                s=str(val or "").upper(); m=re.search(r"(\d+)$", s) if s.startswith(prefix) else None
-                if m: mx=max(mx, int(m.group(1)))
-    except: pass
+            if pfx!=prefix or hoja not in snap.sheetnames: continue
+            for (val,*_) in snap.rows(hoja):
+                mx=max(mx, _code_num(val, prefix))
+    finally:
+        if own and snap is not None: snap.close()
     return f"{prefix}{mx+1}"
 
+# Asignador O(1): un contador por prefijo persistido en COUNTERS_PATH (escritura
+# atómica con fsync) y leído/escrito bajo el candado "journal", así que también es
+# atómico entre procesos. Se siembra una sola vez con next_code (escaneo completo)
+# y se reconcilia con reconcile_counters cuando se sube un Excel editado a mano.
+# El contador guarda el mayor número visto; cada nodo salta a los suyos (NODE_ID).
+# Orden de candados: "excel" antes que "journal" (como compact_journal). Crear el
+# backend toma "excel" (ensure_workbook), así que se resuelve ANTES de tomar
+# "journal"; bajo "journal" solo se pide snapshot(), que no toma ninguno.
+def _read_counters() -> dict:
+    try:
+        with open(COUNTERS_PATH, encoding="utf-8") as f:
+            return {k: int(v) for k, v in json.load(f).items()}
+    except (OSError, ValueError): return {}
+
+def _write_counters(values: dict):
+    tmp = COUNTERS_PATH.with_suffix(".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(values, f); f.flush(); os.fsync(f.fileno())
+    os.replace(tmp, COUNTERS_PATH)
+
+def _code_num(codigo, prefix) -> int:
+    s=str(codigo or "").upper(); m=re.search(r"(\d+)$", s) if s.startswith(prefix) else None
+    return int(m.group(1)) if m else 0
+
+def _siguiente_del_nodo(ultimo) -> int:
+    """Primer número mayor que `ultimo` que le toca a este nodo."""
+    return ultimo + 1 + (NODE_ID - ultimo - 1) % NODE_COUNT
+
+def allocate_code(prefix, snap=None):
+    """Entrega el siguiente código del prefijo sin recorrer las hojas (salvo la siembra inicial)."""
+    return allocate_codes(prefix, 1, snap=snap)[0]
+
+def allocate_codes(prefix, n, snap=None) -> list:
+    """Reserva `n` códigos consecutivos (del nodo) con una sola escritura del contador."""
+    be = storage()
+    with file_lock("journal"):
+        vals = _read_counters()
+        if prefix not in vals:  # si el escaneo falla no se guarda nada: se reintenta la próxima vez
+            vals[prefix] = _code_num(next_code(prefix, snap=snap, be=be), prefix) - 1
+        nums = range(_siguiente_del_nodo(vals[prefix]), vals[prefix] + 1 + n * NODE_COUNT, NODE_COUNT)[:n]
+        vals[prefix] = nums[-1]
+        _write_counters(vals)  # antes de confirmar el registro: nunca se reutiliza un número
+    return [f"{prefix}{i}" for i in nums]
+
+def reconcile_counters(snap=None):
+    """Sube cada contador al máximo encontrado en el Excel (p.ej. tras una carga manual)."""
+    be = storage()
+    with file_lock("journal"):
+        vals = _read_counters()
+        for pfx in CODE_PREFIXES:
+            vals[pfx] = max(vals.get(pfx, 0), _code_num(next_code(pfx, snap=snap, be=be), pfx) - 1)
+        _write_counters(vals)
+
+def subir_contadores(codigos):
+    """Sube cada contador al mayor número entre `codigos` (sin recorrer las hojas)."""
+    maximos = {}
+    for c in codigos:
+        for pfx in CODE_PREFIXES:
+            n = _code_num(c, pfx)
+            if n: maximos[pfx] = max(maximos.get(pfx, 0), n)
+    if not maximos: return
+    with file_lock("journal"):
+        vals = _read_counters()
+        # Un prefijo aún sin sembrar se siembra después con next_code, que ya los ve.
+        for pfx, n in maximos.items():
+            if pfx in vals: vals[pfx] = max(vals[pfx], n)
+        _write_counters(vals)
+
 def upsert_registro_codigo(codigo, ced, nom, tel, tipo, stand):
-    ensure_workbook(EXCEL_PATH)
-    try: wb=safe_load_workbook(EXCEL_PATH)
+    try:
+        storage().upsert("REGISTRO DE CODIGOS", codigo, {"RUC O CEDULA": ced, "NOMBRE": nom,
+                         "TELEFONO": tel, "TIPO": tipo, "STAND": stand})
+    except Exception:
+        st.info("ℹ️ No se pudo actualizar REGISTRO DE CODIGOS.")
+
+@medido("accion", accion="registrar")
+def registrar_visitante(hoja, prefix, valores, ced, correo, tel, nom, stand):
+    """
+    Transacción de registro: duplicados + código + fila + REGISTRO DE CODIGOS
+    sobre UNA sola lectura (snapshot) y confirmada con UNA sola escritura (commit).
+    `valores` es la fila sin el CODIGO. Devuelve (codigo, duplicados) o (None, []).
+    """
+    try: snap = storage().snapshot()
     except PermissionError:
-        st.info("ℹ️ No se pudo actualizar REGISTRO DE CODIGOS (bloqueado)."); return
-    if "REGISTRO DE CODIGOS" not in wb.sheetnames:
-        ws=wb.create_sheet("REGISTRO DE CODIGOS"); ws.append(HEADERS["REGISTRO DE CODIGOS"])
-    ws=wb["REGISTRO DE CODIGOS"]
-    hmap = header_map(ws)
-    ci_punt = find_col(hmap, "PUNTAJE")
-    ci_ced  = find_col(hmap, "RUC O CEDULA")
-    ci_nom  = find_col(hmap, "NOMBRE")
-    ci_tel  = find_col(hmap, "TELEFONO")
-    ci_tipo = find_col(hmap, "TIPO")
-    ci_stand= find_col(hmap, "STAND")
-    found=False
-    for r in range(2, ws.max_row+1):
-        if str(ws.cell(r,1).value or "").strip().upper()==codigo:
-            if ci_ced  is not None: ws.cell(r,ci_ced+1).value  = ced
-            if ci_nom  is not None: ws.cell(r,ci_nom+1).value  = nom
-            if ci_tel  is not None: ws.cell(r,ci_tel+1).value  = tel
-            if ci_tipo is not None: ws.cell(r,ci_tipo+1).value = tipo
-            if ci_stand is not None: ws.cell(r,ci_stand+1).value= stand
-            found=True; break
-    if not found:
-        row = [""] * (max(hmap.values()) + 1)
-        row[0] = codigo
-        if ci_punt  is not None: row[ci_punt]  = ""
-        if ci_ced   is not None: row[ci_ced]   = ced
-        if ci_nom   is not None: row[ci_nom]   = nom
-        if ci_tel   is not None: row[ci_tel]   = tel
-        if ci_tipo  is not None: row[ci_tipo]  = tipo
-        if ci_stand is not None: row[ci_stand] = stand
-        ws.append(row)
-    try: safe_save_workbook(wb, EXCEL_PATH)
-    except PermissionError: st.info("ℹ️ No se pudo guardar (bloqueado).")
-
-def lookup_stand_by_code(wb, code):
-    for sheet in ("MECANICO","DISTRIBUIDOR","CONSUMIDOR"):
-        if sheet not in wb.sheetnames: continue
-        ws = wb[sheet]
-        hmap = header_map(ws)
-        ci_cod = find_col(hmap, "CODIGO")
-        ci_stand = find_col(hmap, "STAND")
-        if ci_cod is None or ci_stand is None: continue
-        for row in ws.iter_rows(min_row=2, values_only=True):
-            if not row: continue
-            if str(row[ci_cod] or "").strip().upper() == code:
-                return str(row[ci_stand] or "").strip().upper()
-    return ""
+        st.error("🔒 Cierra el Excel o pausa OneDrive e intenta de nuevo."); return None, []
+    try:
+        dups = buscar_duplicados(ced, correo, tel)
+        # El contador es atómico entre sesiones y procesos: no hace falta más candado.
+        try: codigo = allocate_code(prefix, snap=snap)
+        except Exception as e:
+            st.error(f"❗ No se pudo asignar el código: {e}"); return None, dups
+    finally: snap.close()
+    try:
+        storage().commit([
+            {"op": "append", "sheet": hoja, "values": [codigo] + list(valores)},
+            {"op": "upsert", "sheet": "REGISTRO DE CODIGOS", "codigo": codigo,
+             "fields": {"RUC O CEDULA": ced, "NOMBRE": nom, "TELEFONO": tel,
+                        "TIPO": hoja, "STAND": stand, "FECHA REGISTRO": ahora()}},
+        ])
+    except Exception as e:
+        st.error(f"❗ Error inesperado al guardar: {e}"); return None, dups
+    return codigo, dups
+
+# ===== PUNTAJES EN LOTE =====
+PUNTAJE_MAX = 100000
+
+def parse_puntajes(texto: str) -> list:
+    """Una línea por código: "CODIGO PUNTAJE" (espacio, tab, coma o punto y coma)."""
+    pares = []
+    for line in (texto or "").splitlines():
+        parts = [p for p in re.split(r"[\s,;]+", line.strip()) if p]
+        if parts: pares.append((parts[0], parts[1] if len(parts) > 1 else ""))
+    return pares
+
+@medido("accion", accion="puntaje_lote")
+def registrar_puntajes(pares: list) -> list:
+    """
+    Valida cada (CODIGO, PUNTAJE) contra los perfiles por código (REGISTRO DE CODIGOS y
+    hojas de visitantes) y confirma todos los válidos en UNA sola escritura. Devuelve el informe por fila.
+    """
+    informe = [{"CODIGO": str(c or "").strip().upper(), "PUNTAJE": str(p if p is not None else "").strip(),
+                "ESTADO": ""} for c, p in pares]
+    validos = {}
+    for i, f in enumerate(informe):
+        pts = f["PUNTAJE"][:-2] if f["PUNTAJE"].endswith(".0") else f["PUNTAJE"]
+        if not f["CODIGO"]: f["ESTADO"] = "❌ Falta el código"; continue
+        if not re.fullmatch(r"\d+", pts) or int(pts) > PUNTAJE_MAX:
+            f["ESTADO"] = f"❌ Puntaje inválido (0 a {PUNTAJE_MAX})"; continue
+        p = perfil(f["CODIGO"])
+        if p is None: f["ESTADO"] = "❌ Código no registrado"; continue
+        fields = {"PUNTAJE": int(pts)}
+        if not p["registro"]: fields.update(campos_registro(p))
+        if f["CODIGO"] in validos:
+            informe[validos[f["CODIGO"]][0]]["ESTADO"] = "⚠️ Repetido: vale la última línea"
+        validos[f["CODIGO"]] = (i, fields)
+    if not validos: return informe
+    try:
+        storage().commit([{"op": "upsert", "sheet": "REGISTRO DE CODIGOS", "codigo": cod, "fields": fields}
+                          for cod, (_, fields) in validos.items()])
+        estado = "✅ Guardado"
+    except Exception as e:
+        estado = f"❌ No se guardó: {e}"
+    for i, _ in validos.values(): informe[i]["ESTADO"] = estado
+    return informe
+
+# ===== IMPORTACIÓN MASIVA (pre-registros) =====
+# Los distribuidores mandan hojas de mecánicos/distribuidores antes de la feria. El archivo
+# (CSV o XLSX) se lee por bloques y se valida por columnas: cédula/RUC, correo y teléfono
+# sin bucles por fila. Los códigos se reservan en bloque y todo (filas + REGISTRO DE
+# CODIGOS) se confirma en UNA escritura. Cédula/RUC repetida (en el archivo o ya
+# registrada) se rechaza; correo/teléfono repetido solo se avisa, como en los formularios.
+IMPORT_BLOQUE = 5000
+STANDS = ("PANTRO", "EXTREMEMAX")
+VISITOR_PREFIX = {"MECANICO": "M", "DISTRIBUIDOR": "D", "CONSUMIDOR": "C"}
+# Encabezados cortos que también se aceptan en el archivo.
+_IMPORT_ALIAS = {"NOMBRE": "NOMBRE Y APELLIDO", "NOMBRES": "NOMBRE Y APELLIDO",
+                 "CEDULA": "CEDULA", "RUC": "CEDULA", "CELULAR": "TELEFONO",
+                 "EMAIL": "CORREO", "E-MAIL": "CORREO"}
+
+def _celda_texto(v) -> str:
+    if v is None: return ""
+    if isinstance(v, float) and v.is_integer(): v = int(v)  # 1712345678.0 → "1712345678"
+    return str(v).strip()
+
+def _columnas_unicas(head) -> list:
+    vistos = {}; out = []
+    for h in head:
+        h = str(h or "").strip() or "?"
+        vistos[h] = vistos.get(h, 0) + 1
+        out.append(h if vistos[h] == 1 else f"{h}.{vistos[h]-1}")
+    return out
+
+def leer_importacion(nombre: str, data: bytes, bloque: int = IMPORT_BLOQUE):
+    """DataFrames de texto de `bloque` filas desde un CSV (`,` `;` o tab) o un XLSX (primera hoja)."""
+    if nombre.lower().endswith((".xlsx", ".xlsm")):
+        wb = load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+        try:
+            filas = wb.worksheets[0].iter_rows(values_only=True)
+            head = _columnas_unicas(next(filas, ()))
+            lote = []
+            for r in filas:
+                r = [_celda_texto(v) for v in r[:len(head)]]
+                if not any(r): continue
+                lote.append(r + [""] * (len(head) - len(r)))
+                if len(lote) >= bloque:
+                    yield pd.DataFrame(lote, columns=head); lote = []
+            if lote: yield pd.DataFrame(lote, columns=head)
+        finally: wb.close()
+        return
+    try: texto = data.decode("utf-8-sig")
+    except UnicodeDecodeError: texto = data.decode("latin-1")  # CSV de Excel en Windows
+    primera = texto.split("\n", 1)[0]
+    sep = max(",;\t", key=primera.count)  # Excel en español exporta con ";"
+    for df in pd.read_csv(io.StringIO(texto), sep=sep, dtype=str, keep_default_na=False,
+                          chunksize=bloque, skip_blank_lines=True):
+        yield df.apply(lambda c: c.str.strip())
+
+def _columnas_importacion(hoja, cols) -> dict:
+    """Encabezado de HEADERS[hoja] → columna del archivo (por nombre normalizado o alias)."""
+    entrada = {}
+    for c in cols:
+        n = _norm_text(re.sub(r"\.\d+$", "", str(c)))
+        entrada.setdefault(n, c)
+        if n in _IMPORT_ALIAS: entrada.setdefault(_IMPORT_ALIAS[n], c)
+    out = {}
+    for h in HEADERS[hoja][1:]:
+        n = _norm_text(h)
+        c = entrada.get(n)
+        if c is None and ("CEDULA" in n or "RUC" in n): c = entrada.get("CEDULA")
+        out[h] = c
+    return out
+
+def documento_col(s: pd.Series) -> pd.Series:
+    """norm_id por columnas; recupera el 0 inicial que Excel le quita a las cédulas 01–09."""
+    d = s.str.replace(r"[^0-9]+", "", regex=True)
+    return d.where(~d.str.len().isin((9, 12)), "0" + d)
+
+def telefono_col(s: pd.Series) -> pd.Series:
+    """norm_phone por columnas (celular de 9 dígitos sin el 0 → 09…)."""
+    d = s.str.replace(r"[^0-9]+", "", regex=True).str[-10:]
+    return d.where(~(d.str.len().eq(9) & d.str.startswith("9")), "0" + d)
+
+def validar_documento_col(d: pd.Series) -> np.ndarray:
+    """validar_cedula_ec / validar_ruc_natural_ec sobre una columna de dígitos, con numpy."""
+    largo = d.str.len()
+    ruc = (largo.eq(13) & d.str.endswith("001")).to_numpy()
+    forma = largo.eq(10).to_numpy() | ruc
+    base = d.str[:10].where(forma, "0" * 10)
+    dig = np.frombuffer("".join(base).encode("ascii"), dtype=np.uint8).reshape(-1, 10).astype(np.int64) - 48
+    x = dig[:, :9] * np.array([2, 1, 2, 1, 2, 1, 2, 1, 2])
+    x = np.where(x >= 10, x - 9, x)
+    dv = (10 - x.sum(axis=1) % 10) % 10
+    prov = dig[:, 0] * 10 + dig[:, 1]
+    return forma & (prov >= 1) & (prov <= 24) & (dig[:, 2] < 6) & (dv == dig[:, 9])
+
+def validar_correo_col(s: pd.Series) -> np.ndarray:
+    return (s.eq("") | s.str.match(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")).to_numpy()
+
+@medido("accion", accion="importar")
+def importar_visitantes(hoja, nombre, data, bloque=IMPORT_BLOQUE) -> list:
+    """
+    Importa pre-registros de `hoja` desde un CSV/XLSX. Devuelve el informe por fila
+    (FILA, NOMBRE, DOCUMENTO, CODIGO, ESTADO); ValueError si faltan columnas obligatorias.
+    Si no se puede leer el índice de duplicados se relanza su error sin importar nada.
+    """
+    cabeceras = HEADERS[hoja][1:]
+    hm = {_norm_text(h): h for h in cabeceras}
+    h_nom = hm["NOMBRE Y APELLIDO"]; h_tel = hm["TELEFONO"]; h_sta = hm["STAND"]
+    h_doc = next(h for n, h in hm.items() if "CEDULA" in n or "RUC" in n)
+    h_cor = hm.get("CORREO"); h_edad = hm.get("EDAD")
+    keys = obtener_vista("duplicados")  # sin índice no se importa: un índice vacío dejaría pasar duplicados
+    en_archivo = {}  # documento → fila del archivo
+    informe, filas = [], []
+    fila0 = 2  # la fila 1 son los encabezados
+    for df in leer_importacion(nombre, data, bloque):
+        cols = _columnas_importacion(hoja, df.columns)
+        faltan = [h for h in (h_nom, h_doc, h_tel, h_sta) if cols[h] is None]
+        if faltan: raise ValueError("Faltan columnas obligatorias: " + ", ".join(faltan))
+        vacia = pd.Series("", index=df.index, dtype=object)
+        t = {h: (df[c].astype(str) if c is not None else vacia) for h, c in cols.items()}
+        doc = documento_col(t[h_doc]); tel = telefono_col(t[h_tel])
+        sta = t[h_sta].str.upper(); t[h_sta] = sta; t[h_doc] = doc; t[h_tel] = tel
+        correo = t[h_cor].str.lower() if h_cor else vacia
+        if h_cor: t[h_cor] = correo
+        if h_edad:
+            edad = pd.to_numeric(t[h_edad], errors="coerce")
+            t[h_edad] = pd.Series([int(v) if 1 <= v <= 120 else None for v in edad], index=df.index, dtype=object)
+        estado = np.select(
+            [t[h_nom].eq("").to_numpy(), doc.eq("").to_numpy(), tel.eq("").to_numpy(),
+             ~sta.isin(STANDS).to_numpy(), ~validar_documento_col(doc), ~validar_correo_col(correo)],
+            ["❌ Falta el nombre", "❌ Falta la cédula/RUC", "❌ Falta el teléfono",
+             "❌ Stand inválido (" + " o ".join(STANDS) + ")",
+             "❌ Documento inválido (cédula o RUC natural)", "❌ Correo inválido"], default="")
+        valores = list(zip(*[t[h].tolist() for h in cabeceras]))
+        for i, (est, nom, d, m, tl) in enumerate(zip(estado.tolist(), t[h_nom], doc, correo, tel)):
+            f = {"FILA": fila0 + i, "NOMBRE": nom, "DOCUMENTO": d, "CODIGO": "", "ESTADO": est}
+            informe.append(f)
+            if est: continue
+            previa = keys.get(("id", d)) or ()
+            if previa:
+                f["ESTADO"] = f"❌ Ya registrado: {previa[0][0]} {previa[0][1]}"; continue
+            if d in en_archivo:
+                f["ESTADO"] = f"❌ Repetido en el archivo (fila {en_archivo[d]})"; continue
+            en_archivo[d] = f["FILA"]
+            avisos = [f"{q} ya registrado ({keys[k][0][1]})"
+                      for q, k in (("correo", ("mail", m)), ("teléfono", ("tel", tl))) if k[1] and keys.get(k)]
+            filas.append((f, valores[i], avisos))
+        fila0 += len(df)
+    if not filas: return informe
+    try:
+        codigos = allocate_codes(VISITOR_PREFIX[hoja], len(filas))
+        eventos = []; fecha = ahora()
+        for cod, (f, vals, _) in zip(codigos, filas):
+            reg = dict(zip(cabeceras, vals))
+            eventos.append({"op": "append", "sheet": hoja, "values": [cod] + list(vals)})
+            eventos.append({"op": "upsert", "sheet": "REGISTRO DE CODIGOS", "codigo": cod,
+                            "fields": {"RUC O CEDULA": reg[h_doc], "NOMBRE": reg[h_nom], "TELEFONO": reg[h_tel],
+                                       "TIPO": hoja, "STAND": reg[h_sta], "FECHA REGISTRO": fecha}})
+            f["CODIGO"] = cod
+        storage().commit(eventos)
+        for f, _, avisos in filas: f["ESTADO"] = "; ".join(["✅ Importado"] + avisos)
+    except Exception as e:
+        for f, _, _ in filas: f["CODIGO"] = ""; f["ESTADO"] = f"❌ No se guardó: {e}"
+    return informe
+
+# ===== CARGA DE EXCEL (reemplazo atómico o combinación por CODIGO) =====
+# Reemplazar: el archivo entra entero con os.replace (ver replace_from_xlsx). Combinar:
+# se compara contra lo actual y solo se confirma la diferencia en UNA escritura: filas
+# nuevas (append) y campos cambiados (upsert por CODIGO). Así vistas, índices y
+# contadores se parchan en vez de reconstruirse, y lo registrado después de bajar la
+# copia se conserva. Un código que también cambió en el servidor después de la copia
+# (JOURNAL_SEQ del archivo) es un conflicto y manda el servidor, salvo que se pida lo
+# contrario. El journal se trunca al compactar, pero cada compactación anota en
+# HISTORIAL_PATH qué códigos tocó; si ni así alcanza (copia anterior al historial),
+# toda diferencia cuenta como conflicto. Las hojas sin CODIGO
+# (y REGISTRO DE PREMIOS, varias filas por código) solo suman las filas que faltan.
+def _valor_evento(v):
+    if v is None or v is pd.NA or (isinstance(v, float) and np.isnan(v)): return None
+    return int(v) if isinstance(v, np.integer) else v
+
+def _texto_frame(df, cols) -> dict:
+    return {c: df[c].astype("string").fillna("").str.strip() for c in cols}
+
+def validar_xlsx(data: bytes):
+    """ValueError si `data` no es un .xlsx legible (antes de tocar nada)."""
+    try: load_workbook(io.BytesIO(data), read_only=True).close()
+    except Exception as e: raise ValueError(f"El archivo no es un Excel válido: {e}")
+
+def _tocados_eventos(evs):
+    out = set()
+    for e in evs:
+        if e["op"] == "upsert": out.add((e["sheet"], str(e["codigo"]).strip().upper()))
+        elif e["sheet"] in HEADERS:
+            ci = find_col(_headers_hmap(e["sheet"]), "CODIGO")
+            if ci is not None and ci < len(e["values"]):
+                out.add((e["sheet"], str(e["values"][ci] or "").strip().upper()))
+    return out
+
+def _tocados_desde(seq):
+    """{(hoja, CODIGO)} cambiados en el servidor después de `seq`; None si el historial no alcanza."""
+    be = storage()
+    if not seq or seq > be.last_seq(): return None
+    return be.tocados_desde(seq)
+
+def _combinar_por_codigo(hoja, up, cur, comunes, tocados, preferir_archivo, inf, eventos):
+    t_up, t_cur = _texto_frame(up, comunes), _texto_frame(cur, comunes)
+    col_cod = cur.columns[find_col(frame_hmap(cur), "CODIGO")]
+    cod_up = texto_col(up, "CODIGO").str.upper(); cod_cur = texto_col(cur, "CODIGO").str.upper()
+    pos_cur = {c: j for j, c in reversed(list(enumerate(cod_cur))) if c}  # código repetido: la primera fila
+    vistos = set()
+    for i, c in enumerate(cod_up):
+        if not c or c in vistos: continue
+        vistos.add(c)
+        j = pos_cur.get(c)
+        if j is None:
+            # Fuera de las hojas de visitantes los índices y vistas siguen las filas por
+            # upsert (REGISTRO DE CODIGOS), así que el código nuevo entra como upsert.
+            if hoja in VISITOR_PREFIX:
+                eventos.append({"op": "append", "sheet": hoja, "values":
+                                [_valor_evento(up[col].iat[i]) if col in up.columns else None for col in cur.columns]})
+            else:
+                eventos.append({"op": "upsert", "sheet": hoja, "codigo": c, "fields":
+                                {col: _valor_evento(up[col].iat[i]) for col in comunes
+                                 if col != col_cod and t_up[col].iat[i]}})
+            inf["agregadas"] += 1; inf["codigos"].append(c); continue
+        cambios = [col for col in comunes if col != col_cod and t_up[col].iat[i] != t_cur[col].iat[j]]
+        if not cambios: continue
+        if tocados is None or (hoja, c) in tocados:
+            inf["conflictos"] += [{"HOJA": hoja, "CODIGO": c, "COLUMNA": col, "SERVIDOR": t_cur[col].iat[j],
+                                   "ARCHIVO": t_up[col].iat[i]} for col in cambios]
+            if not preferir_archivo: continue
+        eventos.append({"op": "upsert", "sheet": hoja, "codigo": c,
+                        "fields": {col: _valor_evento(up[col].iat[i]) for col in cambios}})
+        inf["actualizadas"] += 1
+    inf["solo_servidor"] += len(set(pos_cur) - vistos)
+
+def _combinar_filas(hoja, up, cur, comunes, inf, eventos):
+    t_up, t_cur = _texto_frame(up, comunes), _texto_frame(cur, comunes)
+    filas_up = list(zip(*t_up.values())) if comunes else []
+    faltan = Counter(filas_up) - Counter(zip(*t_cur.values()))
+    for i, f in enumerate(filas_up):
+        if faltan[f] <= 0 or not any(f): continue
+        faltan[f] -= 1
+        eventos.append({"op": "append", "sheet": hoja, "values":
+                        [_valor_evento(up[col].iat[i]) if col in up.columns else None for col in cur.columns]})
+        inf["agregadas"] += 1
+
+def combinar_xlsx(data: bytes, preferir_archivo: bool = False) -> dict:
+    """
+    Combina un Excel subido con los datos actuales (ver arriba). Devuelve {"agregadas",
+    "actualizadas", "solo_servidor", "conflictos": [filas], "omitidas": [hojas], "historial", …}.
+    """
+    validar_xlsx(data)
+    subido = _columnar_desde_xlsx(data)
+    frames, _ = storage().frames()
+    tocados = _tocados_desde(subido["seq"])
+    inf = {"agregadas": 0, "actualizadas": 0, "solo_servidor": 0, "conflictos": [], "omitidas": [],
+           "codigos": [], "historial": tocados is not None, "manda_archivo": preferir_archivo}
+    eventos = []
+    for hoja, up in subido["hojas"].items():
+        cur = frames.get(hoja)
+        if cur is None: inf["omitidas"].append(hoja); continue
+        comunes = [c for c in cur.columns if c in up.columns]
+        if hoja != "REGISTRO DE PREMIOS" and "CODIGO" in comunes:
+            _combinar_por_codigo(hoja, up, cur, comunes, tocados, preferir_archivo, inf, eventos)
+        else: _combinar_filas(hoja, up, cur, comunes, inf, eventos)
+    if eventos:
+        storage().commit(eventos)
+        subir_contadores(inf["codigos"])
+    return inf
+
+# ===== EXPORTACIÓN FILTRADA (CSV / Parquet) =====
+# Para marketing: solo las hojas y filas pedidas, sin cargar el libro con openpyxl. Se
+# filtra sobre las particiones de la capa columnar (compartidas entre sesiones): un
+# STAND o una ventana de fechas solo leen las particiones de ese stand / esos días. El
+# archivo se escribe por bloques en un temporal que pasa a disco si crece, pero la
+# descarga sí queda entera en memoria: st.download_button convierte cualquier dato
+# (bytes, archivo o lo que devuelva el callable) en bytes y los guarda en su almacén de
+# medios en memoria, así que pasarle un archivo no ahorra nada. Provincia y
+# fecha se resuelven por CODIGO (hojas de visitantes / REGISTRO DE CODIGOS), así también
+# filtran REGISTRO DE CODIGOS y REGISTRO DE PREMIOS. Sin FECHA REGISTRO (registros
+# anteriores a la columna) una fila queda fuera de cualquier ventana de tiempo.
+EXPORT_BLOQUE = 5000
+EXPORT_HOJAS = VISITOR_SHEETS + ("REGISTRO DE CODIGOS", "REGISTRO DE PREMIOS")
+
+def _hay_parquet() -> bool:
+    try: return importlib.util.find_spec("pyarrow.parquet") is not None
+    except ImportError: return False  # sin pyarrow: find_spec no encuentra el paquete padre
+
+def filas_exportacion(hojas, stand=None, tipo=None, provincia=None, desde=None, hasta=None, bloque=EXPORT_BLOQUE):
+    """(hoja, DataFrame) por bloques de `bloque` filas que cumplen los filtros (un bloque vacío si ninguna)."""
+    p = storage().particiones(set(hojas) | set(VISITOR_SHEETS))
+    # Un CODIGO tiene todas sus filas en particiones de su día: los cruces por código
+    # se podan por días, no por STAND (el de la fila puede diferir entre hojas).
+    dias = (desde and desde[:10], hasta and hasta[:10]) if desde or hasta else None
+    frames = p.consultar(hojas, dias, {stand} if stand else None)
+    provs = _por_codigo(p.consultar(VISITOR_SHEETS, dias), VISITOR_SHEETS, "PROVINCIA") if provincia else None
+    fechas = _por_codigo(p.consultar(("REGISTRO DE CODIGOS",), dias), ("REGISTRO DE CODIGOS",), "FECHA REGISTRO") if dias else None
+    for hoja in hojas:
+        df = frames.get(hoja)
+        if df is None: continue
+        if tipo and hoja in VISITOR_SHEETS and hoja != tipo: df = df.iloc[:0]
+        cod = texto_col(df, "CODIGO").str.upper()
+        m = pd.Series(True, index=df.index)
+        if stand: m &= texto_col(df, "STAND").str.upper().eq(stand)
+        if tipo and hoja not in VISITOR_SHEETS: m &= texto_col(df, "TIPO").str.upper().eq(tipo)
+        if provincia: m &= norm_text_col(cod.map(provs)).eq(_norm_text(provincia))
+        if fechas is not None:
+            f = cod.map(fechas).astype("string")
+            if desde: m &= f.ge(desde).fillna(False)
+            if hasta: m &= f.le(hasta).fillna(False)
+        pos = np.flatnonzero(m.to_numpy(dtype=bool))
+        if not len(pos): yield hoja, df.iloc[:0]; continue
+        for i in range(0, len(pos), bloque): yield hoja, df.iloc[pos[i:i + bloque]]
+
+def _escribir_hoja(f, trozos, formato):
+    """Escribe los bloques de una hoja en `f` (archivo binario, solo escritura secuencial)."""
+    if formato == "parquet":
+        import pyarrow as pa, pyarrow.parquet as pq
+        w = None
+        try:
+            for df in trozos:
+                t = pa.Table.from_pandas(df, preserve_index=False)
+                if w is None: w = pq.ParquetWriter(f, t.schema)
+                w.write_table(t)  # un row group por bloque
+        finally:
+            if w is not None: w.close()
+        return
+    primero = True
+    for df in trozos:
+        f.write(df.to_csv(index=False, header=primero, sep=";").encode("utf-8-sig" if primero else "utf-8"))
+        primero = False
+
+@medido("accion", accion="exportar")
+def exportar_hojas(hojas, formato="csv", **filtros) -> bytes:
+    """
+    Hojas filtradas en CSV (`;`, UTF-8 con BOM para Excel) o Parquet. Una hoja → un
+    archivo; varias → un .zip con un archivo por hoja. Devuelve el archivo completo
+    (bytes): es lo que termina guardando la descarga de Streamlit.
+    """
+    ext = "parquet" if formato == "parquet" else "csv"
+    # Los bloques llegan hoja por hoja: se escriben a medida que se generan.
+    por_hoja = groupby(filas_exportacion(hojas, **filtros), key=lambda x: x[0])
+    with tempfile.SpooledTemporaryFile(max_size=16 * 2**20) as out:
+        if len(hojas) == 1:
+            for _, trozos in por_hoja: _escribir_hoja(out, (df for _, df in trozos), ext)
+        else:
+            with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as zf:
+                for hoja, trozos in por_hoja:
+                    with zf.open(f"{hoja}.{ext}", "w") as f: _escribir_hoja(f, (df for _, df in trozos), ext)
+        out.seek(0)
+        return out.read()
+
+# ===== MULTI-NODO: SINCRONIZACIÓN =====
+# Cada laptop (nodo) registra en su propio EXCEL_DIR con su NODE_ID, así que sus
+# códigos no se pisan. sincronizar_nodos() junta el maestro (este EXCEL_DIR) con
+# cualquier cantidad de nodos (carpeta, .xlsx, journal .jsonl o .sqlite3) leyendo
+# cada fuente UNA vez en streaming (openpyxl read_only / cursor SQLite / líneas):
+#  - hojas con CODIGO: una fila por código; gana el último valor no vacío en el orden
+#    de las fuentes (maestro primero) y PUNTAJE es el mayor (se anota absoluto, no se suma).
+#  - REGISTRO DE PREMIOS y hojas sin CODIGO: unión de filas; una fila repetida queda
+#    tantas veces como en la fuente que más la repite (las copias del libro base no se duplican).
+#  - visitantes repetidos (misma hoja, mismo nombre normalizado y misma cédula,
+#    teléfono o correo; típicamente uno por nodo) se fusionan en el código menor: PUNTAJE el mayor del
+#    grupo y sus premios pasan al código final. Las fusiones quedan en la hoja FUSIONES
+#    y se aplican al leer, así que volver a sincronizar da el mismo resultado.
+HOJA_FUSIONES = "FUSIONES"
+
+def _orden_codigo(c):
+    m = re.match(r"([A-Z]*)(\d*)", c)
+    return (m.group(1), int(m.group(2) or 0), c)
+
+def _vacio(v):
+    return v is None or str(v).strip() == ""
+
+def _fuente_partes(ruta: Path) -> dict:
+    """Qué leer de una ruta de nodo: {"xlsx", "journal", "sqlite"} (las que existan)."""
+    if ruta.is_dir():
+        sq = ruta / SQLITE_PATH.name
+        if sq.exists(): return {"sqlite": sq}
+        x = ruta / EXCEL_PATH.name; j = ruta / JOURNAL_PATH.name
+        if not x.exists(): x = next(iter(sorted(ruta.glob("[!.~]*.xlsx"))), x)  # otro EXCEL_FILE
+        return {"xlsx": x if x.exists() else None, "journal": j if j.exists() else None}
+    suf = ruta.suffix.lower()
+    if suf == ".sqlite3": return {"sqlite": ruta}
+    if suf == ".jsonl": return {"journal": ruta}
+    j = ruta.with_name(ruta.stem + ".journal.jsonl")
+    return {"xlsx": ruta, "journal": j if j.exists() else None}
+
+class _Combinador:
+    """Acumula las hojas de varias fuentes con las reglas de arriba."""
+    def __init__(self, alias=None):
+        self.hojas = {}; self.alias = dict(alias or {})  # CODIGO absorbido → CODIGO final
+        self._cuenta = {}  # hojas por fila: Counter de la fuente en curso
+        self.fusionados = 0
+
+    def _hoja(self, hoja, encabezados):
+        h = self.hojas.get(hoja)
+        if h is None:
+            textos = list(HEADERS.get(hoja) or encabezados)
+            cols = _nombres_columnas(textos)
+            h = self.hojas[hoja] = {"textos": textos, "cols": cols, "codigos": {}, "filas": Counter(), "muestras": {},
+                                    "por_codigo": "CODIGO" in cols and hoja != "REGISTRO DE PREMIOS"}
+        return h
+
+    def filas(self, hoja, encabezados, filas):
+        if hoja == HOJA_FUSIONES: return
+        h = self._hoja(hoja, encabezados)
+        nombres = _nombres_columnas(encabezados)
+        for n, t in zip(nombres, encabezados):  # columnas agregadas a mano: al final
+            if n not in h["cols"] and not _vacio(t): h["cols"].append(n); h["textos"].append(t)
+        cuenta = self._cuenta.setdefault(hoja, Counter())
+        for fila in filas:
+            reg = {n: v for n, v in zip(nombres, fila) if not _vacio(v)}
+            if not reg: continue
+            cod = str(reg.get("CODIGO", "")).strip().upper()
+            if cod: reg["CODIGO"] = self.alias.get(cod, cod)
+            # Un código ya fusionado solo completa lo que le falte al final (como en fusionar).
+            if h["por_codigo"] and cod: self._mezclar(h, reg["CODIGO"], reg, rellenar=cod in self.alias); continue
+            clave = tuple(sorted((n, str(v).strip()) for n, v in reg.items()))
+            h["muestras"].setdefault(clave, reg); cuenta[clave] += 1
+
+    def upsert(self, hoja, codigo, campos):
+        h = self._hoja(hoja, HEADERS.get(hoja, []))
+        cod = str(codigo).strip().upper()
+        if h["por_codigo"] and cod:
+            self._mezclar(h, self.alias.get(cod, cod), {_norm_text(k): v for k, v in campos.items() if not _vacio(v)},
+                          rellenar=cod in self.alias)
+
+    def _mezclar(self, h, cod, reg, rellenar=False):
+        actual = h["codigos"].setdefault(cod, {"CODIGO": cod})
+        for n, v in reg.items():
+            if n == "PUNTAJE": actual[n] = max(_to_int_safe(actual.get(n), 0), _to_int_safe(v, 0))
+            elif n != "CODIGO" and not (rellenar and n in actual): actual[n] = v
+
+    def fin_fuente(self):
+        for hoja, cuenta in self._cuenta.items():
+            h = self.hojas[hoja]; h["filas"] = h["filas"] | cuenta  # máximo por fila
+        self._cuenta = {}
+
+    def fusionar(self):
+        """Visitantes repetidos → código menor (unión por nombre + cédula/teléfono/correo)."""
+        nuevos = {}
+        for hoja in VISITOR_SHEETS:
+            h = self.hojas.get(hoja)
+            if not h: continue
+            m = {n: i for i, n in enumerate(h["cols"])}
+            def col(*cands):
+                i = find_col(m, *cands)
+                return None if i is None else h["cols"][i]
+            c_nom, c_ced, c_tel, c_mail = col("NOMBRE"), col("CEDULA", "RUC"), col("TELEFONO"), col("CORREO")
+            raiz, visto = {}, {}
+            def hallar(c):
+                while raiz.get(c, c) != c: c = raiz[c]
+                return c
+            for cod in sorted(h["codigos"], key=_orden_codigo):  # el menor queda como raíz
+                reg = h["codigos"][cod]; nom = _norm_text(reg.get(c_nom))
+                if not nom: continue
+                for campo, norm in ((c_ced, norm_id), (c_tel, norm_phone), (c_mail, norm_email)):
+                    v = norm(str(reg.get(campo) or "")) if campo else ""
+                    if not v: continue
+                    otro = visto.setdefault((campo, nom, v), cod)
+                    a, b = hallar(otro), hallar(cod)
+                    if a != b: raiz[max(a, b, key=_orden_codigo)] = min(a, b, key=_orden_codigo)
+            for cod in list(raiz):
+                fin = hallar(cod); nuevos[cod] = fin
+                self._mezclar(h, fin, h["codigos"].pop(cod), rellenar=True)
+        if not nuevos: return
+        self.fusionados = len(nuevos)
+        self.alias = {a: nuevos.get(f, f) for a, f in self.alias.items()} | nuevos
+        reg = self.hojas.get("REGISTRO DE CODIGOS")
+        for cod, fin in (nuevos.items() if reg else ()):
+            if cod in reg["codigos"]: self._mezclar(reg, fin, reg["codigos"].pop(cod), rellenar=True)
+        pre = self.hojas.get("REGISTRO DE PREMIOS")
+        if pre:  # premios de códigos distintos son entregas distintas: se suman
+            filas, muestras = Counter(), {}
+            for clave, n in pre["filas"].items():
+                r = dict(pre["muestras"][clave])
+                if r.get("CODIGO") in nuevos: r["CODIGO"] = nuevos[r["CODIGO"]]
+                k = tuple(sorted((c, str(v).strip()) for c, v in r.items()))
+                muestras.setdefault(k, r); filas[k] += n
+            pre.update(filas=filas, muestras=muestras)
+
+    def escribir(self, destino, seq):
+        wb = Workbook(write_only=True); total = {}
+        for hoja in [*HEADERS, *self.hojas]:
+            h = self.hojas.get(hoja)
+            if h is None or hoja in total: continue
+            ws = wb.create_sheet(hoja); ws.append(h["textos"])
+            for cod in sorted(h["codigos"], key=_orden_codigo):
+                r = h["codigos"][cod]; ws.append([r.get(n) for n in h["cols"]])
+            for clave, n in h["filas"].items():
+                fila = [h["muestras"][clave].get(c) for c in h["cols"]]
+                for _ in range(n): ws.append(fila)
+            total[hoja] = len(h["codigos"]) + sum(h["filas"].values())
+        if self.alias:
+            ws = wb.create_sheet(HOJA_FUSIONES); ws.append(["CODIGO", "CODIGO FINAL"])
+            for a in sorted(self.alias, key=_orden_codigo): ws.append([a, self.alias[a]])
+        _set_wb_journal_seq(wb, seq)
+        wb.save(destino)
+        return total
+
+def _leer_fusiones(data: bytes) -> dict:
+    wb = load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+    try:
+        if HOJA_FUSIONES not in wb.sheetnames: return {}
+        filas = wb[HOJA_FUSIONES].iter_rows(min_row=2, values_only=True)
+        return {str(a).strip().upper(): str(f).strip().upper() for a, f, *_ in filas if a and f}
+    finally: wb.close()
+
+def _leer_fuente(partes: dict, comb: _Combinador) -> int:
+    """Una pasada por la fuente: libro (o SQLite) y luego sus eventos aún no volcados. Devuelve su JOURNAL_SEQ."""
+    seq = 0; heads = {}
+    if partes.get("sqlite"):
+        conn = sqlite3.connect(f"file:{partes['sqlite']}?mode=ro", uri=True)
+        try:
+            for hoja, cols in conn.execute("SELECT hoja, columnas FROM encabezados ORDER BY orden").fetchall():
+                comb.filas(hoja, json.loads(cols), (json.loads(d) for (d,) in
+                           conn.execute("SELECT datos FROM filas WHERE hoja=? ORDER BY id", (hoja,))))
+        finally: conn.close()
+    if partes.get("xlsx"):
+        wb = safe_load_workbook(partes["xlsx"], read_only=True, data_only=True)
+        try:
+            seq = _wb_journal_seq(wb)
+            for hoja in wb.sheetnames:
+                filas = wb[hoja].iter_rows(values_only=True)
+                heads[hoja] = list(next(filas, ()))
+                comb.filas(hoja, heads[hoja], filas)
+        finally: wb.close()
+    if partes.get("journal"):
+        with open(partes["journal"], encoding="utf-8") as f:
+            for linea in f:
+                try: e = json.loads(linea)
+                except ValueError: continue  # última línea a medio escribir
+                if e.get("seq", 0) <= seq: continue
+                if e["op"] == "append": comb.filas(e["sheet"], heads.get(e["sheet"]) or HEADERS.get(e["sheet"], []), [e["values"]])
+                else: comb.upsert(e["sheet"], e["codigo"], e["fields"])
+    comb.fin_fuente()
+    return seq
+
+def sincronizar_nodos(rutas, salida=None) -> dict:
+    """
+    Junta el maestro con los nodos `rutas` (ver arriba). Con `salida` solo escribe ese
+    .xlsx; si no, reemplaza los datos del maestro como una carga y reconcilia los
+    contadores. Devuelve {"fuentes", "fusionados", "filas": {hoja: n}}.
+    """
+    be = storage()
+    ruta = be.export_xlsx()
+    if ruta is None: raise PermissionError("El Excel maestro está bloqueado; intenta de nuevo.")
+    data = Path(ruta).read_bytes()
+    comb = _Combinador(_leer_fusiones(data))
+    seq = _leer_fuente({"xlsx": io.BytesIO(data)}, comb)  # ya incluye su journal
+    for r in rutas: _leer_fuente(_fuente_partes(Path(r)), comb)
+    comb.fusionar()
+    # JOURNAL_SEQ del maestro: lo registrado mientras tanto sigue en su journal y se aplica encima.
+    buf = io.BytesIO(); total = comb.escribir(buf, seq)
+    if salida: Path(salida).write_bytes(buf.getvalue())
+    else:
+        be.replace_from_xlsx(buf.getvalue()); reconcile_counters()
+    return {"fuentes": 1 + len(rutas), "fusionados": comb.fusionados, "filas": total}
 
 # ===== CONSULTAS / CARGA DE REGISTROS =====
 def _to_int_safe(x, default=0):
     try: return int(x) if x is not None and str(x).strip() != "" else default
     except: return default
 
-@st.cache_data(show_spinner=False)
-def load_registros_codigos(path_str: str, mtime: float):
-    try:
-        wb = safe_load_workbook(Path(path_str), read_only=True, data_only=True)
-        if "REGISTRO DE CODIGOS" not in wb.sheetnames: return []
-        ws = wb["REGISTRO DE CODIGOS"]
-        hmap = header_map(ws)
-        ci_cod = find_col(hmap, "CODIGO")
-        ci_pun = find_col(hmap, "PUNTAJE")
-        ci_ced = find_col(hmap, "RUC O CEDULA")
-        ci_nom = find_col(hmap, "NOMBRE")
-        ci_tel = find_col(hmap, "TELEFONO")
-        ci_tip = find_col(hmap, "TIPO")
-        ci_sta = find_col(hmap, "STAND")
-        rows=[]
-        for r in ws.iter_rows(min_row=2, values_only=True):
-            if not r: continue
-            rows.append({
-                "CODIGO": str((r[ci_cod] if ci_cod is not None else "") or "").strip(),
-                "PUNTAJE": _to_int_safe(r[ci_pun] if ci_pun is not None else 0, 0),
-                "RUC O CEDULA": str((r[ci_ced] if ci_ced is not None else "") or "").strip(),
-                "NOMBRE": str((r[ci_nom] if ci_nom is not None else "") or "").strip(),
-                "TELEFONO": str((r[ci_tel] if ci_tel is not None else "") or "").strip(),
-                "TIPO": str((r[ci_tip] if ci_tip is not None else "") or "").strip(),
-                "STAND": str((r[ci_sta] if ci_sta is not None else "") or "").strip(),
-            })
-        return rows
-    except: return []
-
-@st.cache_data(show_spinner=False)
-def load_registros_premios(path_str: str, mtime: float):
-    try:
-        wb = safe_load_workbook(Path(path_str), read_only=True, data_only=True)
-        if "REGISTRO DE PREMIOS" not in wb.sheetnames: return []
-        ws = wb["REGISTRO DE PREMIOS"]
-        hmap = header_map(ws)
-        ci_cod = find_col(hmap, "CODIGO")
-        ci_pre = find_col(hmap, "PREMIO")
-        ci_ced = find_col(hmap, "RUC O CEDULA")
-        ci_nom = find_col(hmap, "NOMBRE")
-        ci_tel = find_col(hmap, "TELEFONO")
-        ci_tip = find_col(hmap, "TIPO")
-        ci_sta = find_col(hmap, "STAND")
-        rows=[]
-        for r in ws.iter_rows(min_row=2, values_only=True):
-            if not r: continue
-            rows.append({
-                "CODIGO": str((r[ci_cod] if ci_cod is not None else "") or "").strip(),
-                "PREMIO": str((r[ci_pre] if ci_pre is not None else "") or "").strip(),
-                "RUC O CEDULA": str((r[ci_ced] if ci_ced is not None else "") or "").strip(),
-                "NOMBRE": str((r[ci_nom] if ci_nom is not None else "") or "").strip(),
-                "TELEFONO": str((r[ci_tel] if ci_tel is not None else "") or "").strip(),
-                "TIPO": str((r[ci_tip] if ci_tip is not None else "") or "").strip(),
-                "STAND": str((r[ci_sta] if ci_sta is not None else "") or "").strip(),
-            })
-        return rows
-    except: return []
+# Perfil por código: {"ced","nom","tel","tipo","stand","puntaje","registro"}.
+# REGISTRO DE CODIGOS manda (y conserva su orden); los visitantes completan lo
+# vacío (STAND, tipo = hoja).
+_PERFIL_CAMPOS = (("ced", ("CEDULA", "RUC")), ("nom", ("NOMBRE",)), ("tel", ("TELEFONO",)),
+                  ("tipo", ("TIPO",)), ("stand", ("STAND",)))
+_REGISTRO_CAMPOS = {"RUC O CEDULA": "ced", "NOMBRE": "nom", "TELEFONO": "tel", "TIPO": "tipo", "STAND": "stand"}
+
+def _perfil_nuevo(registro: bool) -> dict:
+    return {"ced": "", "nom": "", "tel": "", "tipo": "", "stand": "", "puntaje": 0, "registro": registro}
+
+def _perfil_cols(hmap):
+    return [(k, find_col(hmap, *cands)) for k, cands in _PERFIL_CAMPOS]
+
+def _perfil_completar(p, hoja, cols, r):
+    for k, ci in cols:
+        if not p[k] and ci is not None and ci < len(r) and r[ci] is not None:
+            v = str(r[ci]).strip(); p[k] = v.upper() if k == "stand" else v
+    if not p["tipo"] and hoja in VISITOR_SHEETS: p["tipo"] = hoja
+
+def _perfiles_construir():
+    # Por columnas: cada hoja aporta una tabla (cod, campos…) y, por código, cada
+    # campo toma el primer valor no vacío (registro primero, luego los visitantes).
+    hojas = ("REGISTRO DE CODIGOS",) + VISITOR_SHEETS
+    frames, seq = storage().frames(hojas)
+    partes = []
+    for sheet in hojas:
+        df = frames.get(sheet)
+        if df is None or find_col(frame_hmap(df), "CODIGO") is None: continue
+        reg = sheet == "REGISTRO DE CODIGOS"
+        t = pd.DataFrame({"cod": texto_col(df, "CODIGO").str.upper()})
+        for k, cands in _PERFIL_CAMPOS: t[k] = texto_col(df, *cands)
+        t["stand"] = t["stand"].str.upper()
+        if sheet in VISITOR_SHEETS: t["tipo"] = t["tipo"].mask(t["tipo"] == "", sheet)
+        ci_pun = find_col(frame_hmap(df), "PUNTAJE")
+        t["puntaje"] = pd.to_numeric(df.iloc[:, ci_pun], errors="coerce") if reg and ci_pun is not None else pd.NA
+        t["registro"] = reg
+        t = t[t["cod"] != ""]
+        if reg: t = t.drop_duplicates("cod")  # código repetido en el registro: vale la primera fila
+        partes.append(t)
+    if not partes: return {}, seq
+    g = pd.concat(partes, ignore_index=True).replace("", pd.NA).groupby("cod", sort=False).first()
+    puntajes = pd.to_numeric(g.pop("puntaje"), errors="coerce").fillna(0).astype(int).tolist()
+    registro = g.pop("registro").astype(bool).tolist()
+    g = g.astype(object).fillna("")
+    return {cod: {**fila, "puntaje": pun, "registro": reg}
+            for (cod, fila), pun, reg in zip(g.to_dict("index").items(), puntajes, registro)}, seq
+
+def _perfiles_aplicar(perfiles, e):
+    if e["op"] == "upsert" and e["sheet"] == "REGISTRO DE CODIGOS":
+        p = perfiles.setdefault(e["codigo"], _perfil_nuevo(True))
+        p["registro"] = True
+        for h, v in e["fields"].items():
+            h = _norm_text(h)
+            if h == "PUNTAJE": p["puntaje"] = _to_int_safe(v, 0)
+            elif h in _REGISTRO_CAMPOS and str(v or "").strip():
+                p[_REGISTRO_CAMPOS[h]] = str(v).strip().upper() if h == "STAND" else str(v).strip()
+    elif e["op"] == "append" and e["sheet"] in VISITOR_SHEETS:
+        hmap = _headers_hmap(e["sheet"]); ci = find_col(hmap, "CODIGO")
+        cod = str(e["values"][ci] or "").strip().upper() if ci is not None and ci < len(e["values"]) else ""
+        if cod: _perfil_completar(perfiles.setdefault(cod, _perfil_nuevo(False)), e["sheet"], _perfil_cols(hmap), e["values"])
+
+def _perfiles_actuales() -> dict:
+    """Perfiles tal como están (sin ponerlos al día): para parchar otras vistas."""
+    v = _vistas_state()["vistas"].get("perfiles")
+    return v["obj"] if v else {}
+
+def perfil(codigo):
+    """Copia del perfil de `codigo`, o None si no existe."""
+    with _vistas_state()["lock"]:
+        p = obtener_vista("perfiles").get(str(codigo or "").strip().upper())
+        return dict(p) if p else None
+
+def perfiles_registrados() -> dict:
+    """CODIGO → perfil (copias) de los códigos de REGISTRO DE CODIGOS, en su orden."""
+    with _vistas_state()["lock"]:
+        return {c: dict(p) for c, p in obtener_vista("perfiles").items() if p["registro"]}
+
+def campos_registro(p: dict) -> dict:
+    """Campos de REGISTRO DE CODIGOS a partir de un perfil."""
+    return {"RUC O CEDULA": p["ced"], "NOMBRE": p["nom"], "TELEFONO": p["tel"], "TIPO": p["tipo"], "STAND": p["stand"]}
+
+def _fila_codigo(cod, p) -> dict:
+    return {"CODIGO": cod, "PUNTAJE": p["puntaje"], "RUC O CEDULA": p["ced"], "NOMBRE": p["nom"],
+            "TELEFONO": p["tel"], "TIPO": p["tipo"], "STAND": p["stand"]}
+
+def load_registros_codigos() -> list:
+    return [_fila_codigo(c, p) for c, p in perfiles_registrados().items()]
+
+_PREMIO_CAMPOS = ("CODIGO","PREMIO","RUC O CEDULA","NOMBRE","TELEFONO","TIPO","STAND")
+
+def _premio_fila(cols, r, perfiles) -> dict:
+    fila = {k: str(r[ci] or "").strip() if ci is not None and ci < len(r) and r[ci] is not None else ""
+            for k, ci in cols}
+    p = perfiles.get(fila["CODIGO"].upper())
+    if p and not fila["STAND"]: fila["STAND"] = p["stand"]
+    return fila
+
+def _premios_construir():
+    perfiles = obtener_vista("perfiles")
+    frames, seq = storage().frames(("REGISTRO DE PREMIOS",))
+    df = frames.get("REGISTRO DE PREMIOS")
+    cols = [(k, find_col(_headers_hmap("REGISTRO DE PREMIOS") if df is None else frame_hmap(df), k))
+            for k in _PREMIO_CAMPOS]
+    if df is None or not len(df): return {"filas": [], "cols": cols}, seq
+    t = pd.DataFrame({k: texto_col(df, k) for k in _PREMIO_CAMPOS})
+    stand = t["CODIGO"].str.upper().map({c: p["stand"] for c, p in perfiles.items()}).fillna("")
+    t["STAND"] = t["STAND"].mask(t["STAND"] == "", stand)
+    con_datos = (df.astype("string").fillna("") != "").any(axis=1)
+    return {"filas": t[con_datos].astype(object).to_dict("records"), "cols": cols}, seq
+
+def _premios_aplicar(d, e):
+    if e["op"] == "append" and e["sheet"] == "REGISTRO DE PREMIOS":
+        d["filas"].append(_premio_fila(d["cols"], e["values"], _perfiles_actuales()))
+
+def load_registros_premios() -> list:
+    with _vistas_state()["lock"]:
+        return list(obtener_vista("premios")["filas"])
 
 def _norm_matchable(s: str) -> str:
     s = (s or "").strip().upper()
@@ -376,17 +2981,153 @@ def _norm_matchable(s: str) -> str:
            .replace("Ó","O").replace("Ú","U").replace("Ü","U").replace("Ñ","N"))
     return re.sub(r"\s+"," ", s)
 
-def filtrar_por_query(rows: list, q: str, campos=("CODIGO","RUC O CEDULA","NOMBRE","TELEFONO","STAND")):
-    if not q: return rows
-    qq = _norm_matchable(q)
-    out=[]
-    for row in rows:
-        hit=False
-        for c in campos:
-            if _norm_matchable(str(row.get(c,""))).find(qq) != -1:
-                hit=True; break
-        if hit: out.append(row)
-    return out
+# ===== ÍNDICE DE BÚSQUEDA (Consulta) =====
+# Campos normalizados una sola vez por versión de datos + índice invertido de
+# trigramas: una búsqueda intersecta las listas de sus trigramas y solo verifica
+# esas filas, en vez de normalizar todo en cada tecla. Las búsquedas de 1-2 letras
+# recorren el texto ya normalizado (sin volver a normalizar).
+SEARCH_FIELDS = ("CODIGO","RUC O CEDULA","NOMBRE","TELEFONO","STAND")
+PAGE_SIZE = 50
+
+class SearchIndex:
+    def __init__(self, rows: list, campos=SEARCH_FIELDS):
+        self.campos = campos
+        self.rows, self.norm, self.texto, self.grams = [], [], [], {}
+        for r in rows: self.add(r)
+
+    def _indexar(self, i, row):
+        self.norm[i] = tuple(_norm_matchable(str(row.get(c,"") or "")) for c in self.campos)
+        # Campos unidos por \x00: ningún trigrama útil cruza de un campo a otro.
+        t = self.texto[i] = "\x00".join(self.norm[i])
+        for g in {t[k:k+3] for k in range(len(t)-2)}:
+            if "\x00" in g: continue
+            lista = self.grams.setdefault(g, [])
+            if not lista or lista[-1] < i: lista.append(i)  # listas siempre ordenadas
+            else:
+                j = bisect_left(lista, i)
+                if j == len(lista) or lista[j] != i: lista.insert(j, i)
+
+    def add(self, row):
+        self.rows.append(row); self.norm.append(()); self.texto.append("")
+        self._indexar(len(self.rows) - 1, row)
+
+    def replace(self, i, row):
+        """Las entradas viejas de la fila quedan en el índice y se descartan al verificar."""
+        self.rows[i] = row; self._indexar(i, row)
+
+    def _candidatos(self, qq):
+        if len(qq) < 3: return [i for i, t in enumerate(self.texto) if qq in t]
+        if len(qq) == 3: return self.grams.get(qq, [])
+        listas = sorted((self.grams.get(qq[k:k+3], []) for k in range(len(qq)-2)), key=len)
+        def en(lista, i):
+            j = bisect_left(lista, i); return j < len(lista) and lista[j] == i
+        return [i for i in listas[0] if all(en(l, i) for l in listas[1:])]
+
+    def search(self, q: str) -> list:
+        """
+        Índices de filas que contienen `q` en algún campo, ordenados por relevancia:
+        igual > empieza por > empieza una palabra > contiene; luego por campo
+        (código primero) y por el orden de las filas.
+        """
+        qq = _norm_matchable(q)
+        if not qq: return list(range(len(self.rows)))
+        hits = []
+        for i in self._candidatos(qq):
+            mejor = None
+            for c, f in enumerate(self.norm[i]):
+                if qq not in f: continue
+                tipo = 0 if f == qq else 1 if f.startswith(qq) else 2 if (" " + qq) in f else 3
+                if mejor is None or (tipo, c) < mejor: mejor = (tipo, c)
+            if mejor is not None: hits.append((mejor, i))
+        hits.sort()
+        return [i for _, i in hits]
+
+    def page(self, ids: list, pagina: int) -> list:
+        return [self.rows[i] for i in ids[(pagina-1)*PAGE_SIZE: pagina*PAGE_SIZE]]
+
+def _busqueda_codigos_construir():
+    perfiles = obtener_vista("perfiles")
+    filas = [_fila_codigo(c, p) for c, p in perfiles.items() if p["registro"]]
+    return {"idx": SearchIndex(filas), "pos": {f["CODIGO"]: i for i, f in enumerate(filas)}}, _vista_seq("perfiles")
+
+def _busqueda_codigos_aplicar(d, e):
+    if e["op"] != "upsert" or e["sheet"] != "REGISTRO DE CODIGOS": return
+    p = _perfiles_actuales().get(e["codigo"])
+    if p is None: return
+    fila = _fila_codigo(e["codigo"], p); i = d["pos"].get(e["codigo"])
+    if i is None: d["pos"][e["codigo"]] = len(d["idx"].rows); d["idx"].add(fila)
+    else: d["idx"].replace(i, fila)
+
+def _busqueda_premios_construir():
+    return SearchIndex(obtener_vista("premios")["filas"]), _vista_seq("premios")
+
+def _busqueda_premios_aplicar(idx, e):
+    if e["op"] == "append" and e["sheet"] == "REGISTRO DE PREMIOS":
+        idx.add(_premio_fila(_vistas_state()["vistas"]["premios"]["obj"]["cols"], e["values"], _perfiles_actuales()))
+
+@medido("accion", accion="buscar")
+def buscar(kind: str, q: str):
+    """kind: "codigos" | "premios". Devuelve (índice, ids ordenados por relevancia)."""
+    with _vistas_state()["lock"]:
+        idx = obtener_vista("busqueda_codigos")["idx"] if kind == "codigos" else obtener_vista("busqueda_premios")
+        return idx, idx.search(q)
+
+# ===== TABLA DE POSICIONES (Top N) =====
+# Listas ordenadas por (-PUNTAJE, CODIGO) por grupo (STAND, TIPO); "" = todos. Se
+# construyen una vez (o tras una carga de Excel) y luego cada upsert de REGISTRO
+# DE CODIGOS mueve solo su código: leer el Top N cuesta O(N), no ordenar todo.
+# Es la vista "ranking" (se construye desde "perfiles").
+def _ranking_grupos(fila):
+    return {("", ""), (fila["STAND"], ""), ("", fila["TIPO"]), (fila["STAND"], fila["TIPO"])}
+
+def _ranking_set(rs, codigo, fila):
+    """Reubica `codigo` en las listas de sus grupos (quita la clave vieja e inserta la nueva)."""
+    vieja = rs["filas"].get(codigo)
+    if vieja is not None:
+        clave = (-vieja["PUNTAJE"], codigo)
+        for g in _ranking_grupos(vieja):
+            lista = rs["grupos"].get(g, [])
+            i = bisect_left(lista, clave)
+            if i < len(lista) and lista[i] == clave: del lista[i]
+    rs["filas"][codigo] = fila
+    for g in _ranking_grupos(fila): insort(rs["grupos"].setdefault(g, []), (-fila["PUNTAJE"], codigo))
+
+def _ranking_construir():
+    # Un solo ordenamiento por columnas y un recorrido: cada grupo queda ordenado.
+    filas = [_fila_codigo(c, p) for c, p in obtener_vista("perfiles").items() if p["registro"]]
+    rs = {"filas": {f["CODIGO"]: f for f in filas}, "grupos": {}}
+    if filas:
+        df = pd.DataFrame(filas, columns=["CODIGO","PUNTAJE","STAND","TIPO"])
+        df = df.sort_values(["PUNTAJE","CODIGO"], ascending=[False, True], kind="stable")
+        for cod, pun, stand, tipo in df.itertuples(index=False):
+            for g in _ranking_grupos({"STAND": stand, "TIPO": tipo}):
+                rs["grupos"].setdefault(g, []).append((-int(pun), cod))
+    return rs, _vista_seq("perfiles")
+
+def _ranking_aplicar(rs, e):
+    if e["op"] == "upsert" and e["sheet"] == "REGISTRO DE CODIGOS":
+        p = _perfiles_actuales().get(e["codigo"])
+        if p is not None: _ranking_set(rs, e["codigo"], _fila_codigo(e["codigo"], p))
+
+def top_puntajes(n=10, stand=None, tipo=None, desde=0) -> list:
+    """Top `n` por puntaje (opcional: por STAND o por TIPO), a partir de la posición `desde`."""
+    with _vistas_state()["lock"]:
+        rs = obtener_vista("ranking")
+        lista = rs["grupos"].get((stand or "", tipo or ""), [])
+        return [dict(rs["filas"][cod]) for _, cod in lista[desde:desde+n]]
+
+def total_puntajes(stand=None, tipo=None) -> int:
+    with _vistas_state()["lock"]:
+        return len(obtener_vista("ranking")["grupos"].get((stand or "", tipo or ""), []))
+
+VISTAS = {
+    "perfiles":         (_perfiles_construir, _perfiles_aplicar),
+    "duplicados":       (_dup_construir, _dup_aplicar),
+    "premios":          (_premios_construir, _premios_aplicar),
+    "busqueda_codigos": (_busqueda_codigos_construir, _busqueda_codigos_aplicar),
+    "busqueda_premios": (_busqueda_premios_construir, _busqueda_premios_aplicar),
+    "ranking":          (_ranking_construir, _ranking_aplicar),
+}
 
 # ===== UI HELPERS =====
 def big_code_banner():
@@ -397,6 +3138,161 @@ def big_code_banner():
             f"<div style='font-size:48px;font-weight:900;color:#e65100'>{st.session_state['_last_code']}</div>"
             f"</div>", unsafe_allow_html=True
         )
+        estado_guardado()
+
+def pestanas(nombres, key):
+    """st.tabs que sigue la pestaña activa (on_change="rerun"); en versiones sin soporte, st.tabs normal."""
+    try: return st.tabs(nombres, key=key, on_change="rerun")
+    except TypeError: return st.tabs(nombres)
+
+def abierta(tab) -> bool:
+    """¿Correr el cuerpo de `tab`? Solo si es la activa (o si st.tabs no lo sabe: .open es None)."""
+    return getattr(tab, "open", None) is not False
+
+def conservar_estado(*keys):
+    """Un widget que no se dibuja en un rerun pierde su valor: re-asignarlo lo conserva."""
+    for k in keys:
+        if k in st.session_state: st.session_state[k] = st.session_state[k]
+
+def _fragmento(run_every=None):
+    """st.fragment (o el experimental de versiones anteriores); sin él, función normal."""
+    frag = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None)
+    return frag(run_every=run_every) if frag else (lambda fn: fn)
+
+@_fragmento(run_every=2)
+def estado_guardado():
+    """Estado del último registro: confirmado en el journal (pendiente) o ya en el Excel."""
+    seq = st.session_state.get("_last_seq")
+    if not seq: return
+    try: be = storage(); listo = be.volcado(seq)
+    except Exception: return
+    if listo: st.caption("📗 Guardado en el Excel." if be.name == "excel" else "📗 Guardado en la base de datos.")
+    else: st.caption("⏳ Registro confirmado; se vuelca al Excel en unos segundos.")
+
+def marcar_registrado(codigo):
+    """Código para el banner + último seq confirmado (≥ el del registro) para el indicador."""
+    st.session_state["_last_code"] = codigo
+    try: st.session_state["_last_seq"] = storage().last_seq()
+    except Exception: st.session_state.pop("_last_seq", None)
+
+def cedula_en_vivo(label, key):
+    """Cédula fuera del formulario: al escribirla se avisa de duplicados antes de guardar."""
+    val = st.text_input(label, key=key)
+    if len(norm_id(val)) >= 10:
+        alerta_duplicados(buscar_duplicados(val, "", ""), "Cédula/RUC")
+    return val
+
+def _geo_elegido(key, claves):
+    r = st.session_state.get(f"{key}_sel")
+    if not r: return
+    for k, v in zip(claves, r): st.session_state[k] = v
+    st.session_state[f"{key}_q"] = ""; st.session_state[f"{key}_sel"] = None
+
+def ubicacion_rapida(key, claves, cat):
+    """Buscador fuera del formulario: elegir un cantón o parroquia completa provincia/cantón/parroquia."""
+    q = st.text_input("🔎 Buscar parroquia o cantón", key=f"{key}_q", placeholder="Ej.: TARQUI, MANTA…")
+    hits = cat.buscar(q) if q.strip() else []
+    if q.strip() and not hits: st.caption("Sin coincidencias en el catálogo.")
+    if hits:
+        st.selectbox("Coincidencias", [None] + hits, key=f"{key}_sel", on_change=_geo_elegido, args=(key, claves),
+                     format_func=lambda r: "" if r is None else (f"{r[2]} — {r[1]}, {r[0]}" if r[2] else f"{r[1]} (cantón), {r[0]}"))
+
+def tabla_paginada(total: int, pagina_de, key: str, height=360):
+    """`pagina_de(pagina)` devuelve solo las filas de esa página."""
+    paginas = max(1, -(-total // PAGE_SIZE))
+    pagina = 1
+    if paginas > 1:
+        pagina = int(st.number_input(f"Página (de {paginas})", 1, paginas, 1, key=key))
+    st.caption(f"{total} resultado(s)")
+    st.dataframe(tabla(pagina_de(pagina)), use_container_width=True, height=height)
+
+def tabla(filas: list) -> pd.DataFrame:
+    """Filas (dicts) → DataFrame tipado: texto como texto (sin formato numérico), PUNTAJE entero."""
+    return _tipar(pd.DataFrame.from_records(filas)) if filas else pd.DataFrame()
+
+def importacion_masiva(hoja):
+    """Carga de pre-registros (CSV/XLSX) para una hoja de visitantes; el informe queda en la sesión."""
+    with st.expander("📥 Importación masiva (CSV / XLSX)", expanded=False):
+        st.caption("Una fila por visitante con los encabezados del Excel (el CÓDIGO se asigna solo). "
+                   "Obligatorios: nombre, cédula/RUC, teléfono y STAND (" + " o ".join(STANDS) + ").")
+        plantilla = ";".join(dict.fromkeys(HEADERS[hoja][1:])) + "\n"
+        st.download_button("⬇️ Plantilla CSV", plantilla.encode("utf-8-sig"),
+                           file_name=f"plantilla_{hoja.lower()}.csv", key=f"imp_tpl_{hoja}")
+        up = st.file_uploader("Archivo de pre-registros", type=["csv", "xlsx"], key=f"imp_up_{hoja}")
+        if up is not None and st.button("Importar", key=f"imp_btn_{hoja}"):
+            try: st.session_state[f"imp_informe_{hoja}"] = (up.name, importar_visitantes(hoja, up.name, up.getvalue()))
+            except ValueError as e: st.error(f"❗ {e}")
+            except Exception as e: st.error(f"❗ No se pudo importar (no se guardó nada): {e}")
+        if f"imp_informe_{hoja}" not in st.session_state: return
+        archivo, informe = st.session_state[f"imp_informe_{hoja}"]
+        ok = sum(f["ESTADO"].startswith("✅") for f in informe)
+        rechazos = [f for f in informe if f["ESTADO"].startswith("❌")]
+        if ok: st.success(f"✅ {ok} registro(s) de {archivo} importado(s) en una sola escritura.")
+        if rechazos: st.warning(f"⚠️ {len(rechazos)} fila(s) rechazada(s); revisa el detalle o descarga el informe.")
+        if not informe: st.info("El archivo no tiene filas.")
+        if rechazos: st.dataframe(tabla(rechazos[:500]), use_container_width=True, height=300)
+        if informe:
+            st.download_button("⬇️ Informe de importación (CSV)",
+                               pd.DataFrame(informe).to_csv(index=False, sep=";").encode("utf-8-sig"),
+                               file_name=f"informe_importacion_{hoja.lower()}.csv", key=f"imp_inf_{hoja}")
+
+# data=callable (Streamlit reciente): el archivo se genera al hacer clic, en otro hilo.
+_DESCARGA_DIFERIDA = "callable" in (st.download_button.__doc__ or "")
+
+def exportacion_filtrada(provs):
+    """Exportación por hojas y filtros; el archivo se arma por bloques desde la capa columnar."""
+    with st.expander("📤 Exportar hojas (CSV / Parquet)", expanded=False):
+        hojas = st.multiselect("Hojas", list(EXPORT_HOJAS), default=["CONSUMIDOR"], key="exp_hojas")
+        formato = st.radio("Formato", ["CSV"] + (["Parquet"] if _hay_parquet() else []),
+                           horizontal=True, key="exp_formato").lower()
+        c1, c2, c3 = st.columns(3)
+        stand = c1.selectbox("Stand", ["Todos", *STANDS], key="exp_stand")
+        tipo = c2.selectbox("Tipo", ["Todos", *VISITOR_SHEETS], key="exp_tipo")
+        prov = c3.selectbox("Provincia", ["Todas", *provs], key="exp_prov") if provs else c3.text_input("Provincia", key="exp_prov")
+        c4, c5 = st.columns(2)
+        desde = c4.date_input("Registrados desde", value=None, key="exp_desde")
+        hasta = c5.date_input("Registrados hasta", value=None, key="exp_hasta")
+        st.caption("Las fechas son la FECHA REGISTRO del código; los registros sin fecha quedan fuera al filtrar por fecha.")
+        if not hojas: return
+        filtros = {"stand": None if stand == "Todos" else stand, "tipo": None if tipo == "Todos" else tipo,
+                   "provincia": None if prov in ("Todas", "") else prov,
+                   "desde": f"{desde} 00:00:00" if desde else None, "hasta": f"{hasta} 23:59:59" if hasta else None}
+        if len(hojas) > 1: nombre, mime = f"exportacion_expo_{formato}.zip", "application/zip"
+        else: nombre, mime = f"{hojas[0].lower().replace(' ', '_')}.{formato}", {"csv": "text/csv"}.get(formato, "application/octet-stream")
+        generar = lambda: exportar_hojas(list(hojas), formato, **filtros)
+        if _DESCARGA_DIFERIDA:
+            st.download_button("⬇️ Exportar", generar, file_name=nombre, mime=mime, key="exp_down")
+        elif st.button("Preparar exportación", key="exp_prep"):
+            st.download_button("⬇️ Exportar", generar(), file_name=nombre, mime=mime, key="exp_down")
+
+def es_admin() -> bool:
+    """Panel oculto: ?admin=<ADMIN_TOKEN>. Sin ADMIN_TOKEN configurado queda cerrado."""
+    val = st.query_params.get("admin")
+    return bool(ADMIN_TOKEN) and bool(val) and hmac.compare_digest(str(val), ADMIN_TOKEN)
+
+def panel_metricas():
+    r = resumen_metricas(); m = _metricas()
+    with st.expander("📊 Métricas operativas (admin)", expanded=True):
+        st.caption(f"Proceso {os.getpid()} · ventana {int(METRICAS_VENTANA)} s · "
+                   f"desde {time.strftime('%H:%M:%S', time.localtime(m['desde']))} · "
+                   f"{storage().pending()} cambio(s) pendientes")
+        acciones = [f for f in r["tiempos"] if f["metrica"] == "accion"]
+        if acciones:
+            st.markdown("**Latencia por acción (p50 / p95)**")
+            st.dataframe(pd.DataFrame(acciones).drop(columns="metrica"), use_container_width=True, hide_index=True)
+        io_ = [f for f in r["tiempos"] if f["metrica"] != "accion"]
+        if io_:
+            st.markdown("**E/S y cachés**")
+            st.dataframe(pd.DataFrame(io_), use_container_width=True, hide_index=True)
+        if r["contadores"]:
+            st.markdown("**Contadores**")
+            st.dataframe(pd.DataFrame(r["contadores"]), use_container_width=True, hide_index=True)
+        if not (r["tiempos"] or r["contadores"]): st.info("Aún no hay métricas en este proceso.")
+        col1, col2 = st.columns(2)
+        col1.download_button("⬇️ Prometheus (texto)", metricas_prometheus(), file_name="expo_metricas.prom",
+                             mime="text/plain", key="met_prom")
+        col2.download_button("⬇️ JSON lines", metricas_jsonl(), file_name="expo_metricas.jsonl",
+                             mime="application/x-ndjson", key="met_jsonl")
 
 def clear_and_rerun(keys):
     for k in keys: st.session_state.pop(k, None)
@@ -404,379 +3300,372 @@ def clear_and_rerun(keys):
     elif hasattr(st,"experimental_rerun"): st.experimental_rerun()
 
 # ===== APP =====
-st.title("FORMULARIO DATOS EXPO FERIA")
-st.caption(f"Excel (servidor): **{EXCEL_PATH}**")
-big_code_banner()
-
-# --- Gestor de Excel en la nube: subir/descargar ---
-with st.expander("📁 Excel en el servidor", expanded=False):
-    up = st.file_uploader("Cargar/actualizar Excel (.xlsx)", type=["xlsx"], key="excel_up")
-    if up is not None:
-        with open(EXCEL_PATH, "wb") as f:
-            f.write(up.getbuffer())
-        st.success(f"Excel cargado/actualizado en: {EXCEL_PATH}")
-        if hasattr(st, "rerun"): st.rerun()
-    if EXCEL_PATH.exists():
-        with open(EXCEL_PATH, "rb") as f:
-            st.download_button("⬇️ Descargar Excel actual", f, file_name=EXCEL_PATH.name, key="excel_down")
-    else:
-        st.info("Aún no hay Excel. Se creará automáticamente al guardar el primer registro.")
-
-prov_index = load_province_index(str(EXCEL_PATH), _mtime(EXCEL_PATH))
-provs = sorted(prov_index.keys())
-
-# Tabs (incluye "Consulta")
-tabs = st.tabs(["Mecánico","Distribuidor","Consumidor","Puntaje","Premios","Consulta"])
-
-# ---------- MECÁNICO ----------
-with tabs[0]:
-    st.subheader("Mecánico 🛠️")
-    with st.form("m_form"):
-        colA,colB = st.columns(2)
-        m_nombre = colA.text_input("Nombre y Apellido *", key="m_nombre")
-        m_cedula = colB.text_input("RUC o Cédula *", key="m_cedula")
-        col1,col2 = st.columns(2)
-        m_tel = col1.text_input("Teléfono *", key="m_tel")
-        m_correo = col2.text_input("Correo (opcional)", key="m_correo")
-
-        if provs:
-            m_prov = st.selectbox("Provincia", [""]+provs, key="m_prov")
-            cantones = cantones_de(m_prov, prov_index)
-            m_cant = st.selectbox("Cantón / Ciudad", [""]+cantones, key="m_cant") if cantones else st.text_input("Cantón / Ciudad", key="m_cant")
-            parroqs = parroquias_de(m_prov, m_cant, prov_index)
-            m_parr = st.selectbox("Parroquia", [""]+parroqs, key="m_parr") if parroqs else st.text_input("Parroquia", key="m_parr")
-        else:
-            m_prov = st.text_input("Provincia", key="m_prov")
-            m_cant = st.text_input("Cantón / Ciudad", key="m_cant")
-            m_parr = st.text_input("Parroquia", key="m_parr")
-
-        m_dir = st.text_input("Dirección", key="m_dir")
-        m_redes = st.text_input("Redes Sociales", key="m_redes")
-        col5,col6 = st.columns(2)
-        m_dedic = col5.text_input("¿A qué te dedicas?", key="m_dedic")
-        m_edad  = col6.number_input("Edad", 0,120,0, key="m_edad")
-        m_nom_mec   = st.text_input("Nombre de la mecánica", key="m_nom_mec")
-        m_mec_local = st.text_input("Mecánica y local", key="m_mec_local")
-        m_visitar   = st.selectbox("¿Quisieras que te visitemos?", ["","SI","NO"], key="m_visitar")
-        m_interes   = st.text_area("Productos de interés", key="m_interes")
-
-        m_stand = st.radio("Stand *", ["PANTRO","EXTREMEMAX"], horizontal=True, key="m_stand")
-
-        m_guardar = st.form_submit_button("Guardar MECÁNICO")
-
-    if m_guardar:
-        if any(not v for v in [m_nombre, m_cedula, m_tel, m_stand]):
-            st.error("Completa: Nombre, Cédula/RUC, Teléfono y Stand."); st.stop()
-        if not (validar_cedula_ec(m_cedula) or validar_ruc_natural_ec(m_cedula)):
-            st.error("Documento inválido (cédula o RUC natural)."); st.stop()
-        if not email_valido(m_correo):
-            st.error("Correo inválido."); st.stop()
-
-        dups = buscar_duplicados(m_cedula, m_correo, m_tel)
-        if dups:
-            lista = "\n".join([f"- {h} | Código {c} | {n}" for h,c,n in dups[:6]])
-            st.warning("⚠️ Ya existe un registro con esta Cédula/RUC o Correo o Teléfono:\n" + lista)
-
-        codigo = next_code("M")
-        ok = append_row("MECANICO", [
-            codigo, m_nombre, m_cedula, m_tel, m_correo,
-            m_prov, m_cant, m_parr, m_dir, m_redes, m_dedic,
-            int(m_edad) if m_edad else None, m_nom_mec, m_mec_local, m_visitar, m_interes, m_stand
-        ])
-        if ok:
-            upsert_registro_codigo(codigo, m_cedula, m_nombre, m_tel, "MECANICO", m_stand)
-            st.session_state["_last_code"]=codigo
-            clear_and_rerun([
-                "m_nombre","m_cedula","m_tel","m_correo","m_prov","m_cant","m_parr",
-                "m_dir","m_redes","m_dedic","m_edad","m_nom_mec","m_mec_local","m_visitar","m_interes","m_stand"
-            ])
-
-# ---------- DISTRIBUIDOR ----------
-with tabs[1]:
-    st.subheader("Distribuidor 🧰")
-    with st.form("d_form"):
-        colA,colB = st.columns(2)
-        d_nombre = colA.text_input("Nombre y Apellido *", key="d_nombre")
-        d_cedula = colB.text_input("Cédula o RUC *", key="d_cedula")
-        col1,col2 = st.columns(2)
-        d_tel = col1.text_input("Teléfono *", key="d_tel")
-        d_edad = col2.number_input("Edad", 0,120,0, key="d_edad")
-
-        if provs:
-            d_prov = st.selectbox("Provincia", [""]+provs, key="d_prov")
-            cantones = cantones_de(d_prov, prov_index)
-            d_cant = st.selectbox("Cantón / Ciudad", [""]+cantones, key="d_cant") if cantones else st.text_input("Cantón / Ciudad", key="d_cant")
-            parroqs = parroquias_de(d_prov, d_cant, prov_index)
-            d_parr = st.selectbox("Parroquia", [""]+parroqs, key="d_parr") if parroqs else st.text_input("Parroquia", key="d_parr")
-        else:
-            d_prov = st.text_input("Provincia", key="d_prov")
-            d_cant = st.text_input("Cantón / Ciudad", key="d_cant")
-            d_parr = st.text_input("Parroquia", key="d_parr")
-
-        d_dir = st.text_input("Dirección", key="d_dir")
-        d_correo = st.text_input("Correo (opcional)", key="d_correo")
-        d_redes = st.text_input("Redes Sociales", key="d_redes")
-        d_dedic = st.text_input("¿A qué te dedicas?", key="d_dedic")
-        d_rep   = st.text_area("¿Qué repuestos quieres distribuir?", key="d_rep")
-
-        d_stand = st.radio("Stand *", ["PANTRO","EXTREMEMAX"], horizontal=True, key="d_stand")
-
-        d_guardar = st.form_submit_button("Guardar DISTRIBUIDOR")
-
-    if d_guardar:
-        if any(not v for v in [d_nombre, d_cedula, d_tel, d_stand]):
-            st.error("Completa: Nombre, Cédula/RUC, Teléfono y Stand."); st.stop()
-        if not (validar_cedula_ec(d_cedula) or validar_ruc_natural_ec(d_cedula)):
-            st.error("Documento inválido (cédula o RUC natural)."); st.stop()
-        if not email_valido(d_correo):
-            st.error("Correo inválido."); st.stop()
-
-        dups = buscar_duplicados(d_cedula, d_correo, d_tel)
-        if dups:
-            lista = "\n".join([f"- {h} | Código {c} | {n}" for h,c,n in dups[:6]])
-            st.warning("⚠️ Ya existe un registro con esta Cédula/RUC o Correo o Teléfono:\n" + lista)
-
-        codigo = next_code("D")
-        ok = append_row("DISTRIBUIDOR", [
-            codigo, d_nombre, d_cedula, d_tel, int(d_edad) if d_edad else None,
-            d_prov, d_cant, d_parr, d_dir, d_correo, d_redes, d_dedic, d_rep, d_stand
-        ])
-        if ok:
-            upsert_registro_codigo(codigo, d_cedula, d_nombre, d_tel, "DISTRIBUIDOR", d_stand)
-            st.session_state["_last_code"]=codigo
-            clear_and_rerun([
-                "d_nombre","d_cedula","d_tel","d_edad","d_prov","d_cant","d_parr",
-                "d_dir","d_correo","d_redes","d_dedic","d_rep","d_stand"
-            ])
-
-# ---------- CONSUMIDOR ----------
-with tabs[2]:
-    st.subheader("Consumidor 🏍️")
-    with st.form("c_form"):
-        colA,colB = st.columns(2)
-        c_nombre = colA.text_input("Nombre y Apellido *", key="c_nombre")
-        c_cedula = colB.text_input("Cédula o RUC *", key="c_cedula")
-        col1,col2 = st.columns(2)
-        c_tel = col1.text_input("Teléfono *", key="c_tel")
-        c_edad = col2.number_input("Edad", 0,120,0, key="c_edad")
-        c_sexo = st.selectbox("Hombre o Mujer", ["","HOMBRE","MUJER"], key="c_sexo")
-
-        if provs:
-            c_prov = st.selectbox("Provincia", [""]+provs, key="c_prov1")
-            cantones = cantones_de(c_prov, prov_index)
-            c_cant = st.selectbox("Cantón / Ciudad", [""]+cantones, key="c_cant") if cantones else st.text_input("Cantón / Ciudad", key="c_cant")
-            parroqs = parroquias_de(c_prov, c_cant, prov_index)
-            c_parr = st.selectbox("Parroquia", [""]+parroqs, key="c_parr") if parroqs else st.text_input("Parroquia", key="c_parr")
-        else:
-            c_prov = st.text_input("Provincia", key="c_prov1")
-            c_cant = st.text_input("Cantón / Ciudad", key="c_cant")
-            c_parr = st.text_input("Parroquia", key="c_parr")
-
-        c_dir = st.text_input("Dirección", key="c_dir")
-        c_dedic = st.text_input("¿A qué te dedicas?", key="c_dedic")
-        c_modelo = st.text_input("Modelo de moto que usas", key="c_modelo")
-        c_rep = st.text_area("¿Qué repuesto buscas?", key="c_rep")
-        c_compra = st.selectbox("¿Has comprado productos ExtremeMax?", ["","SI","NO"], key="c_compra")
-
-        c_stand = st.radio("Stand *", ["PANTRO","EXTREMEMAX"], horizontal=True, key="c_stand")
-
-        c_guardar = st.form_submit_button("Guardar CONSUMIDOR")
-
-    if c_guardar:
-        if any(not v for v in [c_nombre, c_cedula, c_tel, c_stand]):
-            st.error("Completa: Nombre, Cédula/RUC, Teléfono y Stand."); st.stop()
-        if not (validar_cedula_ec(c_cedula) or validar_ruc_natural_ec(c_cedula)):
-            st.error("Documento inválido (cédula o RUC natural)."); st.stop()
-
-        dups = buscar_duplicados(c_cedula, "", c_tel)
-        if dups:
-            lista = "\n".join([f"- {h} | Código {c} | {n}" for h,c,n in dups[:6]])
-            st.warning("⚠️ Ya existe un registro con esta Cédula/RUC o Teléfono:\n" + lista)
-
-        codigo = next_code("C")
-        ok = append_row("CONSUMIDOR", [
-            codigo, c_nombre, c_cedula, c_tel, int(c_edad) if c_edad else None, c_sexo,
-            c_prov, c_prov, c_cant, c_parr, c_dir, c_dedic, c_modelo, c_rep, c_compra, c_stand
-        ])
-        if ok:
-            upsert_registro_codigo(codigo, c_cedula, c_nombre, c_tel, "CONSUMIDOR", c_stand)
-            st.session_state["_last_code"]=codigo
-            clear_and_rerun([
-                "c_nombre","c_cedula","c_tel","c_edad","c_sexo","c_prov1","c_cant",
-                "c_parr","c_dir","c_dedic","c_modelo","c_rep","c_compra","c_stand"
-            ])
-
-# ---------- PUNTAJE ----------
-with tabs[3]:
-    st.subheader("Asignar puntaje a un código")
-    try:
-        wb_ro=safe_load_workbook(EXCEL_PATH, read_only=True, data_only=True)
-        codes=[]
-        if "REGISTRO DE CODIGOS" in wb_ro.sheetnames:
-            for row in wb_ro["REGISTRO DE CODIGOS"].iter_rows(min_row=2, values_only=True):
-                if row and row[0]: codes.append(str(row[0]).strip())
-    except: codes=[]
-    col1,col2 = st.columns([2,1])
-    cod_sel = col1.selectbox("Código", [""]+sorted(set(codes)), key="puntaje_codigo")
-    puntaje = col2.number_input("Puntaje", min_value=0, max_value=100000, step=1, key="puntaje_valor")
-    if st.button("Grabar puntaje", key="btn_puntaje"):
-        if not cod_sel: st.error("Selecciona un código.")
-        else:
+# Solo cuando Streamlit corre este archivo: sincronizar_nodos.py, bench_expo.py y las
+# pruebas lo importan como módulo (funciones y estado, sin interfaz).
+if __name__ == "__main__":
+    st.title("FORMULARIO DATOS EXPO FERIA")
+    st.caption(f"Excel (servidor): **{EXCEL_PATH}**"
+               + (f" · nodo **{NODE_ID} de {NODE_COUNT}**" if NODE_COUNT > 1 else ""))
+    big_code_banner()
+
+    # --- Gestor de Excel en la nube: subir/descargar ---
+    with st.expander("📁 Excel en el servidor", expanded=False):
+        up = st.file_uploader("Cargar/actualizar Excel (.xlsx)", type=["xlsx"], key="excel_up")
+        modo = st.radio("Al cargar", ["Combinar por CODIGO", "Reemplazar todo"], horizontal=True, key="excel_up_modo")
+        manda_archivo = modo.startswith("Combinar") and st.checkbox("En conflicto, manda el archivo", key="excel_up_manda")
+        # El archivo sigue en el uploader tras el rerun: file_id evita aplicarlo dos veces.
+        up_id = (getattr(up, "file_id", None) or (up.name, up.size)) if up is not None else None
+        if up is not None and st.session_state.get("_excel_up_id") == up_id:
+            st.caption(f"✔️ {up.name} ya se aplicó. Sube otro archivo para volver a cargar.")
+        elif up is not None and st.button("Aplicar Excel", key="excel_up_btn"):
+            data = up.getvalue()
             try:
-                wb=safe_load_workbook(EXCEL_PATH)
-                if "REGISTRO DE CODIGOS" not in wb.sheetnames:
-                    ws=wb.create_sheet("REGISTRO DE CODIGOS"); ws.append(HEADERS["REGISTRO DE CODIGOS"])
-                ws=wb["REGISTRO DE CODIGOS"]
-                hmap = header_map(ws)
-                ci_punt = find_col(hmap, "PUNTAJE")
-                if ci_punt is None: st.error("No existe la columna PUNTAJE.")
-                found=False
-                for r in range(2, ws.max_row+1):
-                    if str(ws.cell(r,1).value or "").strip()==cod_sel:
-                        ws.cell(r,ci_punt+1).value=puntaje; found=True; break
-                if not found:
-                    def find_data(code):
-                        for sheet,tipo in (("MECANICO","MECANICO"),("DISTRIBUIDOR","DISTRIBUIDOR"),("CONSUMIDOR","CONSUMIDOR")):
-                            if sheet not in wb.sheetnames: continue
-                            ws2=wb[sheet]; h2=header_map(ws2)
-                            ci_cod=find_col(h2,"CODIGO")
-                            ci_ced=find_col(h2,"CEDULA","RUC")
-                            ci_nom=find_col(h2,"NOMBRE")
-                            ci_tel=find_col(h2,"TELEFONO")
-                            ci_sta=find_col(h2,"STAND")
-                            if ci_cod is None: continue
-                            for row in ws2.iter_rows(min_row=2, values_only=True):
-                                if row and str(row[ci_cod] or "").strip()==code:
-                                    return str(row[ci_ced] or ""), str(row[ci_nom] or ""), str(row[ci_tel] or ""), tipo, str(row[ci_sta] or "")
-                        return "","","","",""
-                    ced, nom, tel, tipo, stand = find_data(cod_sel)
-                    hmap = header_map(ws)
-                    ci_ced  = find_col(hmap,"RUC O CEDULA")
-                    ci_nom  = find_col(hmap,"NOMBRE")
-                    ci_tel  = find_col(hmap,"TELEFONO")
-                    ci_tip  = find_col(hmap,"TIPO")
-                    ci_sta  = find_col(hmap,"STAND")
-                    row = [""] * (max(hmap.values()) + 1)
-                    row[0] = cod_sel
-                    if ci_punt is not None: row[ci_punt] = puntaje
-                    if ci_ced  is not None: row[ci_ced]  = ced
-                    if ci_nom  is not None: row[ci_nom]  = nom
-                    if ci_tel  is not None: row[ci_tel]  = tel
-                    if ci_tip  is not None: row[ci_tip]  = tipo
-                    if ci_sta  is not None: row[ci_sta]  = stand
-                    ws.append(row)
-                safe_save_workbook(wb, EXCEL_PATH)
-                st.success("✅ Puntaje actualizado.")
-            except PermissionError:
-                st.error("🔒 No se pudo guardar (archivo bloqueado).")
-
-    st.markdown("---")
-    st.subheader("🏁 Top 10 puntajes")
-    top = load_registros_codigos(str(EXCEL_PATH), _mtime(EXCEL_PATH))
-    if top:
-        top = sorted(top, key=lambda x: x.get("PUNTAJE", 0), reverse=True)[:10]
-        st.dataframe(top, use_container_width=True, height=360)
-    else:
-        st.info("Aún no hay registros de puntajes.")
-
-# ---------- PREMIOS ----------
-with tabs[4]:
-    st.subheader("Registro de premios por código")
-    try:
-        wb_ro=safe_load_workbook(EXCEL_PATH, read_only=True, data_only=True)
-        base={}
-        if "REGISTRO DE CODIGOS" in wb_ro.sheetnames:
-            ws=wb_ro["REGISTRO DE CODIGOS"]; hmap=header_map(ws)
-            ci_cod=find_col(hmap,"CODIGO"); ci_ced=find_col(hmap,"RUC O CEDULA")
-            ci_nom=find_col(hmap,"NOMBRE"); ci_tel=find_col(hmap,"TELEFONO")
-            ci_tip=find_col(hmap,"TIPO");   ci_sta=find_col(hmap,"STAND")
-            for row in ws.iter_rows(min_row=2, values_only=True):
-                if not row: continue
-                cod=str((row[ci_cod] if ci_cod is not None else "") or "").strip()
-                if not cod: continue
-                base[cod]={
-                    "ced": str((row[ci_ced] if ci_ced is not None else "") or ""),
-                    "nom": str((row[ci_nom] if ci_nom is not None else "") or ""),
-                    "tel": str((row[ci_tel] if ci_tel is not None else "") or ""),
-                    "tipo":str((row[ci_tip] if ci_tip is not None else "") or ""),
-                    "stand":str((row[ci_sta] if ci_sta is not None else "") or ""),
-                }
-        if base:
-            wb_r = safe_load_workbook(EXCEL_PATH, read_only=True, data_only=True)
-            for k,v in base.items():
-                if not v.get("stand"):
-                    v["stand"] = lookup_stand_by_code(wb_r, k)
-        codes=sorted(base.keys())
-    except:
-        base,codes={},[]
-    col1,col2 = st.columns([2,1])
-    cod_sel = col1.selectbox("Código", [""]+codes, key="premio_codigo")
-    premio  = col2.text_input("Premio *", key="premio_texto")
-    if cod_sel:
-        d=base.get(cod_sel,{})
-        st.write(f"**Nombre:** {d.get('nom','')}")
-        st.write(f"**RUC/Cédula:** {d.get('ced','')}")
-        st.write(f"**Teléfono:** {d.get('tel','')}")
-        st.write(f"**Tipo:** {d.get('tipo','')}")
-        st.write(f"**Stand:** {d.get('stand','')}")
-    if st.button("Registrar premio", key="btn_premio"):
-        if not cod_sel: st.error("Selecciona un código.")
-        elif not premio.strip(): st.error("Escribe el premio.")
+                if modo.startswith("Combinar"):
+                    st.session_state["_excel_up_inf"] = combinar_xlsx(data, preferir_archivo=manda_archivo)
+                else:
+                    validar_xlsx(data)
+                    storage().replace_from_xlsx(data)
+                    try: reconcile_counters()
+                    except Exception: pass
+                    st.session_state["_excel_up_inf"] = None
+                st.session_state["_excel_up_id"] = up_id
+                if hasattr(st, "rerun"): st.rerun()
+            except ValueError as e: st.error(f"❗ {e}")
+            except Exception as e: st.error(f"❗ No se pudo cargar el Excel: {e}")
+        if st.session_state.get("_excel_up_id") is not None and up is not None:
+            inf = st.session_state.get("_excel_up_inf")
+            if inf is None: st.success(f"Excel reemplazado en: {EXCEL_PATH}")
+            else:
+                st.success(f"✅ Combinado: {inf['agregadas']} fila(s) nuevas, {inf['actualizadas']} actualizada(s); "
+                           f"{inf['solo_servidor']} solo en el servidor (se conservan).")
+                if not inf["historial"] and inf["conflictos"]:
+                    st.caption("La copia es anterior al historial disponible: toda diferencia se trató como conflicto.")
+                if inf["omitidas"]: st.caption("Hojas ignoradas (no existen en el servidor): " + ", ".join(inf["omitidas"]))
+                if inf["conflictos"]:
+                    st.warning(f"⚠️ {len(inf['conflictos'])} conflicto(s): se conservó " +
+                               ("el archivo." if inf["manda_archivo"] else "el servidor."))
+                    st.dataframe(tabla(inf["conflictos"][:500]), use_container_width=True, height=240)
+        pendientes = storage().pending()
+        if pendientes:
+            # Excel: se compacta solo en segundo plano. SQLite: el Excel es una exportación.
+            st.caption(f"⏳ {pendientes} cambio(s) aún no volcados al Excel.")
+            if st.button("🔄 Actualizar Excel ahora", key="excel_compact"):
+                if storage().export_xlsx(): st.rerun()
+                else: st.warning("⚠️ No se pudo actualizar el Excel (bloqueado). Intenta de nuevo.")
+        if EXCEL_PATH.exists():
+            # Se compacta/exporta al hacer clic (no en cada rerun): la descarga incluye lo
+            # que aún estaba en el journal (o en SQLite).
+            if _DESCARGA_DIFERIDA:
+                st.download_button("⬇️ Descargar Excel actual", excel_para_descargar, file_name=EXCEL_PATH.name, key="excel_down")
+            elif st.button("Preparar descarga del Excel", key="excel_prep"):
+                try: st.download_button("⬇️ Descargar Excel actual", excel_para_descargar(),
+                                        file_name=EXCEL_PATH.name, key="excel_down")
+                except PermissionError as e: st.warning(f"⚠️ {e}")
         else:
-            ensure_workbook(EXCEL_PATH)
+            st.info("Aún no hay Excel. Se creará automáticamente al guardar el primer registro.")
+
+    if es_admin(): panel_metricas()
+
+    geo = catalogo_geo()
+    provs = geo.provincias
+    exportacion_filtrada(provs)
+
+    # Tabs (incluye "Consulta"). Los formularios corren siempre (conservan lo tecleado);
+    # Puntaje, Premios y Consulta solo leen sus datos cuando son la pestaña activa.
+    conservar_estado("puntaje_modo", "puntaje_codigo", "puntaje_valor", "top_stand", "top_tipo",
+                     "premio_codigo", "premio_texto", "consulta_vista", "consulta_q")
+    tabs = pestanas(["Mecánico","Distribuidor","Consumidor","Puntaje","Premios","Consulta"], key="seccion")
+
+    # ---------- MECÁNICO ----------
+    with tabs[0]:
+        st.subheader("Mecánico 🛠️")
+        importacion_masiva("MECANICO")
+        m_cedula = cedula_en_vivo("RUC o Cédula *", "m_cedula")
+        if provs: ubicacion_rapida("m_geo", ("m_prov", "m_cant", "m_parr"), geo)
+        with st.form("m_form"):
+            m_nombre = st.text_input("Nombre y Apellido *", key="m_nombre")
+            col1,col2 = st.columns(2)
+            m_tel = col1.text_input("Teléfono *", key="m_tel")
+            m_correo = col2.text_input("Correo (opcional)", key="m_correo")
+
+            if provs:
+                m_prov = st.selectbox("Provincia", [""]+provs, key="m_prov")
+                cantones = cantones_de(m_prov, geo)
+                m_cant = st.selectbox("Cantón / Ciudad", [""]+cantones, key="m_cant") if cantones else st.text_input("Cantón / Ciudad", key="m_cant")
+                parroqs = parroquias_de(m_prov, m_cant, geo)
+                m_parr = st.selectbox("Parroquia", [""]+parroqs, key="m_parr") if parroqs else st.text_input("Parroquia", key="m_parr")
+            else:
+                m_prov = st.text_input("Provincia", key="m_prov")
+                m_cant = st.text_input("Cantón / Ciudad", key="m_cant")
+                m_parr = st.text_input("Parroquia", key="m_parr")
+
+            m_dir = st.text_input("Dirección", key="m_dir")
+            m_redes = st.text_input("Redes Sociales", key="m_redes")
+            col5,col6 = st.columns(2)
+            m_dedic = col5.text_input("¿A qué te dedicas?", key="m_dedic")
+            m_edad  = col6.number_input("Edad", 0,120,0, key="m_edad")
+            m_nom_mec   = st.text_input("Nombre de la mecánica", key="m_nom_mec")
+            m_mec_local = st.text_input("Mecánica y local", key="m_mec_local")
+            m_visitar   = st.selectbox("¿Quisieras que te visitemos?", ["","SI","NO"], key="m_visitar")
+            m_interes   = st.text_area("Productos de interés", key="m_interes")
+
+            m_stand = st.radio("Stand *", ["PANTRO","EXTREMEMAX"], horizontal=True, key="m_stand")
+
+            m_guardar = st.form_submit_button("Guardar MECÁNICO")
+
+        if m_guardar:
+            if any(not v for v in [m_nombre, m_cedula, m_tel, m_stand]):
+                st.error("Completa: Nombre, Cédula/RUC, Teléfono y Stand."); st.stop()
+            if not (validar_cedula_ec(m_cedula) or validar_ruc_natural_ec(m_cedula)):
+                st.error("Documento inválido (cédula o RUC natural)."); st.stop()
+            if not email_valido(m_correo):
+                st.error("Correo inválido."); st.stop()
+
+            codigo, dups = registrar_visitante("MECANICO", "M", [
+                m_nombre, m_cedula, m_tel, m_correo,
+                m_prov, m_cant, m_parr, m_dir, m_redes, m_dedic,
+                int(m_edad) if m_edad else None, m_nom_mec, m_mec_local, m_visitar, m_interes, m_stand
+            ], m_cedula, m_correo, m_tel, m_nombre, m_stand)
+            alerta_duplicados(dups)
+            if codigo:
+                marcar_registrado(codigo)
+                clear_and_rerun([
+                    "m_nombre","m_cedula","m_tel","m_correo","m_prov","m_cant","m_parr",
+                    "m_dir","m_redes","m_dedic","m_edad","m_nom_mec","m_mec_local","m_visitar","m_interes","m_stand"
+                ])
+
+    # ---------- DISTRIBUIDOR ----------
+    with tabs[1]:
+        st.subheader("Distribuidor 🧰")
+        importacion_masiva("DISTRIBUIDOR")
+        d_cedula = cedula_en_vivo("Cédula o RUC *", "d_cedula")
+        if provs: ubicacion_rapida("d_geo", ("d_prov", "d_cant", "d_parr"), geo)
+        with st.form("d_form"):
+            d_nombre = st.text_input("Nombre y Apellido *", key="d_nombre")
+            col1,col2 = st.columns(2)
+            d_tel = col1.text_input("Teléfono *", key="d_tel")
+            d_edad = col2.number_input("Edad", 0,120,0, key="d_edad")
+
+            if provs:
+                d_prov = st.selectbox("Provincia", [""]+provs, key="d_prov")
+                cantones = cantones_de(d_prov, geo)
+                d_cant = st.selectbox("Cantón / Ciudad", [""]+cantones, key="d_cant") if cantones else st.text_input("Cantón / Ciudad", key="d_cant")
+                parroqs = parroquias_de(d_prov, d_cant, geo)
+                d_parr = st.selectbox("Parroquia", [""]+parroqs, key="d_parr") if parroqs else st.text_input("Parroquia", key="d_parr")
+            else:
+                d_prov = st.text_input("Provincia", key="d_prov")
+                d_cant = st.text_input("Cantón / Ciudad", key="d_cant")
+                d_parr = st.text_input("Parroquia", key="d_parr")
+
+            d_dir = st.text_input("Dirección", key="d_dir")
+            d_correo = st.text_input("Correo (opcional)", key="d_correo")
+            d_redes = st.text_input("Redes Sociales", key="d_redes")
+            d_dedic = st.text_input("¿A qué te dedicas?", key="d_dedic")
+            d_rep   = st.text_area("¿Qué repuestos quieres distribuir?", key="d_rep")
+
+            d_stand = st.radio("Stand *", ["PANTRO","EXTREMEMAX"], horizontal=True, key="d_stand")
+
+            d_guardar = st.form_submit_button("Guardar DISTRIBUIDOR")
+
+        if d_guardar:
+            if any(not v for v in [d_nombre, d_cedula, d_tel, d_stand]):
+                st.error("Completa: Nombre, Cédula/RUC, Teléfono y Stand."); st.stop()
+            if not (validar_cedula_ec(d_cedula) or validar_ruc_natural_ec(d_cedula)):
+                st.error("Documento inválido (cédula o RUC natural)."); st.stop()
+            if not email_valido(d_correo):
+                st.error("Correo inválido."); st.stop()
+
+            codigo, dups = registrar_visitante("DISTRIBUIDOR", "D", [
+                d_nombre, d_cedula, d_tel, int(d_edad) if d_edad else None,
+                d_prov, d_cant, d_parr, d_dir, d_correo, d_redes, d_dedic, d_rep, d_stand
+            ], d_cedula, d_correo, d_tel, d_nombre, d_stand)
+            alerta_duplicados(dups)
+            if codigo:
+                marcar_registrado(codigo)
+                clear_and_rerun([
+                    "d_nombre","d_cedula","d_tel","d_edad","d_prov","d_cant","d_parr",
+                    "d_dir","d_correo","d_redes","d_dedic","d_rep","d_stand"
+                ])
+
+    # ---------- CONSUMIDOR ----------
+    with tabs[2]:
+        st.subheader("Consumidor 🏍️")
+        importacion_masiva("CONSUMIDOR")
+        c_cedula = cedula_en_vivo("Cédula o RUC *", "c_cedula")
+        if provs: ubicacion_rapida("c_geo", ("c_prov1", "c_cant", "c_parr"), geo)
+        with st.form("c_form"):
+            c_nombre = st.text_input("Nombre y Apellido *", key="c_nombre")
+            col1,col2 = st.columns(2)
+            c_tel = col1.text_input("Teléfono *", key="c_tel")
+            c_edad = col2.number_input("Edad", 0,120,0, key="c_edad")
+            c_sexo = st.selectbox("Hombre o Mujer", ["","HOMBRE","MUJER"], key="c_sexo")
+
+            if provs:
+                c_prov = st.selectbox("Provincia", [""]+provs, key="c_prov1")
+                cantones = cantones_de(c_prov, geo)
+                c_cant = st.selectbox("Cantón / Ciudad", [""]+cantones, key="c_cant") if cantones else st.text_input("Cantón / Ciudad", key="c_cant")
+                parroqs = parroquias_de(c_prov, c_cant, geo)
+                c_parr = st.selectbox("Parroquia", [""]+parroqs, key="c_parr") if parroqs else st.text_input("Parroquia", key="c_parr")
+            else:
+                c_prov = st.text_input("Provincia", key="c_prov1")
+                c_cant = st.text_input("Cantón / Ciudad", key="c_cant")
+                c_parr = st.text_input("Parroquia", key="c_parr")
+
+            c_dir = st.text_input("Dirección", key="c_dir")
+            c_dedic = st.text_input("¿A qué te dedicas?", key="c_dedic")
+            c_modelo = st.text_input("Modelo de moto que usas", key="c_modelo")
+            c_rep = st.text_area("¿Qué repuesto buscas?", key="c_rep")
+            c_compra = st.selectbox("¿Has comprado productos ExtremeMax?", ["","SI","NO"], key="c_compra")
+
+            c_stand = st.radio("Stand *", ["PANTRO","EXTREMEMAX"], horizontal=True, key="c_stand")
+
+            c_guardar = st.form_submit_button("Guardar CONSUMIDOR")
+
+        if c_guardar:
+            if any(not v for v in [c_nombre, c_cedula, c_tel, c_stand]):
+                st.error("Completa: Nombre, Cédula/RUC, Teléfono y Stand."); st.stop()
+            if not (validar_cedula_ec(c_cedula) or validar_ruc_natural_ec(c_cedula)):
+                st.error("Documento inválido (cédula o RUC natural)."); st.stop()
+
+            codigo, dups = registrar_visitante("CONSUMIDOR", "C", [
+                c_nombre, c_cedula, c_tel, int(c_edad) if c_edad else None, c_sexo,
+                c_prov, c_prov, c_cant, c_parr, c_dir, c_dedic, c_modelo, c_rep, c_compra, c_stand
+            ], c_cedula, "", c_tel, c_nombre, c_stand)
+            alerta_duplicados(dups, "Cédula/RUC o Teléfono")
+            if codigo:
+                marcar_registrado(codigo)
+                clear_and_rerun([
+                    "c_nombre","c_cedula","c_tel","c_edad","c_sexo","c_prov1","c_cant",
+                    "c_parr","c_dir","c_dedic","c_modelo","c_rep","c_compra","c_stand"
+                ])
+
+    # ---------- PUNTAJE ----------
+    with tabs[3]:
+        if abierta(tabs[3]):
+            st.subheader("Asignar puntaje a un código")
+            modo_lote = st.radio("Modo", ["Uno por uno","En lote"], horizontal=True, key="puntaje_modo") == "En lote"
+            if not modo_lote:
+                codes = list(perfiles_registrados())
+                col1,col2 = st.columns([2,1])
+                cod_sel = col1.selectbox("Código", [""]+sorted(set(codes)), key="puntaje_codigo")
+                puntaje = col2.number_input("Puntaje", min_value=0, max_value=PUNTAJE_MAX, step=1, key="puntaje_valor")
+                if st.button("Grabar puntaje", key="btn_puntaje"):
+                    if not cod_sel: st.error("Selecciona un código.")
+                    else:
+                        try:
+                            with medir("accion", accion="puntaje"):
+                                storage().upsert("REGISTRO DE CODIGOS", cod_sel, {"PUNTAJE": puntaje})
+                            st.success("✅ Puntaje actualizado.")
+                        except Exception as e:
+                            st.error(f"❗ No se pudo guardar el puntaje: {e}")
+            else:
+                st.caption("Pega o escanea una línea por visitante: CODIGO y PUNTAJE (p. ej. `M12 80`), "
+                           "o escríbelos en la tabla. Todo se guarda en una sola escritura.")
+                with st.form("puntaje_lote_form", clear_on_submit=True):
+                    lote_txt = st.text_area("Códigos y puntajes", key="puntaje_lote_txt", height=160,
+                                            placeholder="M12 80\nC7 95")
+                    lote_grid = st.data_editor(pd.DataFrame({"CODIGO": pd.Series(dtype="string"), "PUNTAJE": pd.Series(dtype="Int64")}),
+                        num_rows="dynamic", key="puntaje_lote_grid",
+                        column_config={"CODIGO": st.column_config.TextColumn("CODIGO"),
+                                       "PUNTAJE": st.column_config.NumberColumn("PUNTAJE", min_value=0, max_value=PUNTAJE_MAX, step=1)})
+                    lote_enviar = st.form_submit_button("Grabar lote")
+                if lote_enviar:
+                    pares = parse_puntajes(lote_txt)
+                    pares += [(c, "" if pd.isna(p) else p) for c, p in zip(lote_grid["CODIGO"], lote_grid["PUNTAJE"])
+                              if not pd.isna(c) and str(c).strip()]
+                    if not pares: st.error("No hay códigos en el lote.")
+                    else:
+                        informe = registrar_puntajes(pares)
+                        ok = sum(f["ESTADO"].startswith("✅") for f in informe)
+                        if ok: st.success(f"✅ {ok} puntaje(s) guardado(s) en una sola escritura.")
+                        if ok < len(informe): st.warning(f"⚠️ {len(informe)-ok} línea(s) sin guardar; revisa el detalle.")
+                        st.dataframe(informe, use_container_width=True)
+
+            st.markdown("---")
+            st.subheader("🏁 Top 10 puntajes")
+            colT1, colT2 = st.columns(2)
+            top_stand = colT1.selectbox("Stand", ["Todos","PANTRO","EXTREMEMAX"], key="top_stand")
+            top_tipo  = colT2.selectbox("Tipo", ["Todos"]+list(VISITOR_SHEETS), key="top_tipo")
             try:
-                wb=safe_load_workbook(EXCEL_PATH)
-                if "REGISTRO DE PREMIOS" not in wb.sheetnames:
-                    ws=wb.create_sheet("REGISTRO DE PREMIOS"); ws.append(HEADERS["REGISTRO DE PREMIOS"])
-                ws=wb["REGISTRO DE PREMIOS"]
-                d=base.get(cod_sel,{"ced":"","nom":"","tel":"","tipo":"","stand":""})
-                if not d.get("stand"):
-                    d["stand"] = lookup_stand_by_code(wb, cod_sel)
-                hmap = header_map(ws)
-                ci_cod=find_col(hmap,"CODIGO"); ci_pre=find_col(hmap,"PREMIO")
-                ci_ced=find_col(hmap,"RUC O CEDULA"); ci_nom=find_col(hmap,"NOMBRE")
-                ci_tel=find_col(hmap,"TELEFONO"); ci_tip=find_col(hmap,"TIPO")
-                ci_sta=find_col(hmap,"STAND")
-                row = [""] * (max(hmap.values()) + 1)
-                if ci_cod is not None: row[ci_cod] = cod_sel
-                if ci_pre is not None: row[ci_pre] = premio.strip()
-                if ci_ced is not None: row[ci_ced] = d["ced"]
-                if ci_nom is not None: row[ci_nom] = d["nom"]
-                if ci_tel is not None: row[ci_tel] = d["tel"]
-                if ci_tip is not None: row[ci_tip] = d["tipo"]
-                if ci_sta is not None: row[ci_sta] = d["stand"]
-                ws.append(row)
-                safe_save_workbook(wb, EXCEL_PATH)
-                st.success("🏆 Premio registrado.")
-            except PermissionError:
-                st.error("🔒 No se pudo guardar (archivo bloqueado).")
-
-# ---------- CONSULTA ----------
-with tabs[5]:
-    st.subheader("Consulta rápida 🔎")
-
-    codigos = load_registros_codigos(str(EXCEL_PATH), _mtime(EXCEL_PATH))
-    premios = load_registros_premios(str(EXCEL_PATH), _mtime(EXCEL_PATH))
-
-    colA, colB = st.columns([2, 1])
-    vista = colB.selectbox("Vista", ["Puntajes", "Premios", "Ambos"])
-    q = colA.text_input("Buscar por Código, Cédula/RUC, Nombre, Teléfono o Stand")
-
-    codigos_fil = filtrar_por_query(codigos, q)
-    premios_fil = filtrar_por_query(premios, q)
-
-    if vista in ("Puntajes", "Ambos"):
-        st.markdown("### Puntajes")
-        if codigos_fil:
-            if not q:
-                codigos_fil = sorted(codigos_fil, key=lambda x: x.get("PUNTAJE", 0), reverse=True)
-            st.dataframe(codigos_fil, use_container_width=True, height=360)
-        else:
-            st.info("Sin resultados de puntajes para la búsqueda.")
-
-    if vista in ("Premios", "Ambos"):
-        st.markdown("### Premios")
-        if premios_fil:
-            st.dataframe(premios_fil, use_container_width=True, height=360)
-        else:
-            st.info("Sin resultados de premios para la búsqueda.")
+                top = top_puntajes(10, stand=None if top_stand == "Todos" else top_stand,
+                                   tipo=None if top_tipo == "Todos" else top_tipo)
+            except Exception: top = []
+            if top:
+                st.dataframe(tabla(top), use_container_width=True, height=360)
+            else:
+                st.info("Aún no hay registros de puntajes.")
+
+    # ---------- PREMIOS ----------
+    with tabs[4]:
+        if abierta(tabs[4]):
+            st.subheader("Registro de premios por código")
+            base = perfiles_registrados()
+            codes = sorted(base.keys())
+            col1,col2 = st.columns([2,1])
+            cod_sel = col1.selectbox("Código", [""]+codes, key="premio_codigo")
+            premio  = col2.text_input("Premio *", key="premio_texto")
+            if cod_sel:
+                d=base.get(cod_sel,{})
+                st.write(f"**Nombre:** {d.get('nom','')}")
+                st.write(f"**RUC/Cédula:** {d.get('ced','')}")
+                st.write(f"**Teléfono:** {d.get('tel','')}")
+                st.write(f"**Tipo:** {d.get('tipo','')}")
+                st.write(f"**Stand:** {d.get('stand','')}")
+            if st.button("Registrar premio", key="btn_premio"):
+                if not cod_sel: st.error("Selecciona un código.")
+                elif not premio.strip(): st.error("Escribe el premio.")
+                else:
+                    with medir("accion", accion="premio"):
+                        try:
+                            snap=storage().snapshot()
+                            try:
+                                if "REGISTRO DE PREMIOS" in snap.sheetnames: hmap = snap.hmap("REGISTRO DE PREMIOS")
+                                else: hmap = {_norm_text(v):i for i,v in enumerate(HEADERS["REGISTRO DE PREMIOS"])}
+                            finally: snap.close()
+                            d=base.get(cod_sel,{"ced":"","nom":"","tel":"","tipo":"","stand":""})
+                            ci_cod=find_col(hmap,"CODIGO"); ci_pre=find_col(hmap,"PREMIO")
+                            ci_ced=find_col(hmap,"RUC O CEDULA"); ci_nom=find_col(hmap,"NOMBRE")
+                            ci_tel=find_col(hmap,"TELEFONO"); ci_tip=find_col(hmap,"TIPO")
+                            ci_sta=find_col(hmap,"STAND")
+                            row = [""] * (max(hmap.values()) + 1)
+                            if ci_cod is not None: row[ci_cod] = cod_sel
+                            if ci_pre is not None: row[ci_pre] = premio.strip()
+                            if ci_ced is not None: row[ci_ced] = d["ced"]
+                            if ci_nom is not None: row[ci_nom] = d["nom"]
+                            if ci_tel is not None: row[ci_tel] = d["tel"]
+                            if ci_tip is not None: row[ci_tip] = d["tipo"]
+                            if ci_sta is not None: row[ci_sta] = d["stand"]
+                            if append_row("REGISTRO DE PREMIOS", row):
+                                st.success("🏆 Premio registrado.")
+                        except PermissionError:
+                            st.error("🔒 No se pudo leer el Excel (archivo bloqueado).")
+
+    # ---------- CONSULTA ----------
+    with tabs[5]:
+        if abierta(tabs[5]):
+            st.subheader("Consulta rápida 🔎")
+
+            colA, colB = st.columns([2, 1])
+            vista = colB.selectbox("Vista", ["Puntajes", "Premios", "Ambos"], key="consulta_vista")
+            q = colA.text_input("Buscar por Código, Cédula/RUC, Nombre, Teléfono o Stand", key="consulta_q")
+            # La página vuelve a 1 cuando cambia la búsqueda.
+            qkey = _norm_matchable(q)
+
+            if vista in ("Puntajes", "Ambos"):
+                st.markdown("### Puntajes")
+                if not qkey:
+                    # Sin búsqueda: páginas directas de la tabla de posiciones.
+                    total = total_puntajes()
+                    if total: tabla_paginada(total, lambda p: top_puntajes(PAGE_SIZE, desde=(p-1)*PAGE_SIZE), key="pag_codigos_")
+                    else: st.info("Sin resultados de puntajes para la búsqueda.")
+                else:
+                    idx_cod, ids = buscar("codigos", q)
+                    if ids: tabla_paginada(len(ids), lambda p: idx_cod.page(ids, p), key=f"pag_codigos_{qkey}")
+                    else: st.info("Sin resultados de puntajes para la búsqueda.")
+
+            if vista in ("Premios", "Ambos"):
+                st.markdown("### Premios")
+                idx_pre, ids = buscar("premios", q)
+                if ids: tabla_paginada(len(ids), lambda p: idx_pre.page(ids, p), key=f"pag_premios_{qkey}")
+                else:
+                    st.info("Sin resultados de premios para la búsqueda.")
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# SINCRONIZACIÓN MULTI-NODO - FORMULARIO DATOS EXPO FERIA
+# Cada laptop corre la app con su propio EXCEL_DIR y NODE_ID/NODE_COUNT (códigos que
+# no se pisan). Al cierre (o cuando se quiera) se juntan en el Excel maestro con las
+# reglas de sincronizar_nodos() de form_expo_feria2.py:
+#   python sincronizar_nodos.py /media/usb/nodo1 /media/usb/nodo2 --maestro data
+#   python sincronizar_nodos.py nodo1.xlsx nodo2.journal.jsonl --salida combinado.xlsx
+# Un nodo puede ser su carpeta EXCEL_DIR (libro + journal, o el .sqlite3), un .xlsx
+# (con su journal al lado si está), un journal .jsonl suelto o un .sqlite3. Volver a
+# correrlo con los mismos nodos no cambia el resultado.
+
+import os, json, logging, argparse, importlib
+from pathlib import Path
+
+def main():
+    ap = argparse.ArgumentParser(description="Junta los nodos en el Excel maestro.")
+    ap.add_argument("nodos", nargs="+", help="carpeta EXCEL_DIR, .xlsx, .jsonl o .sqlite3 de cada nodo")
+    ap.add_argument("--maestro", default=os.environ.get("EXCEL_DIR", "data"), help="EXCEL_DIR del maestro")
+    ap.add_argument("--backend", default=os.environ.get("STORAGE_BACKEND", "excel"), choices=("excel", "sqlite"))
+    ap.add_argument("--salida", help="solo escribir el resultado en este .xlsx (sin tocar el maestro)")
+    args = ap.parse_args()
+    faltan = [n for n in args.nodos if not Path(n).exists()]
+    if faltan: ap.error("no existe: " + ", ".join(faltan))
+    # La app lee EXCEL_DIR / STORAGE_BACKEND al importarse.
+    os.environ.update(EXCEL_DIR=str(args.maestro), STORAGE_BACKEND=args.backend)
+    logging.disable(logging.WARNING)  # avisos de Streamlit sin servidor
+    app = importlib.import_module("form_expo_feria2")
+    inf = app.sincronizar_nodos([Path(n).resolve() for n in args.nodos], salida=args.salida)
+    print(json.dumps(inf, ensure_ascii=False, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+# La app se importa como módulo (sin UI) sobre una copia del libro de ejemplo. Lee
+# EXCEL_DIR / STORAGE_BACKEND / NODE_ID al importarse y guarda su estado en
+# st.cache_resource: cada carga vacía esas cachés y vuelve a importar el módulo
+# (lo mismo que reiniciar el proceso, con los archivos en disco intactos).
+
+import sys, shutil, logging, importlib
+from pathlib import Path
+
+import pytest
+import streamlit as st
+from openpyxl import load_workbook
+
+RAIZ = Path(__file__).resolve().parents[1]
+LIBRO = RAIZ / "FORMULARIO DATOS EXPO FERIA.xlsx"
+if str(RAIZ) not in sys.path: sys.path.insert(0, str(RAIZ))
+logging.disable(logging.WARNING)  # avisos de Streamlit sin servidor
+
+def _importar(monkeypatch, directorio: Path, backend="excel", **env):
+    directorio.mkdir(parents=True, exist_ok=True)
+    if not (directorio / LIBRO.name).exists(): shutil.copy(LIBRO, directorio / LIBRO.name)
+    env = {"EXCEL_DIR": str(directorio), "EXCEL_FILE": LIBRO.name, "STORAGE_BACKEND": backend,
+           "COMPACT_DELAY": "3600", **env}  # la compactación solo cuando la prueba la pide
+    for k, v in env.items(): monkeypatch.setenv(k, str(v))
+    st.cache_resource.clear()
+    sys.modules.pop("form_expo_feria2", None)
+    return importlib.import_module("form_expo_feria2")
+
+@pytest.fixture
+def cargar_app(tmp_path, monkeypatch):
+    """cargar_app(backend="excel", directorio=tmp_path/"data", **env) → módulo form_expo_feria2."""
+    def cargar(backend="excel", directorio=None, **env):
+        return _importar(monkeypatch, directorio or tmp_path / "data", backend, **env)
+    yield cargar
+    st.cache_resource.clear()
+    sys.modules.pop("form_expo_feria2", None)
+
+def leer_libro(path) -> dict:
+    """{hoja: [filas]} del .xlsx (valores) más "JOURNAL_SEQ" si el libro lo tiene."""
+    wb = load_workbook(path, read_only=True)
+    try:
+        out = {ws.title: [tuple(r) for r in ws.iter_rows(values_only=True)] for ws in wb.worksheets}
+        props = wb.custom_doc_props
+        out["JOURNAL_SEQ"] = props["JOURNAL_SEQ"].value if "JOURNAL_SEQ" in props.names else None
+        return out
+    finally: wb.close()
+
+def filas_con(libro: dict, hoja: str, codigo: str) -> list:
+    return [r for r in libro[hoja] if r and r[0] == codigo]
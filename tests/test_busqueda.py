@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+# Índice de trigramas de la Consulta: mismo resultado que buscar fila por fila,
+# orden por relevancia y paginación estable.
+
+def _fila(cod, ced="", nom="", tel="", stand="PANTRO"):
+    return {"CODIGO": cod, "RUC O CEDULA": ced, "NOMBRE": nom, "TELEFONO": tel, "STAND": stand}
+
+FILAS = [
+    _fila("M1", "1804543047001", "Mario Ponce", "098772778"),
+    _fila("C2", "1700000019", "Ana Pérez García", "0999999999", "EXTREMEMAX"),
+    _fila("C3", "1700000027", "Pérez", "0988888888"),
+    _fila("D4", "0912345675", "Perezoso Luis", "0977777777"),
+    _fila("C5", "1700000035", "Luis Lopez Perez", "0966666666"),
+    _fila("M6", "1700000043", "Ñandú Núñez", "0955555555"),
+]
+
+def test_relevancia(cargar_app):
+    app = cargar_app()
+    idx = app.SearchIndex(FILAS)
+    # igual > empieza por > empieza una palabra > contiene; en empate, el orden de las filas
+    assert [FILAS[i]["CODIGO"] for i in idx.search("perez")] == ["C3", "D4", "C2", "C5"]
+    assert [FILAS[i]["CODIGO"] for i in idx.search("  PÉREZ ")] == ["C3", "D4", "C2", "C5"]
+    # el campo CODIGO va antes que los demás
+    assert [FILAS[i]["CODIGO"] for i in idx.search("m1")] == ["M1"]
+    assert [FILAS[i]["CODIGO"] for i in idx.search("nunez")] == ["M6"]
+    assert idx.search("zzz") == []
+
+def test_igual_que_recorrer_todo(cargar_app):
+    app = cargar_app()
+    idx = app.SearchIndex(FILAS)
+    norm = [[app._norm_matchable(str(f[c])) for c in app.SEARCH_FIELDS] for f in FILAS]
+    for q in ("p", "pe", "per", "pere", "0999", "1700", "luis lo", "extrememax", "a", "ez g", "m"):
+        qq = app._norm_matchable(q)
+        assert sorted(idx.search(q)) == [i for i, campos in enumerate(norm) if any(qq in c for c in campos)], q
+    assert idx.search("") == list(range(len(FILAS)))
+
+def test_replace_descarta_lo_viejo(cargar_app):
+    app = cargar_app()
+    idx = app.SearchIndex(FILAS)
+    idx.replace(2, _fila("C3", "1700000027", "Rosa Mora", "0988888888"))
+    assert [FILAS[i]["CODIGO"] for i in idx.search("perez")] == ["D4", "C2", "C5"]
+    assert idx.search("rosa mora") == [2]
+    idx.add(_fila("C7", nom="Pérez"))
+    assert idx.search("perez")[0] == 6
+
+def test_paginacion(cargar_app):
+    app = cargar_app()
+    filas = [_fila(f"C{i}", nom=f"Visitante {i:03d}") for i in range(1, 2 * app.PAGE_SIZE + 21)]
+    idx = app.SearchIndex(filas)
+    ids = idx.search("visitante")
+    paginas = [idx.page(ids, p) for p in (1, 2, 3, 4)]
+    assert [len(p) for p in paginas] == [app.PAGE_SIZE, app.PAGE_SIZE, 20, 0]
+    assert [f["CODIGO"] for p in paginas for f in p] == [f["CODIGO"] for f in filas]
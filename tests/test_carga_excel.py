@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# Combinar un Excel subido: lo nuevo entra, lo cambiado solo en la copia se aplica y un
+# código que también cambió en el servidor después de la copia es un conflicto.
+
+import io
+
+import pytest
+from openpyxl import load_workbook
+
+from conftest import leer_libro, filas_con
+
+@pytest.fixture
+def app(cargar_app):
+    app = cargar_app()
+    app.storage().append("REGISTRO DE PREMIOS", ["M1", "GORRA", "", "", "", "", ""])
+    assert app.compact_journal()  # la copia lleva JOURNAL_SEQ
+    return app
+
+def _editar(data: bytes, cambios, nuevas=(), sin_seq=False) -> bytes:
+    """cambios: [(hoja, CODIGO, columna, valor)]; nuevas: [(hoja, {columna: valor})]."""
+    wb = load_workbook(io.BytesIO(data))
+    for hoja, cod, col, v in cambios:
+        ws = wb[hoja]; cab = [c.value for c in ws[1]]
+        fila = next(r for r in ws.iter_rows(min_row=2) if r[0].value == cod)
+        fila[cab.index(col)].value = v
+    for hoja, campos in nuevas:
+        cab = [c.value for c in wb[hoja][1]]
+        wb[hoja].append([campos.get(h) for h in cab])
+    if sin_seq: del wb.custom_doc_props["JOURNAL_SEQ"]
+    out = io.BytesIO(); wb.save(out)
+    return out.getvalue()
+
+def _copia(app, **kw) -> bytes:
+    copia = app.storage().export_xlsx().read_bytes()
+    # Después de bajar la copia el servidor renombra a M1 y registra a M2.
+    app.storage().upsert("REGISTRO DE CODIGOS", "M1", {"NOMBRE": "MARIO SERVIDOR"})
+    app.storage().commit([{"op": "upsert", "sheet": "REGISTRO DE CODIGOS", "codigo": "M2",
+                           "fields": {"NOMBRE": "PEDRO", "TIPO": "MECANICO"}}])
+    return _editar(copia, [("REGISTRO DE CODIGOS", "M1", "NOMBRE", "MARIO ARCHIVO"),
+                           ("REGISTRO DE CODIGOS", "D1", "PUNTAJE", 15)],
+                   [("DISTRIBUIDOR", {"CODIGO": "D7", "NOMBRE Y APELLIDO": "Nuevo Distribuidor"})], **kw)
+
+def _nombre(app, cod):
+    frames, _ = app.storage().frames()
+    df = frames["REGISTRO DE CODIGOS"]
+    return df.loc[df["CODIGO"] == cod, "NOMBRE"].tolist()
+
+def test_conflicto_y_cambios_sin_conflicto(app):
+    data = _copia(app)
+    assert leer_libro(io.BytesIO(data))["JOURNAL_SEQ"]
+    inf = app.combinar_xlsx(data)
+    assert inf["historial"] and not inf["manda_archivo"]
+    assert [(c["CODIGO"], c["COLUMNA"], c["SERVIDOR"], c["ARCHIVO"]) for c in inf["conflictos"]] == \
+        [("M1", "NOMBRE", "MARIO SERVIDOR", "MARIO ARCHIVO")]
+    assert (inf["agregadas"], inf["actualizadas"], inf["solo_servidor"]) == (1, 1, 1)
+    assert _nombre(app, "M1") == ["MARIO SERVIDOR"]  # manda el servidor
+    assert app.compact_journal()
+    libro = leer_libro(app.EXCEL_PATH)
+    assert filas_con(libro, "REGISTRO DE CODIGOS", "D1")[0][1] == 15
+    assert filas_con(libro, "DISTRIBUIDOR", "D7")
+    assert app.next_code("D") == "D8"  # el contador sube con el código importado
+    assert app.combinar_xlsx(data)["conflictos"] and not app.combinar_xlsx(data)["agregadas"]
+
+def test_preferir_archivo(app):
+    inf = app.combinar_xlsx(_copia(app), preferir_archivo=True)
+    assert len(inf["conflictos"]) == 1 and inf["actualizadas"] == 2
+    assert _nombre(app, "M1") == ["MARIO ARCHIVO"]
+
+def test_copia_sin_historial(app):
+    inf = app.combinar_xlsx(_copia(app, sin_seq=True))
+    assert not inf["historial"]
+    assert sorted((c["CODIGO"], c["COLUMNA"]) for c in inf["conflictos"]) == [("D1", "PUNTAJE"), ("M1", "NOMBRE")]
+    assert inf["actualizadas"] == 0 and inf["agregadas"] == 1
+
+def test_archivo_invalido(app):
+    with pytest.raises(ValueError, match="Excel válido"):
+        app.combinar_xlsx(b"no es un xlsx")
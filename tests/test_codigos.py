@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+# Asignación de códigos: única aunque pidan a la vez varios hilos y procesos, un
+# escaneo fallido no siembra el contador (no se reparten códigos ya usados) y el
+# candado "excel" nunca se pide con "journal" tomado.
+
+import sys, json, subprocess, threading
+from contextlib import contextmanager
+
+import pytest
+
+from conftest import RAIZ
+
+HIJO = """
+import sys, json, logging
+logging.disable(logging.WARNING)
+sys.path.insert(0, sys.argv[1])
+import form_expo_feria2 as app
+print(json.dumps([app.allocate_code("C") for _ in range(int(sys.argv[2]))]))
+"""
+
+@pytest.mark.parametrize("backend", ["excel", "sqlite"])
+def test_asignacion_concurrente(cargar_app, backend):
+    app = cargar_app(backend)
+    hijos = [subprocess.Popen([sys.executable, "-c", HIJO, str(RAIZ), "60"], stdout=subprocess.PIPE, text=True)
+             for _ in range(3)]
+    codigos, errores = [], []
+    def asignar():
+        try:
+            for _ in range(40): codigos.append(app.allocate_code("C"))
+        except Exception as e: errores.append(e)
+    hilos = [threading.Thread(target=asignar) for _ in range(4)]
+    for t in hilos: t.start()
+    for t in hilos: t.join()
+    for h in hijos:
+        salida, _ = h.communicate(timeout=120)
+        assert h.returncode == 0
+        codigos += json.loads(salida.strip().splitlines()[-1])
+    assert not errores
+    assert len(codigos) == 4 * 40 + 3 * 60
+    assert len(set(codigos)) == len(codigos)
+    assert app._read_counters()["C"] == max(app._code_num(c, "C") for c in codigos)
+
+def test_siembra_con_los_codigos_existentes(cargar_app):
+    app = cargar_app()
+    app.storage().commit([{"op": "upsert", "sheet": "REGISTRO DE CODIGOS", "codigo": "C41", "fields": {"NOMBRE": "X"}}])
+    assert app.allocate_codes("C", 2) == ["C42", "C43"]
+    assert app.allocate_code("M") == "M2"  # el libro de ejemplo ya tiene M1
+
+def test_escaneo_fallido_no_guarda_el_contador(cargar_app):
+    app = cargar_app()
+    app.storage().commit([{"op": "upsert", "sheet": "REGISTRO DE CODIGOS", "codigo": "C41", "fields": {"NOMBRE": "X"}}])
+    class Rota:
+        sheetnames = ["REGISTRO DE CODIGOS", "CONSUMIDOR"]
+        def rows(self, hoja): raise OSError("lectura interrumpida")
+        def close(self): pass
+    with pytest.raises(OSError):
+        app.allocate_codes("C", 1, snap=Rota())
+    assert "C" not in app._read_counters()
+    assert app.allocate_code("C") == "C42"
+
+@pytest.mark.parametrize("reconciliar", [False, True])
+def test_orden_de_candados(cargar_app, monkeypatch, reconciliar):
+    # "excel" nunca se pide con "journal" tomado (compact_journal los toma al revés).
+    app = cargar_app()
+    app._storage.clear()  # el backend se crea dentro de la asignación (ensure_workbook toma "excel")
+    real, tomados, invertidos = app.file_lock, [], []
+    @contextmanager
+    def espia(nombre):
+        if nombre == "excel" and "journal" in tomados: invertidos.append(list(tomados))
+        with real(nombre):
+            tomados.append(nombre)
+            try: yield
+            finally: tomados.pop()
+    monkeypatch.setattr(app, "file_lock", espia)
+    if reconciliar: app.reconcile_counters()
+    else: assert app.allocate_code("M") == "M2"
+    assert not invertidos
+    assert app._read_counters()["M"] >= 1
+
+def test_nodos_no_repiten(cargar_app, tmp_path):
+    uno = cargar_app(directorio=tmp_path / "n1", NODE_ID=1, NODE_COUNT=2)
+    a = [uno.allocate_code("C") for _ in range(3)]
+    dos = cargar_app(directorio=tmp_path / "n2", NODE_ID=2, NODE_COUNT=2)
+    b = [dos.allocate_code("C") for _ in range(3)]
+    assert a == ["C1", "C3", "C5"] and b == ["C2", "C4", "C6"]
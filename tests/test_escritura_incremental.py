@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+# La escritura incremental del .xlsx (solo las hojas con eventos) deja exactamente los
+# mismos datos que la carga + guardado completo con openpyxl.
+
+from conftest import leer_libro
+
+FECHA = "2025-05-01 10:00:00"
+
+def _lotes():
+    cons = ["C90001", " Ana & <Bob> \"Ñandú\" ", "1700000019", "", None, 3, 2.5, True, "=1+1"] + [""] * 6 + ["PANTRO"]
+    return [
+        [{"op": "upsert", "sheet": "REGISTRO DE CODIGOS", "codigo": "M1", "fields": {"PUNTAJE": 1}}],
+        [{"op": "append", "sheet": "CONSUMIDOR", "values": cons},
+         {"op": "upsert", "sheet": "REGISTRO DE CODIGOS", "codigo": "C90001",
+          "fields": {"TIPO": "CONSUMIDOR", "STAND": "PANTRO", "FECHA REGISTRO": FECHA}}],
+        [{"op": "upsert", "sheet": "REGISTRO DE CODIGOS", "codigo": "M1", "fields": {"PUNTAJE": 75, "NOMBRE": ""}},
+         {"op": "upsert", "sheet": "REGISTRO DE CODIGOS", "codigo": "D1", "fields": {"PUNTAJE": None, "STAND": "EXTREMEMAX"}}],
+        [{"op": "append", "sheet": "REGISTRO DE PREMIOS", "values": ["M1", "GORRA", "", "", "", "", ""]},
+         {"op": "upsert", "sheet": "CONSUMIDOR", "codigo": "C90001", "fields": {"EDAD": "41", "STAND": "EXTREMEMAX"}},
+         {"op": "upsert", "sheet": "CONSUMIDOR", "codigo": "C90002", "fields": {"EDAD": "22"}},
+         {"op": "upsert", "sheet": "CONSUMIDOR", "codigo": "C90002", "fields": {"NOMBRE Y APELLIDO": "x"}},
+         {"op": "upsert", "sheet": "MECANICO", "codigo": "M1", "fields": {"EDAD": 36}}],
+    ]
+
+def _compactar(app, monkeypatch, incremental: bool):
+    usados = []
+    original = app._libro_incremental
+    def libro_incremental(*a):
+        inc = original(*a) if incremental else None
+        usados.append(inc is not None); return inc
+    monkeypatch.setattr(app, "_libro_incremental", libro_incremental)
+    for evs in _lotes():
+        app.storage().commit(evs)
+        assert app.compact_journal()
+    libro = leer_libro(app.EXCEL_PATH)
+    # El seq sale del reloj: cada corrida tiene el suyo, pero siempre el del último evento.
+    assert int(libro.pop("JOURNAL_SEQ")) == app.storage().horizon()
+    return libro, usados
+
+def test_incremental_igual_a_completo(cargar_app, tmp_path, monkeypatch):
+    inc, usados = _compactar(cargar_app(directorio=tmp_path / "incremental"), monkeypatch, True)
+    # La primera compactación agrega JOURNAL_SEQ (guardado completo); las demás son incrementales.
+    assert usados == [False, True, True, True]
+    completo, _ = _compactar(cargar_app(directorio=tmp_path / "completo"), monkeypatch, False)
+    assert inc.keys() == completo.keys()
+    for hoja in completo:
+        assert inc[hoja] == completo[hoja], hoja
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+# Exportación filtrada: stand y tipo por fila; provincia y ventana de FECHA REGISTRO
+# por CODIGO (así también filtran REGISTRO DE CODIGOS y REGISTRO DE PREMIOS).
+
+import io, zipfile
+
+import pandas as pd
+import pytest
+
+VISITANTES = [  # hoja, código, stand, provincia, FECHA REGISTRO
+    ("CONSUMIDOR", "C1", "PANTRO", "AZUAY", "2025-05-01 10:00:00"),
+    ("CONSUMIDOR", "C2", "EXTREMEMAX", "Guayas", "2025-05-02 11:00:00"),
+    ("MECANICO", "M2", "PANTRO", "GUAYAS", "2025-05-02 12:00:00"),
+]
+
+@pytest.fixture
+def app(cargar_app):
+    app = cargar_app()
+    evs = []
+    for hoja, cod, stand, prov, fecha in VISITANTES:
+        campos = {"CODIGO": cod, "NOMBRE Y APELLIDO": f"Visitante {cod}", "PROVINCIA": prov, "STAND": stand}
+        fila = [None] * len(app.HEADERS[hoja])
+        for h, v in campos.items(): fila[app.HEADERS[hoja].index(h)] = v  # index: la primera PROVINCIA
+        evs.append({"op": "append", "sheet": hoja, "values": fila})
+        evs.append({"op": "upsert", "sheet": "REGISTRO DE CODIGOS", "codigo": cod,
+                    "fields": {"TIPO": hoja, "STAND": stand, "FECHA REGISTRO": fecha}})
+    evs += [{"op": "append", "sheet": "REGISTRO DE PREMIOS", "values": [c, "GORRA", None, None, None, t, "PANTRO"]}
+            for c, t in (("C1", "CONSUMIDOR"), ("M2", "MECANICO"))]
+    app.storage().commit(evs)
+    return app
+
+def _codigos(app, hojas=("CONSUMIDOR", "REGISTRO DE CODIGOS", "REGISTRO DE PREMIOS"), **filtros):
+    out = {h: [] for h in hojas}
+    for hoja, df in app.filas_exportacion(list(hojas), bloque=1, **filtros):
+        out[hoja] += [str(c) for c in df["CODIGO"]]
+    return out
+
+def test_sin_filtros(app):
+    assert _codigos(app) == {"CONSUMIDOR": ["C1", "C2"], "REGISTRO DE CODIGOS": ["M1", "D1", "C1", "C2", "M2"],
+                             "REGISTRO DE PREMIOS": ["C1", "M2"]}
+
+def test_filtros(app):
+    assert _codigos(app, stand="PANTRO") == {"CONSUMIDOR": ["C1"], "REGISTRO DE CODIGOS": ["C1", "M2"],
+                                             "REGISTRO DE PREMIOS": ["C1", "M2"]}
+    assert _codigos(app, tipo="MECANICO") == {"CONSUMIDOR": [], "REGISTRO DE CODIGOS": ["M1", "M2"],
+                                              "REGISTRO DE PREMIOS": ["M2"]}
+    assert _codigos(app, provincia="guayas") == {"CONSUMIDOR": ["C2"], "REGISTRO DE CODIGOS": ["C2", "M2"],
+                                                 "REGISTRO DE PREMIOS": ["M2"]}
+    # Los códigos sin FECHA REGISTRO (M1, D1) quedan fuera de cualquier ventana.
+    assert _codigos(app, desde="2025-05-02 00:00:00") == {"CONSUMIDOR": ["C2"], "REGISTRO DE CODIGOS": ["C2", "M2"],
+                                                          "REGISTRO DE PREMIOS": ["M2"]}
+    assert _codigos(app, hasta="2025-05-01 23:59:59") == {"CONSUMIDOR": ["C1"], "REGISTRO DE CODIGOS": ["C1"],
+                                                          "REGISTRO DE PREMIOS": ["C1"]}
+    assert _codigos(app, stand="PANTRO", provincia="GUAYAS", desde="2025-05-02 00:00:00", hasta="2025-05-02 23:59:59") == \
+        {"CONSUMIDOR": [], "REGISTRO DE CODIGOS": ["M2"], "REGISTRO DE PREMIOS": ["M2"]}
+
+def test_igual_tras_compactar(app):
+    antes = _codigos(app, stand="PANTRO", desde="2025-05-01 00:00:00")
+    assert app.compact_journal()
+    assert _codigos(app, stand="PANTRO", desde="2025-05-01 00:00:00") == antes
+
+def test_archivos(app):
+    csv = app.exportar_hojas(["CONSUMIDOR"], "csv", stand="EXTREMEMAX")
+    assert csv.startswith("﻿".encode("utf-8"))
+    df = pd.read_csv(io.BytesIO(csv), sep=";", encoding="utf-8-sig", dtype=str)
+    assert list(df.columns[:2]) == ["CODIGO", "NOMBRE Y APELLIDO"] and df["CODIGO"].tolist() == ["C2"]
+    zf = zipfile.ZipFile(io.BytesIO(app.exportar_hojas(["CONSUMIDOR", "REGISTRO DE PREMIOS"], "csv", provincia="AZUAY")))
+    assert zf.namelist() == ["CONSUMIDOR.csv", "REGISTRO DE PREMIOS.csv"]
+    assert pd.read_csv(zf.open("REGISTRO DE PREMIOS.csv"), sep=";", encoding="utf-8-sig")["CODIGO"].tolist() == ["C1"]
+    if app._hay_parquet():
+        pq = pd.read_parquet(io.BytesIO(app.exportar_hojas(["REGISTRO DE CODIGOS"], "parquet", tipo="CONSUMIDOR")))
+        assert pq["CODIGO"].tolist() == ["C1", "C2"]
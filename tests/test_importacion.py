@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+# Importación masiva: validación por columnas (cédula/RUC, teléfono, stand, correo),
+# duplicados contra el servidor y dentro del archivo (sin índice no se importa nada), y
+# UNA escritura con los códigos.
+
+import io
+
+import pytest
+from openpyxl import Workbook
+
+CSV = """NOMBRE;CEDULA;CELULAR;STAND;EMAIL;EDAD
+Ana Perez;1700000019;0999999999;pantro;Ana@X.com;30
+;1700000027;0988888888;PANTRO;;
+Luis Vera;1712345678;0977777777;PANTRO;;
+Rosa Mora;100000009;987654321;EXTREMEMAX;;200
+Pedro Ortiz;1700000019;0966666666;PANTRO;;
+Mario Ponce;1804543047001;0955555555;PANTRO;;
+Sofia Rivera;1700000035;0944444444;OTRO;;
+Paola Salazar;1700000043;0933333333;PANTRO;paola@;
+Carmen Torres;1700000043001;098772778;PANTRO;;
+"""
+
+def _estados(inf):
+    return {f["FILA"]: (f["CODIGO"], f["ESTADO"]) for f in inf}
+
+def test_validacion_y_duplicados(cargar_app):
+    app = cargar_app()
+    inf = _estados(app.importar_visitantes("MECANICO", "pre.csv", CSV.encode("utf-8"), bloque=3))
+    assert inf[2] == ("M2", "✅ Importado")
+    assert inf[3] == ("", "❌ Falta el nombre")
+    assert inf[4] == ("", "❌ Documento inválido (cédula o RUC natural)")
+    assert inf[5] == ("M3", "✅ Importado")  # 0 inicial recuperado, celular sin el 0
+    assert inf[6] == ("", "❌ Repetido en el archivo (fila 2)")
+    assert inf[7][1].startswith("❌ Ya registrado") and "M1" in inf[7][1]
+    assert inf[8][1].startswith("❌ Stand inválido")
+    assert inf[9] == ("", "❌ Correo inválido")
+    assert inf[10][0] == "M4" and "teléfono ya registrado (M1)" in inf[10][1]  # solo aviso
+    snap = app.storage().snapshot()
+    try:
+        hm = snap.hmap("MECANICO")
+        ana, rosa = snap.get("MECANICO", "M2"), snap.get("MECANICO", "M3")
+        assert ana[hm["CORREO"]] == "ana@x.com" and ana[hm["STAND"]] == "PANTRO" and ana[hm["EDAD"]] == 30
+        assert rosa[hm["RUC O CEDULA"]] == "0100000009" and rosa[hm["TELEFONO"]] == "0987654321"
+        assert rosa[hm["EDAD"]] is None  # fuera de rango
+        reg = snap.hmap("REGISTRO DE CODIGOS"); m4 = snap.get("REGISTRO DE CODIGOS", "M4")
+        assert (m4[reg["TIPO"]], m4[reg["STAND"]], m4[reg["RUC O CEDULA"]]) == ("MECANICO", "PANTRO", "1700000043001")
+    finally: snap.close()
+    assert app._read_counters()["M"] == 4
+    # El mismo archivo otra vez: lo importado ya está en el índice de duplicados.
+    otra = _estados(app.importar_visitantes("MECANICO", "pre.csv", CSV.encode("utf-8")))
+    assert all(not c for c, _ in otra.values())
+    assert all(otra[f][1].startswith("❌ Ya registrado") for f in (2, 5, 10))
+
+def test_xlsx_y_columnas_obligatorias(cargar_app):
+    app = cargar_app()
+    wb = Workbook(); ws = wb.active
+    ws.append(["Nombres", "Cédula", "Teléfono", "Stand"])
+    ws.append(["Ana Perez", 1700000019, 999999999, "PANTRO"])  # números como los deja Excel
+    ws.append([None, None, None, None])
+    buf = io.BytesIO(); wb.save(buf)
+    inf = app.importar_visitantes("CONSUMIDOR", "pre.xlsx", buf.getvalue())
+    assert [(f["FILA"], f["CODIGO"], f["ESTADO"]) for f in inf] == [(2, "C1", "✅ Importado")]
+    snap = app.storage().snapshot()
+    try: assert snap.get("CONSUMIDOR", "C1")[1:4] == ("Ana Perez", "1700000019", "0999999999")
+    finally: snap.close()
+    with pytest.raises(ValueError, match="STAND"):
+        app.importar_visitantes("CONSUMIDOR", "pre.csv", b"NOMBRE,CEDULA,TELEFONO\nAna,1700000019,0999999999\n")
+
+def test_sin_indice_de_duplicados_no_importa(cargar_app, monkeypatch):
+    app = cargar_app()
+    def rota(nombre): raise OSError("índice no disponible")
+    monkeypatch.setattr(app, "obtener_vista", rota)
+    with pytest.raises(OSError):
+        app.importar_visitantes("MECANICO", "pre.csv", CSV.encode("utf-8"))
+    assert app.storage().pending() == 0 and "M" not in app._read_counters()
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+# Journal append-only: los eventos se leen antes de compactar (también tras reiniciar)
+# y la compactación es idempotente, incluso si el journal no llegó a truncarse.
+
+import io
+
+from conftest import leer_libro, filas_con
+
+EVENTOS = [
+    {"op": "append", "sheet": "CONSUMIDOR", "values": ["C901", "ANA PEREZ", "1700000019", "0999999999"]},
+    {"op": "upsert", "sheet": "REGISTRO DE CODIGOS", "codigo": "C901",
+     "fields": {"RUC O CEDULA": "1700000019", "NOMBRE": "ANA PEREZ", "TIPO": "CONSUMIDOR", "STAND": "PANTRO"}},
+    {"op": "upsert", "sheet": "REGISTRO DE CODIGOS", "codigo": "M1", "fields": {"PUNTAJE": 40}},
+]
+
+def _ver(app):
+    snap = app.storage().snapshot()
+    try: return snap.get("CONSUMIDOR", "C901"), snap.get("REGISTRO DE CODIGOS", "C901"), snap.get("REGISTRO DE CODIGOS", "M1")
+    finally: snap.close()
+
+def test_replay_antes_de_compactar_y_tras_reiniciar(cargar_app):
+    app = cargar_app()
+    app.storage().commit(EVENTOS)
+    assert not filas_con(leer_libro(app.EXCEL_PATH), "CONSUMIDOR", "C901")  # aún solo en el journal
+    cons, reg, m1 = _ver(app)
+    assert cons[:3] == ("C901", "ANA PEREZ", "1700000019")
+    assert reg[0] == "C901" and "CONSUMIDOR" in reg
+    assert m1[:2] == ("M1", 40)
+    app = cargar_app()  # reinicio: el journal se vuelve a leer del disco
+    assert app.storage().pending() == len(EVENTOS)
+    assert _ver(app) == (cons, reg, m1)
+
+def test_compactacion_idempotente(cargar_app):
+    app = cargar_app()
+    app.storage().commit(EVENTOS)
+    journal = app.JOURNAL_PATH.read_bytes()
+    assert app.compact_journal()
+    assert app.storage().pending() == 0
+    libro = leer_libro(app.EXCEL_PATH)
+    assert len(filas_con(libro, "CONSUMIDOR", "C901")) == 1
+    assert len(filas_con(libro, "REGISTRO DE CODIGOS", "C901")) == 1
+    assert filas_con(libro, "REGISTRO DE CODIGOS", "M1")[0][1] == 40
+    # Sin eventos nuevos no se reescribe nada.
+    datos = app.EXCEL_PATH.read_bytes()
+    assert app.compact_journal()
+    assert app.EXCEL_PATH.read_bytes() == datos
+    # Corte entre el guardado y el truncado: los mismos eventos vuelven a estar en el
+    # journal. JOURNAL_SEQ del libro dice que ya están aplicados: no se duplican.
+    app.JOURNAL_PATH.write_bytes(journal)
+    app = cargar_app()
+    assert app.compact_journal()
+    again = leer_libro(app.EXCEL_PATH)
+    assert {h: again[h] for h in libro if h != "JOURNAL_SEQ"} == {h: v for h, v in libro.items() if h != "JOURNAL_SEQ"}
+    assert app.storage().pending() == 0
+
+def test_descarga_compacta_antes(cargar_app):
+    app = cargar_app()
+    app.storage().commit(EVENTOS)
+    libro = leer_libro(io.BytesIO(app.excel_para_descargar()))
+    assert len(filas_con(libro, "CONSUMIDOR", "C901")) == 1
+    assert filas_con(libro, "REGISTRO DE CODIGOS", "M1")[0][1] == 40
+    assert app.storage().pending() == 0
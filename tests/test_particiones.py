@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+# Capa columnar particionada por (día de FECHA REGISTRO, STAND): las consultas podan
+# particiones y una versión nueva comparte (y no reescribe) las que no tocó.
+
+import pytest
+
+from conftest import leer_libro
+
+def _evs(app, *visitantes, seq0=1):
+    """Eventos de registro de (código, día, stand) en CONSUMIDOR, con seq."""
+    evs = []
+    for cod, dia, stand in visitantes:
+        fila = [cod, f"Visitante {cod}"] + [None] * (len(app.HEADERS["CONSUMIDOR"]) - 2)
+        fila[app.HEADERS["CONSUMIDOR"].index("STAND")] = stand
+        evs.append({"op": "append", "sheet": "CONSUMIDOR", "values": fila})
+        evs.append({"op": "upsert", "sheet": "REGISTRO DE CODIGOS", "codigo": cod,
+                    "fields": {"TIPO": "CONSUMIDOR", "STAND": stand, "FECHA REGISTRO": f"{dia} 10:00:00" if dia else None}})
+    for i, e in enumerate(evs): e["seq"] = seq0 + i
+    return evs
+
+@pytest.fixture
+def app(cargar_app):
+    return cargar_app()
+
+@pytest.fixture
+def base(app):
+    vacias = {h: app.frame_de_filas(cols, ()) for h, cols in app.HEADERS.items()}
+    hojas = {h: app.frame_con_eventos(df, [e for e in _evs(app, ("C1", "2025-05-01", "PANTRO"),
+                                                              ("C2", "2025-05-02", "EXTREMEMAX"), ("C3", "", "PANTRO"))
+                                             if e["sheet"] == h]) for h, df in vacias.items()}
+    return app.Particiones.desde_frames(hojas, 6)
+
+def _cods(df): return df["CODIGO"].tolist()
+
+def test_particion_y_poda(app, base):
+    assert set(base.partes["CONSUMIDOR"]) == {("2025-05-01", "PANTRO"), ("2025-05-02", "EXTREMEMAX"), ("", "PANTRO")}
+    assert _cods(base.hoja("CONSUMIDOR")) == ["C1", "C2", "C3"]
+    # Con días, las filas sin FECHA REGISTRO quedan fuera; el orden es el del Excel.
+    q = base.consultar(["CONSUMIDOR", "REGISTRO DE CODIGOS"], ("2025-05-02", None))
+    assert _cods(q["CONSUMIDOR"]) == ["C2"] and _cods(q["REGISTRO DE CODIGOS"]) == ["C2"]
+    assert _cods(base.consultar(["CONSUMIDOR"], stands={"PANTRO"})["CONSUMIDOR"]) == ["C1", "C3"]
+    assert _cods(base.consultar(["CONSUMIDOR"], (None, "2025-05-01"), {"PANTRO"})["CONSUMIDOR"]) == ["C1"]
+
+def test_aplicar_comparte_lo_no_tocado(app, base):
+    base.ids.update({("CONSUMIDOR", *k): f"p{i}" for i, k in enumerate(base.partes["CONSUMIDOR"])})
+    nueva = base.aplicar(_evs(app, ("C4", "2025-05-03", "PANTRO"), seq0=7))
+    assert nueva is not None and nueva.seq == 8 and nueva.n["CONSUMIDOR"] == 4
+    for k, df in base.partes["CONSUMIDOR"].items():
+        assert nueva.partes["CONSUMIDOR"][k] is df and nueva.ids[("CONSUMIDOR", *k)] == base.ids[("CONSUMIDOR", *k)]
+    assert _cods(nueva.partes["CONSUMIDOR"][("2025-05-03", "PANTRO")]) == ["C4"]
+    assert _cods(nueva.hoja("CONSUMIDOR")) == ["C1", "C2", "C3", "C4"]
+    assert _cods(base.hoja("CONSUMIDOR")) == ["C1", "C2", "C3"]  # la versión anterior no cambia
+
+def test_aplicar_mueve_stand_y_rechaza_cambio_de_dia(app, base):
+    mov = base.aplicar([{"op": "upsert", "sheet": "CONSUMIDOR", "codigo": "C1", "fields": {"STAND": "EXTREMEMAX"}, "seq": 7}])
+    assert ("2025-05-01", "PANTRO") not in mov.partes["CONSUMIDOR"]
+    assert _cods(mov.consultar(["CONSUMIDOR"], stands={"EXTREMEMAX"})["CONSUMIDOR"]) == ["C1", "C2"]
+    assert _cods(mov.hoja("CONSUMIDOR")) == ["C1", "C2", "C3"]  # conserva su posición
+    assert base.aplicar([{"op": "upsert", "sheet": "REGISTRO DE CODIGOS", "codigo": "C1",
+                          "fields": {"FECHA REGISTRO": "2025-05-04 09:00:00"}, "seq": 7}]) is None
+
+def test_compactar_no_reescribe_dias_cerrados(app):
+    be = app.storage()
+    be.commit([{k: v for k, v in e.items() if k != "seq"}
+               for e in _evs(app, ("C1", "2025-05-01", "PANTRO"), ("C2", "2025-05-02", "EXTREMEMAX"))])
+    assert app.compact_journal()
+    antes = app.columnar_base()
+    partes = app.COLUMNAR_DIR / "partes"
+    mtimes = {p.name: p.stat().st_mtime_ns for p in partes.glob("*.arrow")}
+    be.commit([{k: v for k, v in e.items() if k != "seq"} for e in _evs(app, ("C3", "2025-05-03", "PANTRO"))])
+    assert app.compact_journal()
+    despues = app.columnar_base()
+    assert despues is not antes and despues.seq == int(leer_libro(app.EXCEL_PATH)["JOURNAL_SEQ"])
+    nuevas = {k for k in despues.ids if k[1] == "2025-05-03"}
+    assert {k[0] for k in nuevas} == {"CONSUMIDOR", "REGISTRO DE CODIGOS"}
+    for k, pid in antes.ids.items():  # todo lo demás: mismo objeto, mismo archivo, sin reescribir
+        assert despues.ids[k] == pid and despues.partes[k[0]][k[1:]] is antes.partes[k[0]][k[1:]]
+        assert (partes / f"{pid}.arrow").stat().st_mtime_ns == mtimes[f"{pid}.arrow"]
+    assert _cods(despues.hoja("CONSUMIDOR")) == ["C1", "C2", "C3"]
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+# Sincronización multi-nodo: la misma persona registrada en dos nodos queda una sola vez
+# (código menor, puntaje mayor, premios unidos) y volver a sincronizar no cambia nada.
+
+import os, sys, subprocess
+
+from conftest import RAIZ, leer_libro, filas_con
+
+def _registrar(app, hoja, nombre, cedula, telefono):
+    valores = {"NOMBRE Y APELLIDO": nombre, "CEDULA O RUC": cedula, "RUC O CEDULA": cedula,
+               "TELEFONO": telefono, "STAND": "PANTRO"}
+    fila = [valores.get(h, "") for h in app.HEADERS[hoja][1:]]
+    codigo, _ = app.registrar_visitante(hoja, app.VISITOR_PREFIX[hoja], fila, cedula, "", telefono, nombre, "PANTRO")
+    assert codigo
+    return codigo
+
+def _nodos(cargar_app, tmp_path):
+    n1 = cargar_app(directorio=tmp_path / "n1", NODE_ID=1, NODE_COUNT=2)
+    ana1 = _registrar(n1, "CONSUMIDOR", "Ana Pérez", "1700000019", "0999999999")
+    assert n1.compact_journal()  # el nodo 1 llega con libro + journal
+    luis = _registrar(n1, "CONSUMIDOR", "Luis Vera", "1700000027", "0988888888")
+    n1.storage().upsert("REGISTRO DE CODIGOS", ana1, {"PUNTAJE": 30})
+    n1.storage().append("REGISTRO DE PREMIOS", [ana1, "GORRA", "", "", "", "", ""])
+    n2 = cargar_app(directorio=tmp_path / "n2", NODE_ID=2, NODE_COUNT=2)
+    ana2 = _registrar(n2, "CONSUMIDOR", "ANA PEREZ", "", "0999999999")  # misma persona, sin cédula
+    pedro = _registrar(n2, "MECANICO", "Pedro Mora", "0912345675", "0977777777")
+    n2.storage().upsert("REGISTRO DE CODIGOS", ana2, {"PUNTAJE": 50})
+    n2.storage().append("REGISTRO DE PREMIOS", [ana2, "CASCO", "", "", "", "", ""])
+    return (ana1, luis), (ana2, pedro)
+
+def test_misma_persona_en_dos_nodos_e_idempotente(cargar_app, tmp_path):
+    (ana1, luis), (ana2, pedro) = _nodos(cargar_app, tmp_path)
+    assert (ana1, luis, ana2, pedro) == ("C1", "C3", "C2", "M2")
+    maestro = cargar_app(directorio=tmp_path / "maestro", NODE_ID=1, NODE_COUNT=2)
+    inf = maestro.sincronizar_nodos([tmp_path / "n1", tmp_path / "n2"])
+    assert inf["fusionados"] == 1
+    libro = leer_libro(maestro.EXCEL_PATH)
+    assert [r[0] for r in libro["CONSUMIDOR"][1:] if r and r[0]] == ["C1", "C3"]
+    assert [r[0] for r in libro["MECANICO"][1:] if r and r[0]] == ["M1", "M2"]
+    assert filas_con(libro, "REGISTRO DE CODIGOS", "C1")[0][1] == 50  # el puntaje mayor
+    assert not filas_con(libro, "REGISTRO DE CODIGOS", "C2")
+    assert sorted(r[1] for r in filas_con(libro, "REGISTRO DE PREMIOS", "C1")) == ["CASCO", "GORRA"]
+    assert libro[maestro.HOJA_FUSIONES][1:] == [("C2", "C1")]
+    assert maestro._read_counters()["C"] >= 3 and maestro._read_counters()["M"] >= 2
+    # Otra vez, con la herramienta de línea de comandos: el maestro no cambia.
+    r = subprocess.run([sys.executable, str(RAIZ / "sincronizar_nodos.py"), str(tmp_path / "n1"), str(tmp_path / "n2"),
+                        "--maestro", str(tmp_path / "maestro")], capture_output=True, text=True, env=dict(os.environ))
+    assert r.returncode == 0, r.stderr
+    assert leer_libro(maestro.EXCEL_PATH) == libro
+
+def test_salida_no_toca_el_maestro(cargar_app, tmp_path):
+    _nodos(cargar_app, tmp_path)
+    maestro = cargar_app(directorio=tmp_path / "maestro", NODE_ID=1, NODE_COUNT=2)
+    maestro.storage()  # al arrancar completa los encabezados del libro de ejemplo
+    antes = leer_libro(maestro.EXCEL_PATH)
+    maestro.sincronizar_nodos([tmp_path / "n1", tmp_path / "n2"], salida=tmp_path / "combinado.xlsx")
+    assert leer_libro(maestro.EXCEL_PATH) == antes
+    assert [r[0] for r in leer_libro(tmp_path / "combinado.xlsx")["CONSUMIDOR"][1:] if r and r[0]] == ["C1", "C3"]
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# Backend SQLite: exportar poda el log de eventos hasta export_seq (horizon), las
+# vistas detectan el hueco y combinar_xlsx sigue sabiendo qué códigos cambiaron.
+
+import io, sqlite3
+
+from conftest import leer_libro, filas_con
+
+def _eventos(app):
+    conn = sqlite3.connect(app.SQLITE_PATH)
+    try: return conn.execute("SELECT COUNT(*) FROM eventos").fetchone()[0]
+    finally: conn.close()
+
+def _puntaje(app, cod, n):
+    app.storage().upsert("REGISTRO DE CODIGOS", cod, {"PUNTAJE": n})
+
+def test_exportar_poda_el_log(cargar_app):
+    app = cargar_app("sqlite")
+    be = app.storage()
+    _puntaje(app, "M1", 10); _puntaje(app, "D1", 20)
+    antes = be.last_seq()
+    assert be.pending() == 2 and be.horizon() == 0
+    libro = leer_libro(io.BytesIO(app.excel_para_descargar()))
+    assert filas_con(libro, "REGISTRO DE CODIGOS", "D1")[0][1] == 20
+    assert int(libro["JOURNAL_SEQ"]) == be.horizon() == be.last_seq() == antes
+    assert _eventos(app) == 0 and be.pending() == 0
+    snap = be.snapshot()
+    try: assert snap.seq == antes and snap.get("REGISTRO DE CODIGOS", "M1")[1] == 10
+    finally: snap.close()
+    _puntaje(app, "M1", 11)
+    assert be.last_seq() > antes and be.pending() == 1 and _eventos(app) == 1
+    app = cargar_app("sqlite")  # reinicio: export_seq y el log podado siguen en la base
+    assert app.storage().horizon() == antes and app.storage().pending() == 1
+
+def test_vistas_detectan_la_poda(cargar_app):
+    app = cargar_app("sqlite")
+    perfiles = app.obtener_vista("perfiles")
+    _puntaje(app, "M1", 10)
+    assert app.obtener_vista("perfiles") is perfiles  # se parcha
+    app.storage().export_xlsx()
+    assert app.obtener_vista("perfiles") is perfiles  # ya estaba al día: sin hueco
+    # Un evento que se exporta (y poda) antes de que la vista lo lea: se reconstruye.
+    _puntaje(app, "D1", 30)
+    app.storage().export_xlsx()
+    nuevos = app.obtener_vista("perfiles")
+    assert nuevos is not perfiles and nuevos["D1"]["puntaje"] == 30 and nuevos["M1"]["puntaje"] == 10
+
+def test_combinar_tras_la_poda(cargar_app):
+    app = cargar_app("sqlite")
+    _puntaje(app, "D1", 5)
+    copia = app.excel_para_descargar()
+    _puntaje(app, "M1", 10)
+    app.storage().export_xlsx()  # el cambio de M1 ya no está en el log
+    inf = app.combinar_xlsx(copia)
+    assert inf["historial"] and not inf["actualizadas"]
+    assert [(c["CODIGO"], c["COLUMNA"]) for c in inf["conflictos"]] == [("M1", "PUNTAJE")]
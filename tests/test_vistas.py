@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+# Vistas write-through: se parchan con cada evento, también a través de una
+# compactación propia; si otro proceso truncó el journal o el Excel cambió por fuera,
+# se reconstruyen (nunca quedan con datos viejos).
+
+from conftest import LIBRO
+
+def _registrar(app, cod, nombre, puntaje):
+    app.storage().commit([
+        {"op": "append", "sheet": "CONSUMIDOR", "values": [cod, nombre, "1700000019", "0999999999"]},
+        {"op": "upsert", "sheet": "REGISTRO DE CODIGOS", "codigo": cod,
+         "fields": {"PUNTAJE": puntaje, "NOMBRE": nombre, "TIPO": "CONSUMIDOR", "STAND": "PANTRO"}}])
+
+def _puntaje(app, cod):
+    return app.obtener_vista("perfiles")[cod]["puntaje"]
+
+def test_se_parchan_a_traves_de_la_compactacion(cargar_app):
+    app = cargar_app()
+    perfiles = app.obtener_vista("perfiles")
+    assert "M1" in perfiles and "C901" not in perfiles
+    _registrar(app, "C901", "ANA PEREZ", 10)
+    assert app.obtener_vista("perfiles") is perfiles and _puntaje(app, "C901") == 10
+    assert app.top_puntajes(1)[0]["CODIGO"] == "C901"
+    assert app.compact_journal()
+    app.storage().upsert("REGISTRO DE CODIGOS", "M1", {"PUNTAJE": 30})
+    assert app.obtener_vista("perfiles") is perfiles  # parchada, no reconstruida
+    assert _puntaje(app, "M1") == 30 and _puntaje(app, "C901") == 10
+    assert [f["CODIGO"] for f in app.top_puntajes(2)] == ["M1", "C901"]
+    idx, ids = app.buscar("codigos", "ana perez")
+    assert [idx.rows[i]["CODIGO"] for i in ids] == ["C901"]
+
+def test_compactacion_de_otro_proceso_reconstruye(cargar_app):
+    app = cargar_app()
+    perfiles = app.obtener_vista("perfiles")
+    _registrar(app, "C901", "ANA PEREZ", 10)
+    app.obtener_vista("perfiles")
+    # Como si compactara otro proceso: nadie avisa a las vistas antes de truncar.
+    app._journal_state()["observers"].clear()
+    app.storage().upsert("REGISTRO DE CODIGOS", "C901", {"PUNTAJE": 55})
+    assert app.compact_journal() and app.storage().pending() == 0
+    assert app.obtener_vista("perfiles") is not perfiles
+    assert _puntaje(app, "C901") == 55
+
+def test_carga_externa_reconstruye(cargar_app):
+    app = cargar_app()
+    _registrar(app, "C901", "ANA PEREZ", 10)
+    assert "C901" in app.obtener_vista("perfiles")
+    assert app.compact_journal()
+    app.storage().replace_from_xlsx(LIBRO.read_bytes())
+    perfiles = app.obtener_vista("perfiles")
+    assert "C901" not in perfiles and "M1" in perfiles
+    assert [f["CODIGO"] for f in app.top_puntajes(5)] == ["D1", "M1"]  # empate: por CODIGO